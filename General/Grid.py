@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Grid:
     """
     Represents a multi-dimensional grid in space.
@@ -20,6 +23,27 @@ class Grid:
                 raise ValueError('Invalid bound parameter detected, be ascending')
         self.bounds = bounds
         self.sizes = sizes
+        self.__cache = {}
+        self.__cache_key = None
+
+    def __cached(self, name, factory):
+        """
+        Obtain a cached array, recalculating it if grid bounds or sizes have changed.
+
+        :param name: Cache entry name
+        :param factory: Function that calculates the entry
+        :return: Cached value
+        """
+        key = tuple(tuple(b) for b in self.bounds), tuple(self.sizes)
+        if key != self.__cache_key:
+            self.__cache = {}
+            self.__cache_key = key
+        if name not in self.__cache:
+            value = factory()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self.__cache[name] = value
+        return self.__cache[name]
 
     def grid_step(self, axis):
         """
@@ -31,6 +55,43 @@ class Grid:
         if self.sizes[axis] != 1:
             return (self.bounds[axis][1] - self.bounds[axis][0]) / (self.sizes[axis] - 1)
 
+    def is_uniform(self, axis=None):
+        """
+        Check if grid points are equally spaced
+
+        :param axis: Index of the axis to check, all axes are checked if not specified
+        :return: True if the grid is uniform
+        """
+        return True
+
+    def axis_widths(self, axis):
+        """
+        Obtain widths of the cells around grid nodes on specified axis:
+        half of the distance between the neighbours, or the distance to the only neighbour on the bounds
+
+        :param axis: Index of the axis specified
+        :return: Array of widths
+        """
+
+        def factory():
+            if self.sizes[axis] == 1:
+                return np.ones(1)
+            if self.is_uniform(axis):
+                return np.full(self.sizes[axis], self.grid_step(axis))
+            steps = np.diff(self.axis_coordinates(axis))
+            return np.concatenate([steps[:1], (steps[:-1] + steps[1:]) / 2, steps[-1:]])
+
+        return self.__cached(('widths', axis), factory)
+
+    def cell_volumes(self):
+        """
+        Obtain volumes of the cells around all grid points, products of cell widths by every axis
+
+        :return: Array ordered by point indices
+        """
+        return self.__cached('volumes', lambda: np.prod(np.meshgrid(
+            *(self.axis_widths(dim) for dim in range(self.dimensions())), indexing='ij'), axis=0).ravel(order='F'))
+
     def mesh(self, initial_obj=None):
         """
         Return empty multi-dimensional array with parameters corresponding to grid constraints
@@ -65,7 +126,8 @@ class Grid:
     def point_to_absolute(self, point):
         if len(point) != len(self.sizes):
             raise ValueError('Point dimension does not match grid dimension')
-        return [self.bounds[dim][0] + self.grid_step(dim) * point[dim] for dim in range(len(self.sizes))]
+        steps = self.__cached('steps', lambda: [self.grid_step(dim) for dim in range(self.dimensions())])
+        return [self.bounds[dim][0] + steps[dim] * point[dim] for dim in range(len(self.sizes))]
 
     def point_from_absolute(self, point):
         if len(point) != len(self.sizes):
@@ -81,13 +143,129 @@ class Grid:
         return tuple((point[i] + offset if i == axis else point[i]) % self.sizes[i] for i in range(self.dimensions()))
 
     def points_inside(self):
-        for i in range(len(self)):
-            pt = self[i]
-            for dim in range(self.dimensions()):
-                if pt[dim] == 0 or pt[dim] == self.sizes[dim] - 1:
-                    break
-            else:
-                yield pt
+        for i in np.flatnonzero(self.interior_mask()):
+            yield self[int(i)]
+
+    def axis_coordinates(self, axis):
+        """
+        Obtain absolute coordinates of all grid nodes on specified axis
+
+        :param axis: Index of the axis specified
+        :return: Array of coordinates
+        """
+        return self.__cached(('axis', axis), lambda: self.bounds[axis][0] + np.arange(self.sizes[axis], dtype=float) * (
+            self.grid_step(axis) or 0))
+
+    def mesh_coordinates(self):
+        """
+        Obtain absolute coordinates of all grid points arranged the same way as the mesh
+
+        :return: List of arrays shaped as the grid, one for every axis
+        """
+        return self.__cached('mesh', lambda: np.meshgrid(
+            *(self.axis_coordinates(dim) for dim in range(self.dimensions())), indexing='ij'))
+
+    def coordinate_columns(self):
+        """
+        Obtain absolute coordinates of all grid points ordered by their indices
+
+        :return: Array of shape (dimensions, len(grid)), row i contains coordinates by axis i
+        """
+        return self.__cached('columns', lambda: np.array([c.ravel(order='F') for c in self.mesh_coordinates()]))
+
+    def to_mesh(self, values):
+        """
+        Arrange values given for every grid point the same way as the mesh
+
+        :param values: Array of values ordered by point indices
+        :return: Array shaped as the grid
+        """
+        return np.reshape(values, self.sizes, order='F')
+
+    def ravel(self, points):
+        """
+        Match many grid points to their indices at once
+
+        :param points: Array of shape (count, dimensions) with grid points
+        :return: Array of indices
+        """
+        points = np.asarray(points, dtype=int).reshape((-1, self.dimensions()))
+        return np.ravel_multi_index(tuple(points.transpose()), self.sizes, order='F')
+
+    def unravel(self, indices):
+        """
+        Obtain many grid points by their indices at once
+
+        :param indices: Array of indices
+        :return: Array of shape (count, dimensions) with grid points
+        """
+        return np.array(np.unravel_index(indices, self.sizes, order='F')).reshape((self.dimensions(), -1)).transpose()
+
+    def neighbour_indices(self, axis, offset):
+        """
+        Obtain indices of the points shifted along given axis for every grid point, like shift_point does
+
+        :param axis: Index of the axis specified
+        :param offset: Shift along the axis
+        :return: Array of indices
+        """
+        if not 0 <= axis < self.dimensions():
+            raise IndexError('Point has no axis #{}'.format(axis))
+
+        def factory():
+            shape = [1] * self.dimensions()
+            shape[axis] = self.sizes[axis]
+            shifted = (np.arange(self.sizes[axis]) + offset) % self.sizes[axis] - np.arange(self.sizes[axis])
+            stride = int(np.prod(self.sizes[:axis]))
+            return np.arange(len(self)) + stride * np.broadcast_to(shifted.reshape(shape), self.sizes).ravel(order='F')
+
+        return self.__cached(('neighbours', axis, offset), factory)
+
+    def reflection_indices(self, axis):
+        """
+        Obtain indices of the points mirrored along given axis for every grid point
+
+        :param axis: Index of the axis specified
+        :return: Array of indices
+        """
+        if not 0 <= axis < self.dimensions():
+            raise IndexError('Point has no axis #{}'.format(axis))
+        return self.__cached(('reflection', axis),
+                             lambda: np.flip(self.to_mesh(np.arange(len(self))), axis).ravel(order='F'))
+
+    def transposition_indices(self, axis_a, axis_b):
+        """
+        Obtain indices of the points with coordinates by two axes swapped for every grid point
+
+        :param axis_a: Index of the first axis
+        :param axis_b: Index of the second axis
+        :return: Array of indices
+        """
+        if not (0 <= axis_a < self.dimensions() and 0 <= axis_b < self.dimensions()):
+            raise IndexError('Point has no axis #{}'.format(max(axis_a, axis_b)))
+        if self.sizes[axis_a] != self.sizes[axis_b]:
+            raise ValueError('Axes of different sizes cannot be transposed')
+        return self.__cached(('transposition', axis_a, axis_b), lambda: np.swapaxes(
+            self.to_mesh(np.arange(len(self))), axis_a, axis_b).ravel(order='F'))
+
+    def interior_mask(self, axes=None):
+        """
+        Obtain a mask of the points that do not lie on the grid bounds
+
+        :param axes: Indices of axes to check bounds of, all axes if not specified
+        :return: Boolean array ordered by point indices
+        """
+        axes = tuple(range(self.dimensions()) if axes is None else sorted(axes))
+
+        def factory():
+            mask = np.ones(self.sizes, dtype=bool)
+            for dim in axes:
+                index = [slice(None)] * self.dimensions()
+                index[dim] = [0, self.sizes[dim] - 1]
+                mask[tuple(index)] = False
+            return mask.ravel(order='F')
+
+        return self.__cached(('interior', axes), factory)
 
     def __getitem__(self, item):
         """
@@ -141,3 +319,84 @@ class Grid:
         :return: Dimension count
         """
         return len(self.sizes)
+
+
+class NonUniformGrid(Grid):
+    """
+    Represents a multi-dimensional grid with arbitrary ascending coordinates by every axis.
+
+    Operators on non-uniform axes act on wave function values multiplied by square roots of cell volumes
+    (see cell_volumes), so they stay Hermitian and wave functions are normalized as usual.
+    Axes with equally spaced coordinates behave exactly as the axes of Grid.
+    """
+
+    def __init__(self, coordinates):
+        """
+        :param coordinates: List of strictly ascending coordinate arrays, one for every axis, see sinh_coordinates
+          and log_coordinates
+        """
+        coordinates = [np.array(c, dtype=float) for c in coordinates]
+        for c in coordinates:
+            if c.ndim != 1 or len(c) < 2:
+                raise ValueError('Coordinates must be a one-dimensional array with at least 2 points')
+            if np.any(np.diff(c) <= 0):
+                raise ValueError('Coordinates must be strictly ascending')
+            c.flags.writeable = False
+        self.coordinates = coordinates
+        self.uniform = [bool(np.allclose(np.diff(c), (c[-1] - c[0]) / (len(c) - 1), rtol=1E-12, atol=0))
+                        for c in coordinates]
+        super(NonUniformGrid, self).__init__([(c[0], c[-1]) for c in coordinates], [len(c) for c in coordinates])
+
+    def grid_step(self, axis):
+        if not self.uniform[axis]:
+            raise ValueError('Axis #{} is not uniform'.format(axis))
+        return super(NonUniformGrid, self).grid_step(axis)
+
+    def is_uniform(self, axis=None):
+        return all(self.uniform) if axis is None else self.uniform[axis]
+
+    def axis_coordinates(self, axis):
+        return self.coordinates[axis]
+
+    def point_to_absolute(self, point):
+        if len(point) != len(self.sizes):
+            raise ValueError('Point dimension does not match grid dimension')
+        return [float(self.coordinates[dim][point[dim]]) for dim in range(self.dimensions())]
+
+    def point_from_absolute(self, point):
+        if len(point) != len(self.sizes):
+            raise ValueError('Point dimension does not match grid dimension')
+        return [int(np.searchsorted(self.coordinates[dim], point[dim], side='right')) - 1
+                for dim in range(self.dimensions())]
+
+
+def sinh_coordinates(a, b, size, center=0., scale=1.):
+    """
+    Generates coordinates from a to b clustered around the center: x = center + scale * sinh(s) for equally spaced s.
+
+    :param a: Lower bound
+    :param b: Upper bound
+    :param size: Number of points
+    :param center: Coordinate to cluster points around
+    :param scale: Length the spacing grows over, smaller values cluster points more densely
+    :return: Array of coordinates
+    """
+    s = np.linspace(np.arcsinh((a - center) / scale), np.arcsinh((b - center) / scale), size)
+    coordinates = center + scale * np.sinh(s)
+    coordinates[[0, -1]] = a, b
+    return coordinates
+
+
+def log_coordinates(a, b, size, scale=1.):
+    """
+    Generates coordinates from a to b clustered near a: x = a + scale * (exp(s) - 1) for equally spaced s.
+
+    :param a: Lower bound
+    :param b: Upper bound
+    :param size: Number of points
+    :param scale: Length the spacing grows over, smaller values cluster points more densely
+    :return: Array of coordinates
+    """
+    coordinates = a + scale * np.expm1(np.linspace(0, np.log1p((b - a) / scale), size))
+    coordinates[[0, -1]] = a, b
+    return coordinates
@@ -0,0 +1,273 @@
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# File to write spans to as JSON lines from the start, instrumentation is disabled if not set
+FILE_VARIABLE = 'INSTRUMENTATION_FILE'
+
+
+def peak_rss():
+    """
+    :return: Peak resident set size of the process in bytes, None if it is unknown on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def matrix_attributes(mat):
+    """
+    :param mat: Dense array, scipy sparse matrix or scipy LinearOperator
+    :return: Dictionary with the shape, the number of stored elements and the storage format of a matrix
+    """
+    nnz = getattr(mat, 'nnz', None)
+    if nnz is None and hasattr(mat, 'size') and not callable(mat.size):
+        nnz = int(mat.size)
+    return {'shape': [int(size) for size in mat.shape], 'nnz': nnz,
+            'storage': getattr(mat, 'format', None) or type(mat).__name__}
+
+
+class MemorySink:
+    """
+    Collects span records in a list.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def find(self, name):
+        """
+        :return: List of records of the spans with given name
+        """
+        return [record for record in self.records if record['name'] == name]
+
+    def clear(self):
+        self.records = []
+
+
+class JsonLinesSink:
+    """
+    Writes span records to a file, one JSON object per line.
+    """
+
+    def __init__(self, filename, append=True):
+        """
+        :param filename: File to write records to
+        :param append: False to overwrite the file
+        """
+        self.filename = filename
+        self.file = open(filename, 'a' if append else 'w')
+
+    def emit(self, record):
+        self.file.write(json.dumps(record, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Span:
+    """
+    A named interval of work. Records wall and CPU time, the peak resident set size and attributes,
+    and sends the record to all sinks when the interval ends. Spans opened inside another span are its children.
+    """
+
+    __ids = itertools.count(1)
+
+    def __init__(self, name, parent=None, **attributes):
+        """
+        :param name: Span name, like 'eigensolve'
+        :param parent: Span to attach to, the innermost open span of the current thread if not specified
+        :param attributes: Attributes to record, like matrix sizes
+        """
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.id = next(Span.__ids)
+        self.__start = None
+
+    def set(self, **attributes):
+        """
+        Adds attributes to the record, like solver iteration counts known only at the end.
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _stack()
+        if self.parent is None and stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        self.__start = time.time(), time.perf_counter(), time.process_time(), peak_rss()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall, cpu, rss = time.perf_counter(), time.process_time(), peak_rss()
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        start, start_wall, start_cpu, start_rss = self.__start
+        record = {
+            'name': self.name,
+            'path': self.path(),
+            'id': self.id,
+            'parent': self.parent.id if self.parent is not None else None,
+            'thread': threading.current_thread().name,
+            'start': start,
+            'wall': wall - start_wall,
+            'cpu': cpu - start_cpu,
+            'peak_rss': rss,
+            'rss_growth': rss - start_rss if rss is not None and start_rss is not None else None,
+            'attributes': self.attributes
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        _emit(record)
+        return False
+
+    def path(self):
+        """
+        :return: Names of the span and its ancestors joined by slashes, outermost first
+        """
+        return self.name if self.parent is None else self.parent.path() + '/' + self.name
+
+
+class NullSpan:
+    """
+    Span used while instrumentation is disabled, does nothing.
+    """
+
+    id = None
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+_sinks = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _emit(record):
+    with _lock:
+        for sink in _sinks:
+            sink.emit(record)
+
+
+def enabled():
+    """
+    :return: True if there is a sink to send spans to
+    """
+    return bool(_sinks)
+
+
+def span(name, parent=None, **attributes):
+    """
+    Opens a span to use in a with statement. Returns a shared span that does nothing while instrumentation is disabled.
+
+    :param name: Span name
+    :param parent: Span to attach to, useful for work done in other threads
+    :param attributes: Attributes to record
+    :return: Span object
+    """
+    if not _sinks:
+        return NULL_SPAN
+    return Span(name, parent if parent is not NULL_SPAN else None, **attributes)
+
+
+def traced(name, **attributes):
+    """
+    Decorator that runs a function inside a span. The function may add attributes with current_span().set.
+
+    :param name: Span name
+    :param attributes: Attributes to record
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            with Span(name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_span():
+    """
+    :return: The innermost open span of the current thread, NULL_SPAN if there is none
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else NULL_SPAN
+
+
+def add_sink(sink):
+    """
+    Enables instrumentation, spans are sent to the sink.
+
+    :param sink: Object with the emit method that accepts a record dictionary, like MemorySink or JsonLinesSink
+    """
+    with _lock:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """
+    Stops sending spans to the sink, instrumentation is disabled when no sinks are left.
+    """
+    with _lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+class instrumented:
+    """
+    Context manager that sends spans to given sinks inside a with statement.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def __enter__(self):
+        for sink in self.sinks:
+            add_sink(sink)
+        return self.sinks[0] if len(self.sinks) == 1 else self.sinks
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for sink in self.sinks:
+            remove_sink(sink)
+        return False
+
+
+if os.environ.get(FILE_VARIABLE):
+    add_sink(JsonLinesSink(os.environ[FILE_VARIABLE]))
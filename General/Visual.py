@@ -67,19 +67,17 @@ class FunctionVisualizer(Visualizer):
 
     def __init__(self, grid):
         self.grid = grid
-        coords = [np.array(self.grid.mesh()) for _ in range(self.grid.dimensions())]
-        for point in self.grid:
-            for i in range(self.grid.dimensions()):
-                coords[i][point] = self.grid.point_to_absolute(point)[i]
+        coords = [np.array(c) for c in self.grid.mesh_coordinates()]
         super().__init__(coords, [])
 
     def add_fn(self, fn, label="", verbose=True):
-        data = np.array(self.grid.mesh())
+        values = np.zeros(len(self.grid))
         p = ProgressInformer(caption=f'Populating graph for function {label}', max=len(self.grid), verbose=verbose)
-        for point in self.grid:
-            data[point] = fn(self.grid.point_to_absolute(point))
+        for i, x in enumerate(self.grid.coordinate_columns().transpose()):
+            values[i] = fn(list(x))
             p.report_increment()
         p.finish()
+        data = self.grid.to_mesh(values)
         if label != "":
             self.has_legend = True
         self.datas.append((data, label))
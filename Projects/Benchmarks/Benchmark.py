@@ -0,0 +1,165 @@
+import contextlib
+import datetime
+import gc
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+
+class Benchmark:
+    """
+    A timed operation with fixed parameters. Preparation is excluded from timing.
+    """
+
+    def __init__(self, name, run, setup=None, **params):
+        """
+        :param name: Benchmark name, like 'eigensolve'
+        :param run: Function that performs the operation, accepts the setup result if setup is given
+        :param setup: Function that prepares data for the operation, called before every run
+        :param params: Parameters to identify the benchmark in results, like dimensions or size
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.params = params
+
+    def key(self):
+        """
+        :return: String that identifies the benchmark in results of different runs
+        """
+        return self.name + ''.join('[{}={}]'.format(name, self.params[name]) for name in sorted(self.params))
+
+    def measure(self, repeat=3, memory=True):
+        """
+        Runs the operation several times, measures wall time of every run and the peak of memory
+        allocated by Python and NumPy during an additional run.
+
+        :param repeat: Number of timed runs
+        :param memory: False to skip the memory profiling run
+        :return: Dictionary with the results
+        """
+        times = []
+        for _ in range(repeat):
+            data = self.__prepare()
+            start = time.perf_counter()
+            self.__call(data)
+            times.append(time.perf_counter() - start)
+        result = {'name': self.name, 'params': self.params, 'times': times,
+                  'median': statistics.median(times), 'min': min(times), 'peak_memory': None}
+        if memory:
+            data = self.__prepare()
+            tracemalloc.start()
+            try:
+                self.__call(data)
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        return result
+
+    def __prepare(self):
+        data = None
+        if self.setup is not None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = self.setup()
+        gc.collect()
+        return data
+
+    def __call(self, data):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if self.setup is not None:
+                self.run(data)
+            else:
+                self.run()
+
+
+def environment():
+    """
+    :return: Dictionary that describes the machine and library versions
+    """
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine()
+    }
+
+
+def run_benchmarks(benchmarks, repeat=3, memory=True, pattern=None, verbose=True):
+    """
+    Measures benchmarks one by one.
+
+    :param benchmarks: List of Benchmark objects
+    :param repeat: Number of timed runs of every benchmark
+    :param memory: False to skip memory profiling
+    :param pattern: Substring of benchmark keys to run, all benchmarks if not specified
+    :param verbose: False to hide results as they come
+    :return: Dictionary with environment data and the list of results
+    """
+    results = []
+    for benchmark in benchmarks:
+        key = benchmark.key()
+        if pattern is not None and pattern not in key:
+            continue
+        result = benchmark.measure(repeat, memory)
+        result['key'] = key
+        results.append(result)
+        if verbose:
+            print('{:<60} {:>10.4f} s {:>12}'.format(key, result['median'], format_memory(result['peak_memory'])))
+    return {'environment': environment(), 'repeat': repeat, 'results': results}
+
+
+def format_memory(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GB'.format(size)
+
+
+def dump_results(results, filename):
+    with open(filename, 'w') as results_writer:
+        json.dump(results, results_writer, indent=2)
+
+
+def load_results(filename):
+    with open(filename) as results_reader:
+        return json.load(results_reader)
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    Compares median times of benchmarks present in both runs.
+
+    :param baseline: Results dictionary of the reference run, see run_benchmarks
+    :param current: Results dictionary of the run to check
+    :param threshold: Relative change of the median time considered significant
+    :return: List of dictionaries with the key, both medians, their ratio and status:
+      'slower', 'faster' or 'same'
+    """
+    baseline_results = {result['key']: result for result in baseline['results']}
+    comparison = []
+    for result in current['results']:
+        reference = baseline_results.get(result['key'])
+        if reference is None:
+            continue
+        ratio = result['median'] / reference['median'] if reference['median'] > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        else:
+            status = 'same'
+        comparison.append({'key': result['key'], 'baseline': reference['median'], 'current': result['median'],
+                           'ratio': ratio, 'status': status})
+    return comparison
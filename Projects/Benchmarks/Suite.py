@@ -0,0 +1,182 @@
+import os
+import tempfile
+
+import numpy as np
+
+from General.Grid import Grid
+from Projects.Benchmarks.Benchmark import Benchmark
+from Projects.CauchyTaskModel.CauchyProblem import CauchyProblem, DependentVariable
+from Projects.CauchyTaskModel.Solver import SimpleSolver, RungeKuttaSolver
+from Projects.ChernInsulator.Lattice import rect, generate_h_mat, current
+from Projects.LinearAlgebraModel.Model.BaseOperators import get_laplace_operator_mat
+from Projects.LinearAlgebraModel.Model.Equation import SchrodingerSolution
+from Projects.LinearAlgebraModel.Model.Spectrum import Spectrum
+from Projects.LinearAlgebraModel.Operators.Hamiltonian import Harmonic
+from Projects.LinearAlgebraModel.Operators.Measurement import TorqueSquaredOperator
+
+try:
+    from General.Visual import FunctionVisualizer
+except ImportError:
+    FunctionVisualizer = None
+
+# Grid sizes by every axis, for every number of dimensions
+GRID_ITERATION_SIZES = {1: (1000, 10000), 2: (32, 100), 3: (10, 20)}
+ASSEMBLY_SIZES = {1: (10000, 100000), 2: (64, 128, 256), 3: (16, 32, 48)}
+EIGENSOLVE_SIZES = {1: (500, 5000), 2: (32, 64, 128), 3: (12, 20)}
+SPECTRUM_SIZES = {3: (12, 20, 28)}
+IO_SIZES = {2: (32, 64), 3: (12, 20)}
+VISUALIZER_SIZES = {2: (32, 64)}
+EVOLVE_STEPS = (1000, 10000)
+CHERN_SIZES = (10, 20, 30)
+N_STATES = 10
+
+
+def cube_grid(dimensions, size, r=5.):
+    """
+    :return: Grid with equal bounds and sizes by all axes, shifted so its center is not a grid point
+    """
+    step = 2 * r / (size - 1)
+    return Grid([(-r + step / 3, r + step / 3)] * dimensions, [size] * dimensions)
+
+
+def solve_harmonic(grid: Grid):
+    hamiltonian = Harmonic(grid, 1, 1, cache=False)
+    return hamiltonian, SchrodingerSolution(hamiltonian=hamiltonian, grid=grid, n_states=N_STATES, cache=False)
+
+
+def oscillator_problem():
+    problem = CauchyProblem()
+    problem.add_dependent_variable(DependentVariable('x', lambda t, dvars: dvars['v']))
+    problem.add_dependent_variable(DependentVariable('v', lambda t, dvars: -dvars['x']))
+    problem.set_state(0., {'x': 1., 'v': 0.})
+    return problem
+
+
+def ladder(sizes):
+    return [(dimensions, size) for dimensions in sorted(sizes) for size in sizes[dimensions]]
+
+
+def grid_benchmarks():
+    benchmarks = []
+    for dimensions, size in ladder(GRID_ITERATION_SIZES):
+        def iterate(grid):
+            for _ in grid:
+                pass
+
+        benchmarks.append(Benchmark('grid_iteration', iterate, lambda d=dimensions, s=size: cube_grid(d, s),
+                                    dimensions=dimensions, size=size))
+    return benchmarks
+
+
+def assembly_benchmarks():
+    benchmarks = []
+    for dimensions, size in ladder(ASSEMBLY_SIZES):
+        setup = (lambda d=dimensions, s=size: cube_grid(d, s))
+        benchmarks.append(Benchmark('laplace_mat', lambda grid: get_laplace_operator_mat(grid, sparse=True), setup,
+                                    dimensions=dimensions, size=size))
+        benchmarks.append(Benchmark('hamiltonian', lambda grid: Harmonic(grid, 1, 1, cache=False), setup,
+                                    dimensions=dimensions, size=size))
+    return benchmarks
+
+
+def eigensolve_benchmarks():
+    benchmarks = []
+    for dimensions, size in ladder(EIGENSOLVE_SIZES):
+        def setup(d=dimensions, s=size):
+            grid = cube_grid(d, s)
+            return grid, Harmonic(grid, 1, 1, cache=False)
+
+        def solve(data):
+            grid, hamiltonian = data
+            SchrodingerSolution(hamiltonian=hamiltonian, grid=grid, n_states=N_STATES, cache=False)
+
+        benchmarks.append(Benchmark('eigensolve', solve, setup, dimensions=dimensions, size=size, n_states=N_STATES))
+    return benchmarks
+
+
+def spectrum_benchmarks():
+    benchmarks = []
+    for dimensions, size in ladder(SPECTRUM_SIZES):
+        def evaluate(data):
+            hamiltonian, sol = data
+            Spectrum(solution=sol, operators=[hamiltonian, TorqueSquaredOperator(sol.grid, cache=False)], cache=False)
+
+        benchmarks.append(Benchmark('spectrum', evaluate, lambda d=dimensions, s=size: solve_harmonic(cube_grid(d, s)),
+                                    dimensions=dimensions, size=size, n_states=N_STATES))
+    return benchmarks
+
+
+def io_benchmarks(directory):
+    benchmarks = []
+    for dimensions, size in ladder(IO_SIZES):
+        filename = os.path.join(directory, 'solution_{}_{}.csv'.format(dimensions, size))
+
+        def dumped(d=dimensions, s=size, f=filename):
+            sol = solve_harmonic(cube_grid(d, s))[1]
+            sol.dump(f)
+            return f
+
+        benchmarks.append(Benchmark('csv_dump', lambda data, f=filename: data[1].dump(f),
+                                    lambda d=dimensions, s=size: solve_harmonic(cube_grid(d, s)),
+                                    dimensions=dimensions, size=size, n_states=N_STATES))
+        benchmarks.append(Benchmark('csv_load', lambda f: SchrodingerSolution(filename=f), dumped,
+                                    dimensions=dimensions, size=size, n_states=N_STATES))
+    return benchmarks
+
+
+def visualizer_benchmarks():
+    if FunctionVisualizer is None:
+        return []
+    benchmarks = []
+    for dimensions, size in ladder(VISUALIZER_SIZES):
+        def add_fn(grid):
+            FunctionVisualizer(grid).add_fn(lambda x: np.exp(-sum(t ** 2 for t in x)), 'gauss')
+
+        benchmarks.append(Benchmark('visualizer_add_fn', add_fn, lambda d=dimensions, s=size: cube_grid(d, s),
+                                    dimensions=dimensions, size=size))
+    return benchmarks
+
+
+def evolve_benchmarks():
+    benchmarks = []
+    for solver_class in (SimpleSolver, RungeKuttaSolver):
+        for steps in EVOLVE_STEPS:
+            benchmarks.append(Benchmark('evolve', lambda solver, n=steps: solver.evolve(10., 10. / n),
+                                        lambda c=solver_class: c(oscillator_problem()),
+                                        solver=solver_class.__name__, steps=steps))
+    return benchmarks
+
+
+def chern_benchmarks():
+    benchmarks = []
+    for size in CHERN_SIZES:
+        benchmarks.append(Benchmark('chern_h_mat', lambda grid: generate_h_mat(grid, 5),
+                                    lambda s=size: rect(s, s), size=size))
+
+        def eigenstates(s=size):
+            grid = rect(s, s)
+            vectors = np.linalg.eigh(generate_h_mat(grid, 5))[1]
+            return grid, vectors[:, :2].transpose()
+
+        def currents(data):
+            grid, states = data
+            for point in grid:
+                current(grid, states, point, 0)
+                current(grid, states, point, 1)
+
+        benchmarks.append(Benchmark('chern_current', currents, eigenstates, size=size))
+    return benchmarks
+
+
+def default_suite(directory=None):
+    """
+    Lists benchmarks of the main paths across ladders of grid sizes and dimensions.
+    Benchmarks that need optional packages which are not installed are left out.
+
+    :param directory: Directory for files written by I/O benchmarks, a temporary one if not specified
+    :return: List of Benchmark objects
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='benchmarks_')
+    return grid_benchmarks() + assembly_benchmarks() + eigensolve_benchmarks() + spectrum_benchmarks() + \
+        io_benchmarks(directory) + visualizer_benchmarks() + evolve_benchmarks() + chern_benchmarks()
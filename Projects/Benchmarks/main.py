@@ -0,0 +1,34 @@
+#!/usr/bin/python
+import argparse
+import sys
+
+from Projects.Benchmarks.Benchmark import run_benchmarks, dump_results, load_results, compare_results
+from Projects.Benchmarks.Suite import default_suite
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the main computational paths')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run benchmarks and write results to a JSON file')
+    run_parser.add_argument('output', help='JSON file to write results to')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of every benchmark')
+    run_parser.add_argument('--filter', default=None, help='Substring of benchmark keys to run')
+    run_parser.add_argument('--no-memory', action='store_true', help='Skip memory profiling')
+    compare_parser = subparsers.add_parser('compare', help='Compare results of two runs')
+    compare_parser.add_argument('baseline', help='JSON file with reference results')
+    compare_parser.add_argument('current', help='JSON file with results to check')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Relative slowdown of the median time to flag')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(default_suite(), args.repeat, not args.no_memory, args.filter)
+        dump_results(results, args.output)
+    else:
+        comparison = compare_results(load_results(args.baseline), load_results(args.current), args.threshold)
+        for row in comparison:
+            status = row['status'].upper() if row['status'] == 'slower' else row['status']
+            print('{:<60} {:>10.4f} s {:>10.4f} s {:>7.2f}x {}'.format(
+                row['key'], row['baseline'], row['current'], row['ratio'], status))
+        slower = [row for row in comparison if row['status'] == 'slower']
+        print('{} of {} benchmarks slower'.format(len(slower), len(comparison)))
+        sys.exit(1 if slower else 0)
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from math import isnan
 
+from General.Instrumentation import current_span, traced
 from General.Utils import ProgressInformer
 from Projects.CauchyTaskModel.CauchyProblem import CauchyProblem
 
@@ -16,6 +17,7 @@ class Solver(ABC):
     def set_condition(self, initial_t, dependent_vars):
         self.problem.set_state(initial_t, dependent_vars)
 
+    @traced('evolve')
     def evolve(self, target, step, verbose=False):
         if step <= 0:
             raise ValueError('Step must be strictly positive')
@@ -44,6 +46,7 @@ class Solver(ABC):
         self.problem.set_state(initial_t, dependent_vars)
         if verbose:
             p.finish()
+        current_span().set(solver=type(self).__name__, steps=len(t_arr) - 1, variables=len(dvars))
         return t_arr, dvars
 
     def evolve_iterative(self, target_t, point_tolerance):
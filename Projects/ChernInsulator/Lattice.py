@@ -0,0 +1,42 @@
+import numpy as np
+
+from General.Grid import Grid
+from General.Utils import ProgressInformer
+from Projects.ChernInsulator.consts import pauli_mats, sx, sy, sz, z
+
+
+def rect(w, h):
+    return Grid([[0, w - 1], [0, h - 1]], [w, h])
+
+
+def generate_h_mat(grid: Grid, m):
+    mat = np.zeros((len(grid) * 2,) * 2, dtype='complex64')
+    p = ProgressInformer(caption='Generating matrix...', max=len(grid))
+    for pt in grid:
+        i = grid.index(pt) * 2
+        mat[i:i + 2, i:i + 2] = m * sz
+        if pt[0] != grid.sizes[0] - 1:
+            i_dx = grid.index(grid.shift_point(pt, 0, 1)) * 2
+            mat[i:i + 2, i_dx:i_dx + 2] = 0.5 * (sz - 1j * sx)
+            mat[i_dx:i_dx + 2, i:i + 2] = 0.5 * (sz + 1j * sx)
+        if pt[1] != grid.sizes[1] - 1:
+            i_dy = grid.index(grid.shift_point(pt, 1, 1)) * 2
+            mat[i:i + 2, i_dy:i_dy + 2] = 0.5 * (sz - 1j * sy)
+            mat[i_dy:i_dy + 2, i:i + 2] = 0.5 * (sz + 1j * sy)
+        p.report_increment()
+    p.finish()
+    return mat
+
+
+def current(grid, states: np.array, point, axis):
+    if len(states.shape) == 1:
+        states = np.array([states])
+    point = [int(round(a)) for a in point]
+    i = grid.index(point)
+    if point[axis] == grid.sizes[axis] - 1:
+        return 0
+    j = grid.index(grid.shift_point(point, axis, 1))
+    s = pauli_mats[axis]
+    m = np.block([[z, 0.5 * (sz - 1j * s)], [-0.5 * (sz + 1j * s), z]])
+    e = np.concatenate((states.transpose()[2 * i: 2 * i + 2], states.transpose()[2 * j: 2 * j + 2]), 0)
+    return -np.linalg.multi_dot((e.transpose().conjugate(), m, e)).trace().imag / len(states)
@@ -1,13 +1,278 @@
+import numbers
 from abc import abstractmethod
 
 import numpy as np
+import scipy.fft
+from scipy import sparse as sp
+from scipy.sparse import linalg as spla
 
 from General.Grid import Grid
+from General.Instrumentation import current_span, matrix_attributes, traced
+from Projects.LinearAlgebraModel.Model.Cache import cached, key_value, operator_key
 
 H = 1
 
+DENSE = 'dense'
+SPARSE_FORMATS = ('csr', 'csc')
+MATRIX_FREE = 'matrix-free'
 
-def add_first_dif_operator_mat(mat, grid: Grid, axis, loop=False, multiplier=1):
+# Central finite difference coefficients by accuracy order, for offsets 1, 2, ... (and 0 for the second derivative)
+FIRST_DIF_COEFFICIENTS = {
+    2: (1 / 2,),
+    4: (2 / 3, -1 / 12),
+    6: (3 / 4, -3 / 20, 1 / 60),
+    8: (4 / 5, -1 / 5, 4 / 105, -1 / 280)
+}
+SECOND_DIF_COEFFICIENTS = {
+    2: (-2, 1),
+    4: (-5 / 2, 4 / 3, -1 / 12),
+    6: (-49 / 18, 3 / 2, -3 / 20, 1 / 90),
+    8: (-205 / 72, 8 / 5, -1 / 5, 8 / 315, -1 / 560)
+}
+
+
+def convert_operator_mat(mat, storage):
+    """
+    Converts operator matrix to given storage format.
+
+    :param mat: Dense array or sparse matrix
+    :param storage: 'dense' or any of SPARSE_FORMATS
+    :return: Converted matrix
+    """
+    if storage == DENSE:
+        return mat.toarray() if sp.issparse(mat) else np.asarray(mat)
+    if storage not in SPARSE_FORMATS:
+        raise ValueError('Unknown storage format {}'.format(storage))
+    return sp.csr_array(mat).asformat(storage)
+
+
+def is_hermitian_mat(mat, tol=1E-12):
+    """
+    Checks if a matrix is Hermitian up to the tolerance given.
+
+    :param mat: Dense array or sparse matrix
+    :param tol: Tolerance relative to the largest matrix element
+    :return: True if matrix is Hermitian, False otherwise
+    """
+    if mat.shape[0] != mat.shape[1]:
+        return False
+    diff = abs(mat - mat.conj().transpose())
+    if sp.issparse(diff) and diff.nnz == 0:
+        return True
+    return diff.max() <= tol * abs(mat).max()
+
+
+def is_scalar(value):
+    """
+    :return: True if value is a number that operators can be multiplied by
+    """
+    return isinstance(value, numbers.Number)
+
+
+def update_array(array, ufunc, operand):
+    """
+    Applies a binary ufunc to an array, in place if the array is writeable and can hold the result.
+
+    :param array: Array to update
+    :param ufunc: Binary numpy ufunc like np.add
+    :param operand: Second operand
+    :return: Updated array, a new one if it could not be updated in place
+    """
+    if array.flags.writeable and np.can_cast(np.result_type(array, operand), array.dtype, 'same_kind'):
+        return ufunc(array, operand, out=array)
+    return ufunc(array, operand)
+
+
+def get_central_stencil(derivative, order=2, step=1, multiplier=1):
+    """
+    Generates a central finite difference stencil.
+
+    :param derivative: 1 for the first derivative, 2 for the second one
+    :param order: Accuracy order, one of 2, 4, 6 and 8
+    :param step: Grid step
+    :param multiplier: Multiplier
+    :return: Tuple of offsets and coefficients
+    """
+    table = {1: FIRST_DIF_COEFFICIENTS, 2: SECOND_DIF_COEFFICIENTS}.get(derivative)
+    if table is None or order not in table:
+        raise ValueError('Unsupported derivative {} of accuracy order {}'.format(derivative, order))
+    scale = 1 / step ** derivative * multiplier
+    offsets, coefficients = [], []
+    if derivative == 2:
+        offsets.append(0)
+        coefficients.append(table[order][0] * scale)
+    for offset, coefficient in enumerate(table[order][derivative - 1:], start=1):
+        offsets += [-offset, offset]
+        coefficients += [(-1) ** derivative * coefficient * scale, coefficient * scale]
+    return tuple(offsets), tuple(coefficients)
+
+
+def get_nonuniform_stencil(grid: Grid, axis, derivative, multiplier=1):
+    """
+    Generates a second order finite difference stencil along a non-uniform axis.
+
+    Coefficients are arrays with an element for every point on the axis. The derivative matrix D
+    is symmetrized as W^(1/2) D W^(-1/2) with the diagonal matrix W of cell widths, see Grid.axis_widths,
+    so the second derivative is symmetric and the first one is antisymmetric.
+
+    :param grid: Grid object
+    :param axis: Axis index
+    :param derivative: 1 for the first derivative, 2 for the second one
+    :param multiplier: Multiplier
+    :return: Tuple of offsets and coefficient arrays
+    """
+    if derivative not in (1, 2):
+        raise ValueError('Unsupported derivative {} on a non-uniform axis'.format(derivative))
+    steps = np.diff(grid.axis_coordinates(axis))
+    scale = 1 / np.sqrt(grid.axis_widths(axis))
+    lower, upper = np.zeros(len(scale)), np.zeros(len(scale))
+    if derivative == 1:
+        lower[1:] = -0.5 * scale[1:] * scale[:-1]
+        upper[:-1] = 0.5 * scale[:-1] * scale[1:]
+        return (-1, 1), (multiplier * lower, multiplier * upper)
+    lower[1:] = scale[1:] * scale[:-1] / steps
+    upper[:-1] = scale[:-1] * scale[1:] / steps
+    center = np.zeros(len(scale))
+    center[1:-1] = -(1 / steps[:-1] + 1 / steps[1:]) * scale[1:-1] ** 2
+    return (0, -1, 1), (multiplier * center, multiplier * lower, multiplier * upper)
+
+
+def get_axis_stencil(grid: Grid, axis, derivative, order=2, multiplier=1, loop=False):
+    """
+    Generates a central finite difference stencil along given axis,
+    see get_central_stencil for uniform axes and get_nonuniform_stencil for non-uniform ones.
+
+    :return: Tuple of offsets and coefficients
+    """
+    if grid.is_uniform(axis):
+        return get_central_stencil(derivative, order, grid.grid_step(axis), multiplier)
+    if loop:
+        raise ValueError('Non-uniform axis #{} cannot be looped'.format(axis))
+    if order != 2:
+        raise ValueError('Only second order stencils are supported on non-uniform axes')
+    return get_nonuniform_stencil(grid, axis, derivative, multiplier)
+
+
+def get_stencil_mat_1d(size, offsets, coefficients, loop=False):
+    """
+    Generates a single-dimensional finite difference matrix for given stencil.
+
+    Rows of the boundary points are left empty unless the coordinate is looped,
+    just like points_inside does for the whole grid. Neighbours beyond the bounds
+    are dropped, as the wave function vanishes there.
+
+    :param size: Point count on the axis
+    :param offsets: Stencil offsets
+    :param coefficients: Stencil coefficients corresponding to the offsets, either numbers
+      or arrays with a coefficient for every row
+    :param loop: True if coordinate is looped (like phi in polar coordinates)
+    :return: Sparse matrix in COO format
+    """
+    rows = np.arange(size) if loop else np.arange(1, size - 1)
+    if len(rows) == 0:
+        return sp.coo_array((size, size))
+    all_rows, all_cols, data = [], [], []
+    for offset, coefficient in zip(offsets, coefficients):
+        cols = rows + offset
+        inside = np.ones(len(rows), dtype=bool) if loop else (cols >= 0) & (cols < size)
+        all_rows.append(rows[inside])
+        all_cols.append(cols[inside] % size)
+        data.append(np.asarray(coefficient)[rows[inside]] if np.ndim(coefficient) else
+                    np.full(np.count_nonzero(inside), coefficient))
+    return sp.coo_array((np.concatenate(data), (np.concatenate(all_rows), np.concatenate(all_cols))),
+                        shape=(size, size))
+
+
+def get_axis_operator_mat(grid: Grid, axis, stencil_mat, loop=False, projected=None):
+    """
+    Composes a multi-dimensional operator acting along one axis from its single-dimensional matrix.
+
+    The operator is assembled as a Kronecker product of the stencil matrix with the
+    identities (or interior projectors if the coordinate is not looped) of other axes.
+
+    :param grid: Grid object
+    :param axis: Axis index
+    :param stencil_mat: Single-dimensional operator matrix for the axis
+    :param loop: True if coordinate is looped (like phi in polar coordinates)
+    :param projected: List with a flag for every axis, True to project on the interior of the axis,
+      for operators with both looped and bounded axes. All other axes are projected unless loop is True by default
+    :return: Sparse matrix in CSR format
+    """
+    if projected is None:
+        projected = [not loop] * grid.dimensions()
+    mat = sp.identity(1, format='csr')
+    for dim in reversed(range(grid.dimensions())):
+        if dim == axis:
+            factor = stencil_mat
+        elif not projected[dim]:
+            factor = sp.identity(grid.sizes[dim], format='csr')
+        else:
+            interior = np.zeros(grid.sizes[dim])
+            interior[1:-1] = 1
+            factor = sp.diags_array(interior)
+        mat = sp.kron(mat, factor, format='csr')
+    return sp.csr_array(mat)
+
+
+def first_dif_operator_csr(grid: Grid, axis, loop=False, multiplier=1, order=2):
+    """
+    Generates a sparse matrix for the first derivative operator in given grid for given axis.
+
+    :param grid: Grid object
+    :param axis: Axis index
+    :param loop: True if coordinate is looped (like phi in polar coordinates)
+    :param multiplier: Multiplier
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
+    :return: Sparse matrix in CSR format
+    """
+    size = grid.sizes[axis]
+    if loop or size > 2:
+        offsets, coefficients = get_axis_stencil(grid, axis, 1, order, multiplier, loop)
+        stencil = get_stencil_mat_1d(size, offsets, coefficients, loop)
+    else:
+        stencil = sp.coo_array((size, size))
+    return get_axis_operator_mat(grid, axis, stencil, loop)
+
+
+def second_dif_operator_csr(grid: Grid, axis, loop=False, multiplier=1, order=2, projected=None):
+    """
+    Generates a sparse matrix for the second derivative operator in given grid for given axis.
+
+    :param grid: Grid object
+    :param axis: Axis index
+    :param loop: True if coordinate is looped (like phi in polar coordinates)
+    :param multiplier: Multiplier
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
+    :param projected: See get_axis_operator_mat
+    :return: Sparse matrix in CSR format
+    """
+    size = grid.sizes[axis]
+    if loop or size > 2:
+        offsets, coefficients = get_axis_stencil(grid, axis, 2, order, multiplier, loop)
+        stencil = get_stencil_mat_1d(size, offsets, coefficients, loop)
+    else:
+        stencil = sp.coo_array((size, size))
+    return get_axis_operator_mat(grid, axis, stencil, loop, projected)
+
+
+def add_operator_mat(mat, addition):
+    """
+    Adds a sparse operator matrix to the given one.
+
+    Dense arrays are updated in place, sparse matrices are replaced by the sum.
+
+    :param mat: Initial matrix
+    :param addition: Sparse matrix to add
+    :return: Resulting matrix
+    """
+    if sp.issparse(mat):
+        return sp.csr_array(mat + addition)
+    addition = addition.tocoo()
+    np.add.at(mat, (addition.row, addition.col), addition.data)
+    return mat
+
+
+def add_first_dif_operator_mat(mat, grid: Grid, axis, loop=False, multiplier=1, order=2):
     """
     Generates a matrix for the first derivative operator in given grid for given axis,
     multiplies it by the multiplier given and adds it to given matrix.
@@ -19,32 +284,28 @@ def add_first_dif_operator_mat(mat, grid: Grid, axis, loop=False, multiplier=1):
     :param axis: Axis index
     :param loop: True if coordinate is looped (like phi in polar coordinates)
     :param multiplier: Multiplier
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
+    :return: Resulting matrix
     """
-    d = grid.grid_step(axis)
-    for pt in (grid if loop else grid.points_inside()):
-        pt_idx = grid.index(pt)
-        pt_idx_d = grid.index(grid.shift_point(pt, axis, -1))
-        pt_idx_u = grid.index(grid.shift_point(pt, axis, 1))
-        mat[pt_idx, pt_idx_d] -= 0.5 / d * multiplier
-        mat[pt_idx, pt_idx_u] += 0.5 / d * multiplier
-    return mat
+    return add_operator_mat(mat, first_dif_operator_csr(grid, axis, loop, multiplier, order))
 
 
-def get_first_dif_operator_mat(grid, axis, loop=False):
+def get_first_dif_operator_mat(grid, axis, loop=False, sparse=False, order=2):
     """
-    Generates a matrix for the second derivative operator in given grid for given axis.
+    Generates a matrix for the first derivative operator in given grid for given axis.
 
     :param grid: Grid object
     :param axis: Axis index
     :param loop: True if coordinate is looped (like phi in polar coordinates)
-    :return: Second derivative operator matrix
+    :param sparse: True if the matrix should be stored in CSR format
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
+    :return: First derivative operator matrix
     """
-    mat = np.zeros((len(grid),) * 2)
-    add_first_dif_operator_mat(mat, grid, axis, loop=loop)
-    return mat
+    mat = first_dif_operator_csr(grid, axis, loop, order=order)
+    return mat if sparse else mat.toarray()
 
 
-def add_second_dif_operator_mat(mat, grid, axis, loop=False, multiplier=1):
+def add_second_dif_operator_mat(mat, grid, axis, loop=False, multiplier=1, order=2):
     """
     Generates a matrix for the second derivative operator in given grid for given axis,
     multiplies it by the multiplier given and adds it to given matrix.
@@ -56,126 +317,1274 @@ def add_second_dif_operator_mat(mat, grid, axis, loop=False, multiplier=1):
     :param axis: Axis index
     :param loop: True if coordinate is looped (like phi in polar coordinates)
     :param multiplier: Multiplier
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
+    :return: Resulting matrix
     """
-    d = grid.grid_step(axis)
-    for pt in (grid if loop else grid.points_inside()):
-        pt_idx = grid.index(pt)
-        pt_idx_u = grid.index(grid.shift_point(pt, axis, 1))
-        pt_idx_d = grid.index(grid.shift_point(pt, axis, -1))
-        mat[pt_idx, pt_idx] -= 2 / d ** 2 * multiplier
-        mat[pt_idx, pt_idx_d] += 1 / d ** 2 * multiplier
-        mat[pt_idx, pt_idx_u] += 1 / d ** 2 * multiplier
-    return mat
+    return add_operator_mat(mat, second_dif_operator_csr(grid, axis, loop, multiplier, order))
 
 
-def get_second_dif_operator_mat(grid, axis, loop=False):
+def get_second_dif_operator_mat(grid, axis, loop=False, sparse=False, order=2):
     """
     Generates a matrix for the second derivative operator in given grid for given axis.
 
     :param grid: Grid object
     :param axis: Axis index
     :param loop: True if coordinate is looped (like phi in polar coordinates)
+    :param sparse: True if the matrix should be stored in CSR format
+    :param order: Accuracy order of the central stencil, one of 2, 4, 6 and 8
     :return: Second derivative operator matrix
     """
-    mat = np.zeros((len(grid),) * 2)
-    add_second_dif_operator_mat(mat, grid, axis, loop=loop)
-    return mat
+    mat = second_dif_operator_csr(grid, axis, loop, order=order)
+    return mat if sparse else mat.toarray()
+
 
+def get_scalar_diagonal(grid, function_callback, vectorized=True):
+    """
+    Evaluates a function in all grid points.
 
-def get_scalar_mat(grid, function_callback):
-    mat = np.zeros((len(grid),) * 2)
-    for pt in grid:
-        i = grid.index(pt)
-        mat[i, i] += function_callback(grid.point_to_absolute(pt))
+    :param grid: Grid object
+    :param function_callback: Function that accepts absolute point coordinates.
+      If vectorized, it is called once with a list of coordinate arrays, one for every axis.
+    :param vectorized: False if the function can only be evaluated point by point
+    :return: Array with function values ordered by point indices
+    """
+    if vectorized:
+        return np.broadcast_to(function_callback(list(grid.coordinate_columns())), (len(grid),)).copy()
+    return np.array([function_callback(list(x)) for x in grid.coordinate_columns().transpose()])
+
+
+def add_diagonal_mat(mat, diagonal):
+    """
+    Adds a diagonal matrix to the given one without materializing the diagonal matrix.
+
+    :param mat: Dense array or sparse matrix
+    :param diagonal: Array with diagonal elements
+    :return: Resulting matrix
+    """
+    if sp.issparse(mat):
+        return sp.csr_array(mat + sp.diags_array(diagonal))
+    mat = mat.astype(np.result_type(mat, diagonal))
+    mat[np.diag_indices_from(mat)] += diagonal
     return mat
 
-def get_laplace_operator_mat(grid):
+
+def get_scalar_mat(grid, function_callback, sparse=False, vectorized=True):
+    """
+    Generates a diagonal matrix of the operator that multiplies on a function.
+
+    :param grid: Grid object
+    :param function_callback: Function that accepts absolute point coordinates
+    :param sparse: True if the matrix should be stored in CSR format
+    :param vectorized: False if the function can only be evaluated point by point
+    :return: Scalar operator matrix
+    """
+    diagonal = get_scalar_diagonal(grid, function_callback, vectorized)
+    if sparse:
+        return sp.csr_array(sp.diags_array(diagonal))
+    return np.diagflat(diagonal)
+
+
+def get_laplace_operator_mat(grid, loop=False, sparse=False, order=2):
     """
     Generates a matrix for the Laplace operator in given grid.
 
     :param grid: Grid object
+    :param loop: True if all coordinates are looped, or a list with a flag for every axis.
+      Points on the bounds of axes that are not looped are decoupled
+    :param sparse: True if the matrix should be stored in CSR format
+    :param order: Accuracy order of the central stencils, one of 2, 4, 6 and 8
     :return: Laplace operator matrix
     """
-    mat = np.zeros((len(grid),) * 2)
+    loops = loop if isinstance(loop, (list, tuple)) else [loop] * grid.dimensions()
+    projected = [not looped for looped in loops]
+    mat = sp.csr_array((len(grid),) * 2)
     for dim in range(grid.dimensions()):
-        add_second_dif_operator_mat(mat, grid, dim)
-    return mat
+        mat = mat + second_dif_operator_csr(grid, dim, loops[dim], order=order, projected=projected)
+    return mat if sparse else mat.toarray()
 
 
-def get_laplace_operator_sph_grid(grid):
-    mat = np.zeros((len(grid),) * 2)
-    if grid.dimensions() != 3:
-        raise ValueError("Grid must be three-dimensional")
-    # R, phi, theta
+def get_spectral_second_dif_symbol(grid: Grid, axis):
+    """
+    Generates the Fourier symbol of the second derivative along a looped axis,
+    the period of the coordinate is the axis size times the grid step.
+
+    :param grid: Grid object
+    :param axis: Axis index
+    :return: Array with eigenvalues of the derivative in the order of FFT frequencies
+    """
+    wave_numbers = 2 * np.pi * scipy.fft.fftfreq(grid.sizes[axis], grid.grid_step(axis))
+    return -wave_numbers ** 2
+
+
+def get_spectral_mat_1d(symbol):
+    """
+    Generates a dense circulant matrix of a single-dimensional operator diagonal in Fourier space.
+
+    :param symbol: Array with eigenvalues in the order of FFT frequencies
+    :return: Dense array
+    """
+    mat = scipy.fft.ifft(symbol[:, np.newaxis] * scipy.fft.fft(np.eye(len(symbol)), axis=0), axis=0)
+    return np.real_if_close(mat, tol=1E3)
 
 
 class LinearOperator:
     """
-    Represents an arbitrary operator
+    Represents an arbitrary operator.
+
+    The matrix can be stored either as a dense array or as a CSR/CSC sparse matrix,
+    arithmetic works across both storage formats.
     """
 
-    def __init__(self, grid: Grid, mat: np.array):
+    _modified = False
+    # Number of in-place changes, lets expressions notice changes of their operands
+    _version = 0
+
+    def __init__(self, grid: Grid, mat, storage=None, hermitian=None):
+        """
+        :param grid: Grid object
+        :param mat: Operator matrix, dense array or scipy sparse matrix
+        :param storage: Storage format to convert matrix to, keeps the given one if not specified
+        :param hermitian: True or False if the matrix is known to be Hermitian or not, None to detect when needed
+        """
         self.grid = grid
-        self.mat = mat
-        pass
+        self.mat = mat if storage is None or mat is None else convert_operator_mat(mat, storage)
+        self.hermitian = hermitian
+
+    @property
+    def mat(self):
+        """
+        Operator matrix. Matrix-free operators generate it on first access.
+        """
+        if self._mat is None:
+            self._mat = self._materialize()
+        return self._mat
+
+    @mat.setter
+    def mat(self, value):
+        self._mat = value
+
+    def _materialize(self):
+        """
+        Generates the matrix of a matrix-free operator.
+        """
+        raise NotImplementedError('Operator {} has no matrix'.format(type(self).__name__))
+
+    def is_matrix_free(self):
+        """
+        :return: True if the operator is applied without its matrix
+        """
+        return False
+
+    def storage(self):
+        """
+        :return: 'dense', 'matrix-free' or sparse format name of the operator matrix
+        """
+        if self.is_matrix_free():
+            return MATRIX_FREE
+        return self.mat.format if sp.issparse(self.mat) else DENSE
+
+    def is_sparse(self):
+        return not self.is_matrix_free() and sp.issparse(self.mat)
+
+    def matvec(self, vector):
+        """
+        Applies the operator to a wave function.
+
+        :param vector: Array with wave function values ordered by point indices
+        :return: Resulting array
+        """
+        return self.matmat(np.asarray(vector)[:, np.newaxis])[:, 0]
+
+    def matmat(self, vectors):
+        """
+        Applies the operator to many wave functions at once.
+
+        :param vectors: Matrix with wave function values as columns
+        :return: Resulting matrix
+        """
+        return self.mat @ vectors
+
+    def as_linear_operator(self):
+        """
+        :return: scipy LinearOperator that applies this operator, for use with iterative solvers
+        """
+        return spla.LinearOperator((len(self.grid),) * 2, matvec=self.matvec, matmat=self.matmat,
+                                   dtype=self.dtype())
+
+    def dtype(self):
+        """
+        :return: Data type of the operator matrix elements
+        """
+        return self.mat.dtype
 
-    def __assert_compatibility(self, other):
-        if type(self) != type(other):
+    def to_storage(self, storage):
+        """
+        Creates a copy of the operator with matrix converted to given storage format.
+
+        :param storage: 'dense' or any of SPARSE_FORMATS
+        :return: LinearOperator object
+        """
+        return LinearOperator(self.grid, self.mat, storage, self.hermitian)
+
+    def dense_mat(self):
+        """
+        :return: Operator matrix as a dense array
+        """
+        return convert_operator_mat(self.mat, DENSE)
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        """
+        Checks if the operator is Hermitian, unless it is already known.
+
+        :param tol: Tolerance relative to the largest matrix element
+        :param points: Boolean array to check only the block of the matrix for the points specified
+        :return: True if operator is Hermitian, False otherwise
+        """
+        if self.hermitian is not None:
+            return self.hermitian
+        mat = self.mat
+        if points is not None and not np.all(points):
+            mat = mat[points][:, points] if sp.issparse(mat) else mat[np.ix_(points, points)]
+        return is_hermitian_mat(mat, tol)
+
+    def decoupled_points(self):
+        """
+        Finds points that are not mapped onto other points by the operator,
+        like the bounds of the grid for operators with Dirichlet boundary conditions.
+
+        :return: Boolean array ordered by point indices, True for points whose matrix rows
+          have no nonzero elements off the diagonal
+        """
+        if sp.issparse(self.mat):
+            mat = sp.coo_array(self.mat)
+            off_diagonal = (mat.row != mat.col) & (mat.data != 0)
+            return np.bincount(mat.row[off_diagonal], minlength=len(self.grid)) == 0
+        off_diagonal = self.mat != 0
+        np.fill_diagonal(off_diagonal, False)
+        return ~off_diagonal.any(axis=1)
+
+    def _assert_compatibility(self, other):
+        if not isinstance(other, LinearOperator):
             raise TypeError('Unsupported operand types: {} and {}'.format(type(self), type(other)))
         if self.grid != other.grid:
             raise ValueError('Both operands should have the same grid')
 
+    def parameters(self):
+        """
+        Lists parameters that define the operator together with its type and grid, used as cache key.
+
+        :return: Dictionary with parameter values, None if the operator is not defined by its parameters,
+          like after in-place arithmetic
+        """
+        return None
+
+    def _mark_modified(self):
+        """
+        Records an in-place change of the operator.
+        """
+        self._modified = True
+        self._version += 1
+
+    def _revision(self):
+        """
+        :return: Value that changes with every in-place change of the operator
+        """
+        return self._version
+
+    def adjoint(self):
+        """
+        :return: Lazy Hermitian conjugate of the operator, the operator itself if it is known to be Hermitian
+        """
+        if self.hermitian:
+            return self
+        return AdjointOperator(self)
+
+    def _add_to_mat(self, other, sign=1):
+        """
+        Adds other operator to the stored dense matrix in place, if it can hold the result.
+
+        :return: True if the matrix was updated, False if a new matrix would be needed
+        """
+        mat = self._mat
+        if self.is_matrix_free() or mat is None or sp.issparse(mat) or other.is_matrix_free() \
+                or not np.can_cast(other.dtype(), mat.dtype, 'same_kind'):
+            return False
+        if isinstance(other, DiagonalOperator):
+            mat[np.diag_indices_from(mat)] += sign * other.diagonal
+        elif sp.issparse(other.mat):
+            add_operator_mat(mat, other.mat if sign > 0 else -other.mat)
+        elif sign > 0:
+            np.add(mat, other.mat, out=mat)
+        else:
+            np.subtract(mat, other.mat, out=mat)
+        self.hermitian = True if self.hermitian and other.hermitian else None
+        self._mark_modified()
+        return True
+
+    def _scale_mat(self, factor):
+        """
+        Scales the assembled matrix in place, drops it if it can not hold the result.
+        """
+        if self._mat is not None:
+            if np.can_cast(np.result_type(self._mat, factor), self._mat.dtype, 'same_kind'):
+                self._mat *= factor
+            else:
+                self._mat = None
+        if np.imag(factor) != 0:
+            self.hermitian = None
+        self._mark_modified()
+
     def __add__(self, other):
-        self.__assert_compatibility(other)
-        return LinearOperator(self.grid, self.mat + other.mat)
+        self._assert_compatibility(other)
+        return OperatorSum(self.grid, [(1, self), (1, other)])
 
     def __iadd__(self, other):
-        self.__assert_compatibility(other)
-        self.mat += other.mat
+        self._assert_compatibility(other)
+        return self if self._add_to_mat(other) else self + other
 
     def __sub__(self, other):
-        self.__assert_compatibility(other)
-        return LinearOperator(self.grid, self.mat - other.mat)
+        self._assert_compatibility(other)
+        return OperatorSum(self.grid, [(1, self), (-1, other)])
 
     def __isub__(self, other):
-        self.__assert_compatibility(other)
-        self.mat -= other.mat
+        self._assert_compatibility(other)
+        return self if self._add_to_mat(other, -1) else self - other
+
+    def __neg__(self):
+        return self * -1
 
     def __mul__(self, other):
-        if type(other) in {int, float, complex}:
-            return LinearOperator(self.grid, np.dot(self.mat, other))
-        self.__assert_compatibility(other)
-        return LinearOperator(self.grid, np.dot(self.mat, other.mat))
+        if is_scalar(other):
+            return OperatorSum(self.grid, [(other, self)])
+        self._assert_compatibility(other)
+        return OperatorProduct(self.grid, [self, other])
+
+    def __rmul__(self, other):
+        if is_scalar(other):
+            return self * other
+        return NotImplemented
 
     def __imul__(self, other):
-        self.mat = (other * self).mat
+        if is_scalar(other) and not self.is_matrix_free() and self._mat is not None \
+                and np.can_cast(np.result_type(self._mat, other), self._mat.dtype, 'same_kind'):
+            self._scale_mat(other)
+            return self
+        return self * other
 
 
-class ScalarLinearOperator(LinearOperator):
+class DiagonalOperator(LinearOperator):
+    """
+    Represents an operator with diagonal matrix, only the diagonal is stored.
+    """
+
+    def __init__(self, grid: Grid, diagonal):
+        """
+        :param grid: Grid object
+        :param diagonal: Array with diagonal elements ordered by point indices, copied so that
+          in-place arithmetic does not change it
+        """
+        if len(diagonal) != len(grid):
+            raise ValueError('Diagonal length does not correspond to grid size')
+        self.grid = grid
+        self.diagonal = np.array(diagonal)
+        self.hermitian = None
+
+    @property
+    def mat(self):
+        """
+        Diagonal matrix in CSR format, generated on every access.
+        """
+        return sp.csr_array(sp.diags_array(self.diagonal))
+
+    def dense_mat(self):
+        return np.diagflat(self.diagonal)
+
+    def matmat(self, vectors):
+        return self.diagonal[:, np.newaxis] * vectors
+
+    def dtype(self):
+        return self.diagonal.dtype
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        if self.hermitian is not None:
+            return self.hermitian
+        diagonal = self.diagonal if points is None else self.diagonal[points]
+        return np.all(abs(np.imag(diagonal)) <= tol * abs(diagonal).max())
+
+    def decoupled_points(self):
+        return np.ones(len(self.grid), dtype=bool)
+
+    def adjoint(self):
+        return DiagonalOperator(self.grid, np.conj(self.diagonal))
+
+    def _update_diagonal(self, ufunc, other):
+        """
+        Applies a binary ufunc to the diagonal, in place if the result fits its data type.
+        """
+        self.diagonal = update_array(self.diagonal, ufunc, other)
+        self.hermitian = None
+        self._mark_modified()
+        return self
+
+    def __add__(self, other):
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return DiagonalOperator(self.grid, self.diagonal + other.diagonal)
+        return super().__add__(other)
+
+    def __iadd__(self, other):
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return self._update_diagonal(np.add, other.diagonal)
+        return self + other
+
+    def __sub__(self, other):
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return DiagonalOperator(self.grid, self.diagonal - other.diagonal)
+        return super().__sub__(other)
+
+    def __isub__(self, other):
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return self._update_diagonal(np.subtract, other.diagonal)
+        return self - other
+
+    def __mul__(self, other):
+        if is_scalar(other):
+            return DiagonalOperator(self.grid, self.diagonal * other)
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return DiagonalOperator(self.grid, self.diagonal * other.diagonal)
+        return super().__mul__(other)
+
+    def __imul__(self, other):
+        if is_scalar(other):
+            return self._update_diagonal(np.multiply, other)
+        self._assert_compatibility(other)
+        if isinstance(other, DiagonalOperator):
+            return self._update_diagonal(np.multiply, other.diagonal)
+        return self * other
+
+
+class ScalarLinearOperator(DiagonalOperator):
     """
     Represents an operator that multiplies on a function
     """
 
-    def __init__(self, grid: Grid, function_callback):
-        super().__init__(grid, get_scalar_mat(grid, function_callback))
+    def __init__(self, grid: Grid, function_callback, vectorized=True):
+        """
+        :param grid: Grid object
+        :param function_callback: Function that accepts absolute point coordinates
+        :param vectorized: False if the function can only be evaluated point by point
+        """
+        super().__init__(grid, get_scalar_diagonal(grid, function_callback, vectorized))
+
+
+def apply_operator(operator: LinearOperator, vectors, cache=None):
+    """
+    Applies an operand of an expression to wave functions.
+
+    :param operator: LinearOperator object
+    :param vectors: Matrix with wave function values as columns
+    :param cache: Dictionary with results of operands already applied to the same vectors, keyed by operand id,
+      None if the results should not be reused
+    :return: Resulting matrix
+    """
+    key = id(operator)
+    if cache is not None and key in cache:
+        return cache[key]
+    if isinstance(operator, OperatorExpression) and operator.is_matrix_free():
+        result = operator._evaluate(vectors, cache)
+    else:
+        result = operator.matmat(vectors)
+    if cache is not None:
+        cache[key] = result
+    return result
+
 
+def scale_rows_mat(mat, diagonal):
+    """
+    Multiplies a matrix by a diagonal matrix from the left without materializing the diagonal matrix.
+
+    :param mat: Dense array or sparse matrix
+    :param diagonal: Array with diagonal elements
+    :return: Resulting matrix
+    """
+    if sp.issparse(mat):
+        return sp.csr_array(sp.diags_array(diagonal) @ mat)
+    return diagonal[:, np.newaxis] * mat
+
+
+class OperatorExpression(LinearOperator):
+    """
+    Base class of lazy expressions built by operator arithmetic.
 
-class ParticleHamiltonian(LinearOperator):
+    An expression is applied to wave functions through its operands, its matrix is only assembled
+    on first access. Operands are referenced, not copied, so in-place arithmetic on an operand is
+    reflected by every expression built of it: simplified operand lists and the assembled matrix
+    are rebuilt when any operand has changed since. Direct writes into operand arrays are not tracked.
+    """
+
+    _mat_revision = None
+
+    def __init__(self, grid: Grid):
+        super().__init__(grid, None)
+
+    @property
+    def mat(self):
+        """
+        Operator matrix, assembled on first access and again after in-place changes of operands.
+        """
+        if self._mat is not None and self._mat_revision != self._revision():
+            self._mat = None
+        if self._mat is None:
+            self._mat = self._materialize()
+            self._mat_revision = self._revision()
+        return self._mat
+
+    @mat.setter
+    def mat(self, value):
+        self._mat = value
+        self._mat_revision = None if value is None else self._revision()
+
+    def operands(self):
+        """
+        :return: List of operators the expression is applied through
+        """
+        raise NotImplementedError
+
+    def _sources(self):
+        """
+        :return: List of operators the expression was built of, before simplification
+        """
+        return self.operands()
+
+    def _revision(self):
+        """
+        :return: Tuple of identities and change counters of the expression and all operators it is built of
+        """
+        revision = []
+        visited = set()
+        stack = [self]
+        while stack:
+            operator = stack.pop()
+            if id(operator) in visited:
+                continue
+            visited.add(id(operator))
+            revision.append((id(operator), operator._version))
+            if isinstance(operator, OperatorExpression):
+                stack.extend(operator._sources())
+        return tuple(revision)
+
+    def _mark_modified(self):
+        super()._mark_modified()
+        if self._mat is not None:
+            self._mat_revision = self._revision()
+
+    def is_matrix_free(self):
+        return self._mat is None or self._mat_revision != self._revision()
+
+    def matmat(self, vectors):
+        if not self.is_matrix_free():
+            return self.mat @ vectors
+        return self._evaluate(np.asarray(vectors), {})
+
+    def _evaluate(self, vectors, cache):
+        """
+        Applies the expression to wave functions.
+
+        :param vectors: Matrix with wave function values as columns
+        :param cache: See apply_operator
+        :return: Resulting matrix
+        """
+        raise NotImplementedError
+
+    def _add_to_mat(self, other, sign=1):
+        return False
+
+    def _scale_mat(self, factor):
+        if self.is_matrix_free():
+            self._mat = None
+        super()._scale_mat(factor)
+
+    def decoupled_points(self):
+        if not self.is_matrix_free():
+            return super().decoupled_points()
+        return np.logical_and.reduce([operand.decoupled_points() for operand in self.operands()])
+
+
+class OperatorSum(OperatorExpression):
+    """
+    Lazy linear combination of operators.
+
+    Nested sums are flattened, repeated operands are merged and diagonal operands are folded into
+    a single diagonal, so every operand is applied only once. The simplified terms are derived
+    from the terms the sum was built of, and are simplified again after in-place changes of operands.
+    """
+
+    def __init__(self, grid: Grid, terms):
+        """
+        :param grid: Grid object
+        :param terms: List of (coefficient, operator) tuples
+        """
+        super().__init__(grid)
+        self.__sources = list(terms)
+        self.__terms = None
+        self.__terms_revision = None
+
+    @property
+    def terms(self):
+        """
+        Simplified list of (coefficient, operator) tuples.
+        """
+        revision = self._revision()
+        if self.__terms_revision != revision:
+            self.__terms = self.__simplify(self.__sources)
+            self.__terms_revision = revision
+        return self.__terms
+
+    def __simplify(self, terms):
+        coefficients = {}
+        operators = {}
+        diagonal = None
+        stack = list(reversed(terms))
+        while stack:
+            coefficient, operator = stack.pop()
+            if isinstance(operator, OperatorSum) and operator.is_matrix_free():
+                stack.extend((coefficient * c, o) for c, o in reversed(operator.__sources))
+            elif isinstance(operator, DiagonalOperator):
+                term = coefficient * operator.diagonal
+                diagonal = term if diagonal is None else diagonal + term
+            else:
+                key = id(operator)
+                operators[key] = operator
+                coefficients[key] = coefficients.get(key, 0) + coefficient
+        result = [(coefficients[key], operator) for key, operator in operators.items() if coefficients[key] != 0]
+        if diagonal is None and not result:
+            diagonal = np.zeros(len(self.grid))
+        if diagonal is not None and (np.any(diagonal != 0) or not result):
+            result.append((1, DiagonalOperator(self.grid, diagonal)))
+        return result
+
+    def operands(self):
+        return [operator for coefficient, operator in self.terms]
+
+    def _sources(self):
+        return [operator for coefficient, operator in self.__sources]
+
+    def dtype(self):
+        return np.result_type(*(coefficient for coefficient, operator in self.terms),
+                              *(operator.dtype() for operator in self.operands()))
+
+    def _evaluate(self, vectors, cache):
+        result = np.zeros(vectors.shape, dtype=np.result_type(vectors, self.dtype()))
+        for coefficient, operator in self.terms:
+            term = apply_operator(operator, vectors, cache)
+            if coefficient == 1:
+                result += term
+            else:
+                result += coefficient * term
+        return result
+
+    def _materialize(self):
+        mat = None
+        diagonal = None
+        terms = self.terms
+        for coefficient, operator in terms:
+            if isinstance(operator, DiagonalOperator):
+                term = coefficient * operator.diagonal
+                diagonal = term if diagonal is None else diagonal + term
+                continue
+            term = operator.mat if coefficient == 1 else coefficient * operator.mat
+            mat = term if mat is None else mat + term
+        if mat is None:
+            return sp.csr_array(sp.diags_array(diagonal))
+        if diagonal is not None:
+            return add_diagonal_mat(mat, diagonal)
+        if sp.issparse(mat):
+            return sp.csr_array(mat)
+        return mat if len(terms) > 1 or terms[0][0] != 1 else mat.copy()
+
+    def adjoint(self):
+        if self.hermitian:
+            return self
+        return OperatorSum(self.grid, [(np.conj(coefficient), operator.adjoint()) for coefficient, operator in self.terms])
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        if self.hermitian is not None:
+            return self.hermitian
+        if self.is_matrix_free() and all(np.imag(coefficient) == 0 and operator.is_hermitian(tol, points)
+                                         for coefficient, operator in self.terms):
+            return True
+        return super().is_hermitian(tol, points)
+
+    def __add_terms(self, terms):
+        self.__sources = self.__sources + terms
+        self.hermitian = None
+        self._mark_modified()
+        return self
+
+    def __iadd__(self, other):
+        self._assert_compatibility(other)
+        if not LinearOperator._add_to_mat(self, other):
+            self._mat = None
+        return self.__add_terms([(1, other)])
+
+    def __isub__(self, other):
+        self._assert_compatibility(other)
+        if not LinearOperator._add_to_mat(self, other, -1):
+            self._mat = None
+        return self.__add_terms([(-1, other)])
+
+    def __imul__(self, other):
+        if not is_scalar(other):
+            return self * other
+        self.__sources = [(coefficient * other, operator) for coefficient, operator in self.__sources]
+        self._scale_mat(other)
+        return self
+
+
+class OperatorProduct(OperatorExpression):
+    """
+    Lazy product of operators, applied to wave functions from right to left.
+
+    Nested products are flattened, scalar factors are collected into the coefficient and adjacent
+    diagonal factors are folded into one. Like the terms of OperatorSum, the simplified factors
+    are derived again after in-place changes of operands.
+    """
+
+    def __init__(self, grid: Grid, factors, coefficient=1):
+        """
+        :param grid: Grid object
+        :param factors: List of operators, the rightmost one is applied first
+        :param coefficient: Scalar multiplier
+        """
+        super().__init__(grid)
+        self.__sources = list(factors)
+        self.__coefficient = coefficient
+        self.__simplified = None
+        self.__simplified_revision = None
+
+    def __simplify(self):
+        revision = self._revision()
+        if self.__simplified_revision != revision:
+            self.__simplified = [self.__coefficient, []]
+            self.__append(self.__sources)
+            self.__simplified_revision = revision
+        return self.__simplified
+
+    @property
+    def coefficient(self):
+        """
+        Scalar multiplier, including the ones of nested products.
+        """
+        return self.__simplify()[0]
+
+    @property
+    def factors(self):
+        """
+        Simplified list of operators, the rightmost one is applied first.
+        """
+        return self.__simplify()[1]
+
+    def __append(self, factors):
+        simplified = self.__simplified[1]
+        for factor in factors:
+            if isinstance(factor, OperatorProduct) and factor.is_matrix_free():
+                self.__simplified[0] *= factor.__coefficient
+                self.__append(factor.__sources)
+            elif isinstance(factor, OperatorSum) and factor.is_matrix_free() and len(factor.terms) == 1:
+                self.__simplified[0] *= factor.terms[0][0]
+                self.__append([factor.terms[0][1]])
+            elif isinstance(factor, DiagonalOperator) and simplified and isinstance(simplified[-1], DiagonalOperator):
+                simplified[-1] = DiagonalOperator(self.grid, simplified[-1].diagonal * factor.diagonal)
+            else:
+                simplified.append(factor)
+
+    def operands(self):
+        return self.factors
+
+    def _sources(self):
+        return self.__sources
+
+    def dtype(self):
+        return np.result_type(self.coefficient, *(factor.dtype() for factor in self.factors))
+
+    def _evaluate(self, vectors, cache):
+        coefficient, factors = self.__simplify()
+        result = apply_operator(factors[-1], vectors, cache)
+        for factor in reversed(factors[:-1]):
+            result = apply_operator(factor, result)
+        return result if coefficient == 1 else coefficient * result
+
+    def _materialize(self):
+        coefficient, factors = self.__simplify()
+        mat = factors[-1].mat
+        for factor in reversed(factors[:-1]):
+            if isinstance(factor, DiagonalOperator):
+                mat = scale_rows_mat(mat, factor.diagonal)
+            else:
+                mat = factor.mat @ mat
+        if sp.issparse(mat):
+            mat = sp.csr_array(mat)
+        if coefficient != 1:
+            return coefficient * mat
+        return mat if len(factors) > 1 else mat.copy()
+
+    def adjoint(self):
+        if self.hermitian:
+            return self
+        return OperatorProduct(self.grid, [factor.adjoint() for factor in reversed(self.factors)],
+                               np.conj(self.coefficient))
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        if self.hermitian is not None:
+            return self.hermitian
+        coefficient, factors = self.__simplify()
+        if self.is_matrix_free() and (points is None or np.all(points)) and np.imag(coefficient) == 0 \
+                and all(factor is factors[0] for factor in factors) and factors[0].is_hermitian(tol):
+            return True
+        return super().is_hermitian(tol, points)
+
+    def __mul__(self, other):
+        if is_scalar(other):
+            return OperatorProduct(self.grid, [self], other)
+        return super().__mul__(other)
+
+    def __iadd__(self, other):
+        self._assert_compatibility(other)
+        return self + other
+
+    def __isub__(self, other):
+        self._assert_compatibility(other)
+        return self - other
+
+    def __imul__(self, other):
+        if is_scalar(other):
+            self.__coefficient *= other
+            self._scale_mat(other)
+            return self
+        self._assert_compatibility(other)
+        self._mat = None
+        self.hermitian = None
+        self.__sources = self.__sources + [other]
+        self._mark_modified()
+        return self
+
+
+class AdjointOperator(OperatorExpression):
+    """
+    Lazy Hermitian conjugate of an operator, applied through the transposed matrix of the operator.
+    """
+
+    def __init__(self, operator: LinearOperator):
+        """
+        :param operator: LinearOperator object
+        """
+        super().__init__(operator.grid)
+        self.operator = operator
+
+    def operands(self):
+        return [self.operator]
+
+    def dtype(self):
+        return self.operator.dtype()
+
+    def _evaluate(self, vectors, cache):
+        return np.conj(self.operator.mat.T @ np.conj(vectors))
+
+    def _materialize(self):
+        mat = self.operator.mat.conj().T
+        return sp.csr_array(mat) if sp.issparse(mat) else mat
+
+    def adjoint(self):
+        return self.operator
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        if self.hermitian is not None:
+            return self.hermitian
+        return self.operator.is_hermitian(tol, points)
+
+    def decoupled_points(self):
+        return LinearOperator.decoupled_points(self)
+
+    def __iadd__(self, other):
+        self._assert_compatibility(other)
+        return self + other
+
+    def __isub__(self, other):
+        self._assert_compatibility(other)
+        return self - other
+
+    def __imul__(self, other):
+        return self * other
+
+
+def apply_stencil(values, out, axis, offsets, coefficients, loop=False):
+    """
+    Applies a finite difference stencil along one axis of a mesh-shaped array and adds the result to out.
+
+    Like get_stencil_mat_1d, boundary points are left untouched unless the coordinate is looped.
+
+    :param values: Array shaped as the grid, may have trailing dimensions
+    :param out: Array of the same shape to add the result to
+    :param axis: Axis index
+    :param offsets: Stencil offsets
+    :param coefficients: Stencil coefficients corresponding to the offsets, either numbers
+      or arrays with a coefficient for every point on the axis
+    :param loop: True if coordinate is looped (like phi in polar coordinates)
+    """
+    size = values.shape[axis]
+
+    def axis_slice(start, stop):
+        index = [slice(None)] * values.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    def axis_coefficient(coefficient, start, stop):
+        if np.ndim(coefficient) == 0:
+            return coefficient
+        shape = [1] * values.ndim
+        shape[axis] = stop - start
+        return np.reshape(coefficient[start:stop], shape)
+
+    for offset, coefficient in zip(offsets, coefficients):
+        if loop:
+            offset %= size
+            out[axis_slice(0, size - offset)] += axis_coefficient(coefficient, 0, size - offset) * \
+                                                 values[axis_slice(offset, size)]
+            if offset != 0:
+                out[axis_slice(size - offset, size)] += axis_coefficient(coefficient, size - offset, size) * \
+                                                        values[axis_slice(0, offset)]
+        else:
+            start, stop = max(1, -offset), min(size - 1, size - offset)
+            if start < stop:
+                out[axis_slice(start, stop)] += axis_coefficient(coefficient, start, stop) * \
+                                                values[axis_slice(start + offset, stop + offset)]
+
+
+class StencilOperator(LinearOperator):
+    """
+    Represents an operator composed of finite difference stencils along grid axes and a diagonal part.
+
+    The operator is applied to wave functions directly with shifted array slices, its matrix
+    is only assembled on demand. Memory usage is thus proportional to the grid size.
+    Spectral terms along looped axes are applied with FFT.
+
+    If some axes are looped and others are bounded, every term leaves out the points on the bounds
+    of bounded axes, so these points are decoupled and the operator stays Hermitian on the rest.
+    """
+
+    def __init__(self, grid: Grid, diagonal=None, matrix_free=True):
+        """
+        :param grid: Grid object
+        :param diagonal: Array with diagonal elements ordered by point indices, zero if not specified, copied
+        :param matrix_free: False to apply the operator through its matrix once it is assembled
+        """
+        super().__init__(grid, None)
+        self.diagonal = np.zeros(len(grid)) if diagonal is None else np.array(diagonal)
+        self.stencils = []
+        self.spectral = []
+        self.matrix_free = matrix_free
+
+    def add_stencil(self, axis, offsets, coefficients, loop=False, weights=None):
+        """
+        Adds a finite difference stencil along given axis to the operator.
+
+        :param axis: Axis index
+        :param offsets: Stencil offsets
+        :param coefficients: Stencil coefficients corresponding to the offsets, either numbers
+          or arrays with a coefficient for every point on the axis
+        :param loop: True if coordinate is looped (like phi in polar coordinates)
+        :param weights: Array to multiply the result by, ordered by point indices
+        :return: self
+        """
+        self.stencils.append((axis, tuple(offsets), tuple(coefficients), loop, weights))
+        self._mat = None
+        self._version += 1
+        return self
+
+    def add_first_dif(self, axis, loop=False, multiplier=1, weights=None, order=2):
+        """
+        Adds the first derivative along given axis to the operator, see add_stencil and get_axis_stencil.
+        """
+        if loop or self.grid.sizes[axis] > 2:
+            self.add_stencil(axis, *get_axis_stencil(self.grid, axis, 1, order, multiplier, loop), loop, weights)
+        return self
+
+    def add_second_dif(self, axis, loop=False, multiplier=1, weights=None, order=2):
+        """
+        Adds the second derivative along given axis to the operator, see add_stencil and get_axis_stencil.
+        """
+        if loop or self.grid.sizes[axis] > 2:
+            self.add_stencil(axis, *get_axis_stencil(self.grid, axis, 2, order, multiplier, loop), loop, weights)
+        return self
+
+    def add_spectral(self, axis, symbol):
+        """
+        Adds an operator diagonal in Fourier space along a looped axis.
+
+        :param axis: Axis index
+        :param symbol: Array with eigenvalues in the order of FFT frequencies
+        :return: self
+        """
+        self.spectral.append((axis, np.asarray(symbol)))
+        self._mat = None
+        self._version += 1
+        return self
+
+    def add_spectral_second_dif(self, axis, multiplier=1):
+        """
+        Adds the second derivative along given looped axis with spectral accuracy, see add_spectral.
+        """
+        return self.add_spectral(axis, multiplier * get_spectral_second_dif_symbol(self.grid, axis))
+
+    def add_laplace(self, loop=False, multiplier=1, spectral=False, order=2):
+        """
+        Adds the Laplace operator to the operator.
+
+        :param loop: True if all coordinates are looped, or a list with a flag for every axis
+        :param multiplier: Multiplier
+        :param spectral: True to differentiate along all axes with FFT, or a list with a flag for every axis,
+          such axes are looped
+        :param order: Accuracy order of finite difference stencils, one of 2, 4, 6 and 8
+        :return: self
+        """
+        loops = loop if isinstance(loop, (list, tuple)) else [loop] * self.grid.dimensions()
+        spectral = spectral if isinstance(spectral, (list, tuple)) else [spectral] * self.grid.dimensions()
+        for dim in range(self.grid.dimensions()):
+            if spectral[dim]:
+                self.add_spectral_second_dif(dim, multiplier)
+            else:
+                self.add_second_dif(dim, loops[dim], multiplier, order=order)
+        return self
+
+    def add_diagonal(self, diagonal):
+        """
+        Adds a diagonal operator to the operator.
+
+        :param diagonal: Array with diagonal elements ordered by point indices
+        :return: self
+        """
+        self.diagonal = self.diagonal + diagonal
+        self._mat = None
+        self._version += 1
+        return self
+
+    def is_matrix_free(self):
+        return self.matrix_free
+
+    def projected_axes(self, loop):
+        """
+        Finds axes whose bounds are left out of a term. Axes are looped if they have looped stencils
+        or spectral terms, and bounded if they only have stencils that are not looped.
+
+        :param loop: True for looped stencils and spectral terms, False for other stencils
+        :return: List with a flag for every axis, see get_axis_operator_mat
+        """
+        looped = [False] * self.grid.dimensions()
+        bounded = [False] * self.grid.dimensions()
+        for axis, offsets, coefficients, stencil_loop, weights in self.stencils:
+            (looped if stencil_loop else bounded)[axis] = True
+        for axis, symbol in self.spectral:
+            looped[axis] = True
+        if loop:
+            return [is_bounded and not is_looped for is_bounded, is_looped in zip(bounded, looped)]
+        return [not is_looped for is_looped in looped]
+
+    def __interior_mask(self, loop):
+        """
+        :return: Mask of the points a term acts on, see projected_axes
+        """
+        return self.grid.interior_mask(np.flatnonzero(self.projected_axes(loop)))
+
+    def dtype(self):
+        return np.result_type(self.diagonal, *(c for stencil in self.stencils for c in stencil[2]),
+                              *(stencil[4] for stencil in self.stencils if stencil[4] is not None),
+                              *(symbol for axis, symbol in self.spectral))
+
+    def _materialize(self):
+        mat = sp.csr_array(sp.diags_array(self.diagonal))
+        projected = {loop: self.projected_axes(loop) for loop in (False, True)}
+        for axis, offsets, coefficients, loop, weights in self.stencils:
+            stencil_mat = get_stencil_mat_1d(self.grid.sizes[axis], offsets, coefficients, loop)
+            term = get_axis_operator_mat(self.grid, axis, stencil_mat, loop, projected[bool(loop)])
+            if weights is not None:
+                term = sp.diags_array(weights) @ term
+            mat = mat + term
+        for axis, symbol in self.spectral:
+            mat = mat + get_axis_operator_mat(self.grid, axis, sp.csr_array(get_spectral_mat_1d(symbol)), True,
+                                              projected[True])
+        return sp.csr_array(mat)
+
+    def matmat(self, vectors):
+        if not self.is_matrix_free():
+            return super().matmat(vectors)
+        vectors = np.asarray(vectors)
+        shape = tuple(self.grid.sizes) + (vectors.shape[1],)
+        values = vectors.reshape(shape, order='F')
+        result = np.asfortranarray(self.diagonal[:, np.newaxis] * vectors, dtype=np.result_type(vectors, self.dtype()))
+        result = result.reshape(shape, order='F')
+        dirichlet = None
+        # Looped terms are added to the result directly, unless some axes are bounded
+        periodic = None if any(self.projected_axes(True)) else result
+        for axis, offsets, coefficients, loop, weights in self.stencils:
+            if not loop and dirichlet is None:
+                dirichlet = np.zeros_like(result)
+            if loop and periodic is None:
+                periodic = np.zeros_like(result)
+            target = periodic if loop else dirichlet
+            if weights is None:
+                apply_stencil(values, target, axis, offsets, coefficients, loop)
+            else:
+                term = np.zeros_like(result)
+                apply_stencil(values, term, axis, offsets, coefficients, loop)
+                target += self.grid.to_mesh(weights)[..., np.newaxis] * term
+        if dirichlet is not None:
+            result += self.grid.to_mesh(self.__interior_mask(False))[..., np.newaxis] * dirichlet
+        for axis, symbol in self.spectral:
+            if periodic is None:
+                periodic = np.zeros_like(result)
+            shape = [1] * result.ndim
+            shape[axis] = len(symbol)
+            term = scipy.fft.ifft(symbol.reshape(shape) * scipy.fft.fft(values, axis=axis), axis=axis)
+            periodic += term if np.iscomplexobj(periodic) else term.real
+        if periodic is not None and periodic is not result:
+            result += self.grid.to_mesh(self.__interior_mask(True))[..., np.newaxis] * periodic
+        return result.reshape((len(self.grid), vectors.shape[1]), order='F')
+
+    def decoupled_points(self):
+        if not self.is_matrix_free():
+            return super().decoupled_points()
+        if not self.stencils and not self.spectral:
+            return np.ones(len(self.grid), dtype=bool)
+        # Points left out of looped terms are left out of the others too, see projected_axes
+        return ~self.__interior_mask(bool(self.spectral or any(stencil[3] for stencil in self.stencils)))
+
+    def is_hermitian(self, tol=1E-12, points=None):
+        if self.hermitian is not None:
+            return self.hermitian
+        if not self.is_matrix_free() or any(stencil[4] is not None or any(np.ndim(c) for c in stencil[2])
+                                            for stencil in self.stencils):
+            return super().is_hermitian(tol, points)
+        for axis, offsets, coefficients, loop, weights in self.stencils:
+            stencil = dict(zip(offsets, coefficients))
+            scale = max(abs(c) for c in coefficients)
+            if any(abs(c - np.conj(stencil.get(-o, 0))) > tol * scale for o, c in stencil.items()):
+                return False
+            if not loop and (points is None or np.any(points & ~self.__interior_mask(False))):
+                return False
+        for axis, symbol in self.spectral:
+            if np.any(abs(np.imag(symbol)) > tol * abs(symbol).max()):
+                return False
+        diagonal = self.diagonal if points is None else self.diagonal[points]
+        return np.all(abs(np.imag(diagonal)) <= tol * abs(diagonal).max())
+
+    def __add_operator(self, other, sign):
+        """
+        Adds diagonal or stencil operator in place, merging its stencils into this operator.
+
+        :return: self, or None if other operator can not be merged
+        """
+        if isinstance(other, StencilOperator):
+            stencils = [(axis, offsets, tuple(sign * c for c in coefficients), loop, weights)
+                        for axis, offsets, coefficients, loop, weights in other.stencils]
+            spectral = [(axis, sign * symbol) for axis, symbol in other.spectral]
+        elif isinstance(other, DiagonalOperator):
+            stencils, spectral = [], []
+        else:
+            return None
+        if not self._add_to_mat(other, sign):
+            self._mat = None
+        self.diagonal = update_array(self.diagonal, np.add, sign * other.diagonal)
+        self.stencils.extend(stencils)
+        self.spectral.extend(spectral)
+        self.hermitian = None
+        self._mark_modified()
+        return self
+
+    def __iadd__(self, other):
+        self._assert_compatibility(other)
+        return self.__add_operator(other, 1) or self + other
+
+    def __isub__(self, other):
+        self._assert_compatibility(other)
+        return self.__add_operator(other, -1) or self - other
+
+    def __imul__(self, other):
+        if not is_scalar(other):
+            return self * other
+        self._scale_mat(other)
+        self.diagonal = update_array(self.diagonal, np.multiply, other)
+        self.stencils = [(axis, offsets, tuple(other * c for c in coefficients), loop, weights)
+                         for axis, offsets, coefficients, loop, weights in self.stencils]
+        self.spectral = [(axis, other * symbol) for axis, symbol in self.spectral]
+        return self
+
+
+class ParticleHamiltonian(StencilOperator):
     """
     Implementation of a hamiltonian of a single particle.
+
+    Public attributes set by subclasses, like potential parameters, define the hamiltonian together with
+    its type and grid, see parameters.
     """
 
-    def __init__(self, grid: Grid, m, *args):
+    # Attributes that hold the assembled operator rather than define it
+    STATE_ATTRIBUTES = ('grid', 'diagonal', 'stencils', 'spectral', 'matrix_free', 'hermitian')
+
+    @traced('assembly')
+    def __init__(self, grid: Grid, m, *args, sparse=True, matrix_free=False, cache=None, loop=False, spectral=False,
+                 order=2):
+        """
+        :param grid: Grid object
+        :param m: Particle mass
+        :param sparse: True if the matrix should be stored in CSR format
+        :param matrix_free: True to apply the hamiltonian with stencils instead of assembling its matrix
+        :param cache: DiskCache object to load assembled matrix from, None for the default cache, False to disable
+        :param loop: True if all coordinates are looped, or a list with a flag for every axis
+        :param spectral: True to evaluate kinetic energy with FFT along all axes, or a list with a flag for every axis,
+          such axes are looped. The matrix of spectral kinetic energy is dense along these axes
+        :param order: Accuracy order of finite difference kinetic energy, one of 2, 4, 6 and 8
+        """
         self.m = m
-        operator_mat = - H ** 2 / (self.m * 2) * get_laplace_operator_mat(grid)
-        operator_mat += ScalarLinearOperator(grid, lambda x: self.get_potential(x)).mat
-        super(ParticleHamiltonian, self).__init__(grid, operator_mat)
+        self.order = order
+        dimensions = grid.dimensions()
+        self.loops = list(loop) if isinstance(loop, (list, tuple)) else [loop] * dimensions
+        self.spectral_axes = list(spectral) if isinstance(spectral, (list, tuple)) else [spectral] * dimensions
+        super(ParticleHamiltonian, self).__init__(grid, get_scalar_diagonal(grid, self.get_potential), matrix_free)
+        self.add_laplace(self.loops, - H ** 2 / (self.m * 2), self.spectral_axes, order)
+        if not matrix_free:
+            def assemble():
+                if any(self.spectral_axes):
+                    return {'mat': convert_operator_mat(self._materialize(), 'csr' if sparse else DENSE)}
+                operator_mat = - H ** 2 / (self.m * 2) * get_laplace_operator_mat(grid, self.loops, sparse, order)
+                return {'mat': add_diagonal_mat(operator_mat, self.diagonal)}
+
+            key = operator_key(self, kind='matrix', sparse=sparse)
+            self.mat = cached(key, assemble, cache)['mat']
+            current_span().set(**matrix_attributes(self.mat))
+        current_span().set(operator=type(self).__name__, points=len(grid), matrix_free=matrix_free)
+
+    def parameters(self):
+        if self._modified:
+            return None
+        try:
+            parameters = {name: key_value(value) for name, value in vars(self).items()
+                          if not name.startswith('_') and name not in self.STATE_ATTRIBUTES}
+        except TypeError:
+            return None
+        parameters.update(loops=[bool(loop) for loop in self.loops],
+                          spectral_axes=[bool(spectral) for spectral in self.spectral_axes])
+        return parameters
 
     @abstractmethod
-    def get_potential(self, x: list) -> float:
+    def get_potential(self, x: list) -> np.ndarray:
         """
+        Evaluates the potential energy in many points at once.
 
-        :param x:
-        :return:
+        :param x: List with coordinate arrays, one for every axis
+        :return: Array with potential values
         """
         pass
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import numbers
+import os
+import shutil
+import uuid
+
+import numpy as np
+from scipy import sparse as sp
+
+from General.Instrumentation import current_span, traced
+
+ENTRY_HEADER = 'entry.json'
+
+default_cache = None
+
+
+class DiskCache:
+    """
+    Content-addressed on-disk cache for assembled operator matrices, eigenproblem solutions and spectra.
+
+    Every entry is a directory named by the hash of its key, holding NPY files with the stored arrays.
+    Once the total size exceeds the limit, entries are evicted in least recently used order.
+    The cache directory may be shared by several processes.
+    """
+
+    def __init__(self, directory, max_size=1 << 30):
+        """
+        :param directory: Directory to store entries in, created if it does not exist
+        :param max_size: Maximal total size of entries in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def digest(key: dict) -> str:
+        """
+        :param key: JSON-serializable dictionary describing the entry
+        :return: Hexadecimal hash of the key
+        """
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def __path(self, key: dict):
+        return os.path.join(self.directory, self.digest(key))
+
+    @traced('cache_read')
+    def get(self, key: dict, mmap=False):
+        """
+        Loads an entry and marks it as recently used.
+
+        :param key: Entry key
+        :param mmap: True to memory-map dense arrays instead of reading them into memory
+        :return: Dictionary with stored arrays, None if there is no such entry
+        """
+        path = self.__path(key)
+        try:
+            with open(os.path.join(path, ENTRY_HEADER)) as header_reader:
+                header = json.load(header_reader)
+            arrays = {name: self.__load_array(path, name, storage, mmap) for name, storage in header['arrays'].items()}
+            os.utime(os.path.join(path, ENTRY_HEADER))
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            current_span().set(kind=key.get('kind'), hit=False)
+            return None
+        self.hits += 1
+        current_span().set(kind=key.get('kind'), hit=True)
+        return arrays
+
+    @traced('cache_write')
+    def put(self, key: dict, arrays: dict):
+        """
+        Stores an entry, then evicts least recently used entries if the cache is too large.
+
+        :param key: Entry key
+        :param arrays: Dictionary with dense arrays or sparse matrices to store
+        """
+        current_span().set(kind=key.get('kind'))
+        path = self.__path(key)
+        temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        os.makedirs(temp_path)
+        storages = {name: self.__save_array(temp_path, name, array) for name, array in arrays.items()}
+        with open(os.path.join(temp_path, ENTRY_HEADER), 'w') as header_writer:
+            json.dump({'key': key, 'arrays': storages}, header_writer, default=repr)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # The same entry has been stored by another process meanwhile
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict()
+
+    def fetch(self, key: dict, compute, mmap=False):
+        """
+        Loads an entry, or computes and stores it if there is no such entry.
+
+        :param key: Entry key
+        :param compute: Function without arguments that returns a dictionary with arrays to store
+        :param mmap: True to memory-map dense arrays of a stored entry
+        :return: Dictionary with arrays
+        """
+        arrays = self.get(key, mmap)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    @staticmethod
+    def __save_array(path, name, array):
+        if sp.issparse(array):
+            array = sp.csr_array(array)
+            np.save(os.path.join(path, name + '.data.npy'), array.data)
+            np.save(os.path.join(path, name + '.indices.npy'), array.indices)
+            np.save(os.path.join(path, name + '.indptr.npy'), array.indptr)
+            return {'format': 'csr', 'shape': list(array.shape)}
+        np.save(os.path.join(path, name + '.npy'), np.asarray(array))
+        return {'format': 'dense'}
+
+    @staticmethod
+    def __load_array(path, name, storage, mmap):
+        if storage['format'] == 'dense':
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+        parts = [np.load(os.path.join(path, '{}.{}.npy'.format(name, part))) for part in ('data', 'indices', 'indptr')]
+        return sp.csr_array(tuple(parts), shape=tuple(storage['shape']))
+
+    def entries(self):
+        """
+        :return: List of (last access time, size in bytes, path) tuples, least recently used first
+        """
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                last_access = os.stat(os.path.join(path, ENTRY_HEADER)).st_mtime
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+            except OSError:
+                continue
+            result.append((last_access, size, path))
+        return sorted(result)
+
+    def size(self):
+        """
+        :return: Total size of entries in bytes
+        """
+        return sum(size for last_access, size, path in self.entries())
+
+    def evict(self):
+        """
+        Removes least recently used entries until total size fits the limit.
+        """
+        entries = self.entries()
+        total = sum(size for last_access, size, path in entries)
+        for last_access, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        for last_access, size, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self):
+        """
+        :return: Dictionary with hit and miss counts of this cache object, evictions it made and current entries
+        """
+        entries = self.entries()
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum(size for last_access, size, path in entries)
+        }
+
+
+def set_default_cache(cache):
+    """
+    Sets the cache used by operators, solutions and spectra unless another one is passed explicitly.
+
+    :param cache: DiskCache object, None to disable caching by default
+    """
+    global default_cache
+    default_cache = cache
+
+
+def get_cache(cache=None):
+    """
+    :param cache: DiskCache object, None for the default cache or False to disable caching
+    :return: DiskCache object to use or None
+    """
+    if cache is None:
+        return default_cache
+    return cache or None
+
+
+def key_value(value):
+    """
+    Converts an operator parameter to a JSON-serializable key item.
+    Arrays and tuples become lists, operators are described by their type and parameters.
+
+    :param value: Parameter value
+    :return: Converted value
+    :raises TypeError: If the value can not be converted
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, np.ndarray):
+        return key_value(value.tolist())
+    if isinstance(value, np.generic):
+        return key_value(value.item())
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, numbers.Complex):
+        return {'complex': [float(value.real), float(value.imag)]}
+    if isinstance(value, (list, tuple)):
+        return [key_value(item) for item in value]
+    if isinstance(value, dict) and all(isinstance(name, str) for name in value):
+        return {name: key_value(item) for name, item in value.items()}
+    if callable(getattr(value, 'parameters', None)):
+        parameters = value.parameters()
+        if parameters is not None:
+            return {'type': '{}.{}'.format(type(value).__module__, type(value).__qualname__),
+                    'parameters': key_value(parameters)}
+    raise TypeError('Parameter of type {} can not be a part of a cache key'.format(type(value).__name__))
+
+
+def operator_key(operator, **kwargs):
+    """
+    Builds a cache key for an operator from its type, parameters and grid.
+
+    :param operator: LinearOperator object
+    :param kwargs: Additional key items, like solver arguments
+    :return: Dictionary, None if the operator is not determined by its parameters
+    """
+    parameters = operator.parameters()
+    if parameters is None:
+        return None
+    key = {
+        'type': '{}.{}'.format(type(operator).__module__, type(operator).__qualname__),
+        'parameters': parameters,
+        'bounds': [[float(b) for b in bounds] for bounds in operator.grid.bounds],
+        'sizes': [int(s) for s in operator.grid.sizes]
+    }
+    grid = operator.grid
+    if not grid.is_uniform():
+        key['coordinates'] = [hashlib.sha256(np.ascontiguousarray(grid.axis_coordinates(dim)).tobytes()).hexdigest()
+                              for dim in range(grid.dimensions())]
+    key.update(kwargs)
+    return key
+
+
+def cached(key, compute, cache=None, mmap=False):
+    """
+    Loads arrays from the cache or computes them, see DiskCache.fetch.
+
+    :param key: Entry key, None to compute without caching
+    :param compute: Function without arguments that returns a dictionary with arrays
+    :param cache: DiskCache object, None for the default cache or False to disable caching
+    :param mmap: True to memory-map dense arrays of a stored entry
+    :return: Dictionary with arrays
+    """
+    cache = get_cache(cache)
+    if cache is None or key is None:
+        return compute()
+    return cache.fetch(key, compute, mmap)
@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.sparse as sp
+
+from General import Instrumentation
+from General.Grid import Grid
+from Projects.LinearAlgebraModel.Model.Equation import solve_eigenproblem
+
+
+def get_axis_interpolation_mat(source, target):
+    """
+    Generates a matrix of linear interpolation between two sets of points on a line.
+
+    :param source: Ascending coordinates to interpolate from
+    :param target: Coordinates to interpolate to, values outside the source range are zero
+    :return: Sparse matrix of shape (len(target), len(source))
+    """
+    source, target = np.asarray(source, dtype=float), np.asarray(target, dtype=float)
+    if len(source) == 1:
+        return sp.csr_array(np.ones((len(target), 1)))
+    right = np.clip(np.searchsorted(source, target, side='right'), 1, len(source) - 1)
+    left = right - 1
+    weights = (target - source[left]) / (source[right] - source[left])
+    rows = np.flatnonzero((target >= source[0]) & (target <= source[-1]))
+    return sp.csr_array((np.concatenate([1 - weights[rows], weights[rows]]),
+                         (np.tile(rows, 2), np.concatenate([left[rows], right[rows]]))),
+                        shape=(len(target), len(source)))
+
+
+def get_interpolation_mat(source: Grid, target: Grid):
+    """
+    Generates a matrix of multilinear interpolation of wave functions between two grids of the same dimension.
+
+    :return: Sparse matrix of shape (len(target), len(source))
+    """
+    if source.dimensions() != target.dimensions():
+        raise ValueError('Grids must have the same dimension')
+    mat = sp.csr_array(np.ones((1, 1)))
+    for axis in range(source.dimensions()):
+        axis_mat = get_axis_interpolation_mat(source.axis_coordinates(axis), target.axis_coordinates(axis))
+        mat = sp.csr_array(sp.kron(axis_mat, mat))
+    return mat
+
+
+def refined_sizes(sizes, refinement, level):
+    """
+    :return: Grid sizes with the spacing of every axis divided by refinement ** level, so nodes stay nodes
+    """
+    return [(size - 1) * refinement ** level + 1 if size > 1 else 1 for size in sizes]
+
+
+class ConvergenceResult:
+    """
+    Eigenvalues found on a sequence of refined grids and their extrapolations to zero spacing.
+    Arrays are indexed by level and state.
+    """
+
+    def __init__(self, grids, values, extrapolated, errors, order, refinement, converged, vectors):
+        """
+        :param grids: List of Grid objects, coarsest first
+        :param values: Array with eigenvalues found on every grid
+        :param extrapolated: Array with Richardson estimates, the eigenvalues themselves for the first level
+        :param errors: Array with error estimates of the extrapolated values, infinite for the first level
+        :param order: Accuracy order used to extrapolate
+        :param refinement: Spacing ratio of consecutive grids
+        :param converged: True if all error estimates are within tolerance at the last level
+        :param vectors: Matrix with eigenvectors found on the finest grid as columns
+        """
+        self.grids = grids
+        self.values = values
+        self.extrapolated = extrapolated
+        self.errors = errors
+        self.order = order
+        self.refinement = refinement
+        self.converged = converged
+        self.vectors = vectors
+
+    def best(self):
+        """
+        :return: Tuple with extrapolated eigenvalues of the finest level and their error estimates
+        """
+        return self.extrapolated[-1], self.errors[-1]
+
+    def observed_order(self):
+        """
+        Estimates the accuracy order of every eigenvalue from the last three levels.
+
+        :return: Array ordered by states, NaN if there are less than three levels or differences vanish
+        """
+        if len(self.values) < 3:
+            return np.full(self.values.shape[1], np.nan)
+        coarse, fine = abs(self.values[-3] - self.values[-2]), abs(self.values[-2] - self.values[-1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            orders = np.log(coarse / fine) / np.log(self.refinement)
+        return np.where(np.isfinite(orders), orders, np.nan)
+
+    def __len__(self):
+        return len(self.grids)
+
+
+def converge_eigenvalues(hamiltonian_class, bounds, sizes, args=(), kwargs=None, n_states=4, tol=1E-4, refinement=2,
+                         max_points=2 ** 20, order=None, seed=True, verbose=True):
+    """
+    Solves a hamiltonian on grids with decreasing spacing, cheapest first, and extrapolates every one of the lowest
+    eigenvalues to zero spacing, until the estimated errors are within tolerance.
+
+    Eigenvalues of a hamiltonian with stencils of accuracy order p behave like E + C h^p for small spacing h,
+    so two consecutive levels give the Richardson estimate E_fine + (E_fine - E_coarse) / (refinement^p - 1).
+    Its error is estimated by the change from the previous estimate, or by the correction itself at the second level.
+    Eigenvectors of every level are interpolated to start the iterative eigensolver of the next one.
+
+    :param hamiltonian_class: ParticleHamiltonian subclass, called like hamiltonian_class(grid, *args, **kwargs)
+    :param bounds: List of bounds by every axis
+    :param sizes: List of point counts by every axis on the coarsest grid
+    :param args: Hamiltonian arguments after the grid
+    :param kwargs: Hamiltonian keyword arguments, like order or sparse
+    :param n_states: Number of the lowest eigenvalues to track
+    :param tol: Absolute tolerance of the extrapolated eigenvalues
+    :param refinement: Integer factor the spacing is divided by at every level, nodes of coarser grids stay nodes
+    :param max_points: Maximal number of grid points, refinement stops before exceeding it
+    :param order: Accuracy order of the eigenvalues, order of the hamiltonian stencils if not specified
+    :param seed: False to solve every level from scratch
+    :param verbose: False to hide progress messages
+    :return: ConvergenceResult object
+    """
+    kwargs = dict(kwargs or {})
+    if order is None:
+        order = kwargs.get('order', 2)
+    if int(refinement) != refinement or refinement < 2:
+        raise ValueError('Refinement must be an integer greater than 1')
+    grids, values, extrapolated, errors = [], [], [], []
+    vectors, converged = None, False
+    while True:
+        level_sizes = refined_sizes(sizes, refinement, len(grids))
+        if grids and np.prod(level_sizes) > max_points:
+            break
+        grid = Grid(bounds, level_sizes)
+        with Instrumentation.span('convergence_level', level=len(grids), sizes=level_sizes):
+            hamiltonian = hamiltonian_class(grid, *args, **kwargs)
+            initial = get_interpolation_mat(grids[-1], grid) @ vectors if seed and grids else None
+            level_values, vectors = solve_eigenproblem(hamiltonian, n_states, initial=initial)
+        grids.append(grid)
+        values.append(np.real(level_values))
+        if len(values) > 1:
+            estimate = values[-1] + (values[-1] - values[-2]) / (refinement ** order - 1)
+            extrapolated.append(estimate)
+            errors.append(abs(estimate - extrapolated[-2]) if len(values) > 2 else abs(estimate - values[-1]))
+        else:
+            extrapolated.append(values[-1])
+            errors.append(np.full(len(values[-1]), np.inf))
+        if verbose:
+            print('Grid {}: maximal error estimate {:.3e}'.format('x'.join(map(str, level_sizes)), errors[-1].max()))
+        if errors[-1].max() <= tol:
+            converged = True
+            break
+    return ConvergenceResult(grids, np.array(values), np.array(extrapolated), np.array(errors), order, refinement,
+                             converged, vectors)
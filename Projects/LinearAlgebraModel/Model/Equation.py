@@ -1,29 +1,52 @@
 import csv
+import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
+from scipy.sparse import linalg as spla
 
-from General.Grid import Grid
+from General import Instrumentation
+from General.Grid import Grid, NonUniformGrid
+from General.Instrumentation import current_span, matrix_attributes, traced
 from General.Utils import ProgressInformer
-from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator
+from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator, convert_operator_mat, DENSE
+from Projects.LinearAlgebraModel.Model.Cache import cached, operator_key
+from Projects.LinearAlgebraModel.Model.Symmetry import SymmetryGroup, project_operator
 
+# Widest band of a sparse Hermitian matrix that is diagonalized with band solvers
+MAX_BANDWIDTH = 8
+# Largest part of the spectrum that band solvers find eigenvectors for, dense solvers are faster for more
+MAX_BAND_FRACTION = 0.05
 
 class WaveFunction:
     """
     A class implementing a wave function.
     """
 
-    def __init__(self, grid: Grid, values: list):
+    def __init__(self, grid: Grid, values: list, normalize=True, label=None):
         """
         Creates a new WaveFunction object.
 
+        Numeric arrays are not copied unless normalization is requested.
+
         :param grid: Grid object
         :param values: List with wave function values
+        :param normalize: False if values are already normalized
+        :param label: Label of the state, like symmetry characters 'Px+Py-' or quantum numbers (n, l, m)
         """
         if len(grid) != len(values):
             raise ValueError('Value count does not correspond to grid size')
         self.grid = grid
-        self.values = np.array(list(complex(a) for a in values), dtype=np.complex)
-        self.values /= sum(x * np.conj(x) for x in self.values) ** 0.5
+        values = np.asarray(values)
+        if values.dtype.kind not in 'fc':
+            values = values.astype(complex)
+        if normalize:
+            values = values / np.linalg.norm(values)
+        self.values = values
+        self.label = label
 
     def operator_value_error(self, operator: LinearOperator):
         """
@@ -32,14 +55,91 @@ class WaveFunction:
         :param operator: Operator object
         :return: Operator value and error
         """
-        val = np.linalg.multi_dot(
-            (np.conj(self.values.transpose()), operator.mat, self.values))
-        op = val * np.eye(len(self.grid)) - operator.mat
-        column = np.conj(self.values) * np.dot(op, self.values)
-        return complex(val), abs(np.dot(column.transpose(), column))
+        values, errors = operator_values_errors(self.values[:, np.newaxis], operator)
+        return complex(values[0]), errors[0]
+
+    def point_values(self):
+        """
+        Obtains wave function values at grid points. Values on non-uniform grids are stored multiplied
+        by square roots of cell volumes (see NonUniformGrid), so they are divided by them here.
+
+        :return: Array ordered by point indices
+        """
+        if self.grid.is_uniform():
+            return self.values
+        return self.values / np.sqrt(self.grid.cell_volumes())
 
     def value_at(self, point):
-        return self.values[self.grid.index(point)]
+        return self.point_values()[self.grid.index(point)]
+
+
+def operator_values_errors(vectors, operator: LinearOperator, chunk_size=256):
+    """
+    Calculate the mean operator values and errors for many wave functions at once.
+
+    Wave functions are processed in chunks of columns, so memory-mapped matrices are read only once.
+
+    :param vectors: Matrix with normalized wave function values as columns
+    :param operator: Operator object
+    :param chunk_size: Number of wave functions processed at once
+    :return: Tuple of operator values array and errors array
+    """
+    count = vectors.shape[1]
+    values = np.zeros(count, dtype=complex)
+    errors = np.zeros(count)
+    for start in range(0, count, chunk_size):
+        chunk = np.asarray(vectors[:, start:start + chunk_size])
+        op_values = operator.matmat(chunk)
+        chunk_values = np.einsum('ij,ij->j', np.conj(chunk), op_values)
+        columns = np.conj(chunk) * (chunk_values * chunk - op_values)
+        values[start:start + chunk_size] = chunk_values
+        errors[start:start + chunk_size] = abs(np.einsum('ij,ij->j', columns, columns))
+    return values, errors
+
+
+def naive_region_mask(grid: Grid):
+    """
+    Obtains the mask of points used by the naive operator value estimation:
+    points inside the grid that are not too close to its center.
+
+    :param grid: Grid object
+    :return: Boolean array ordered by point indices
+    """
+    r = min(min(abs(k) for k in bounds) for bounds in grid.bounds)
+    return grid.interior_mask() & (np.linalg.norm(grid.coordinate_columns(), axis=0) > r / 4)
+
+
+def naive_operator_values_errors(grid: Grid, vectors, op: LinearOperator, chunk_size=256):
+    """
+    Calculates eigenvalues of an operator on many wave functions at once.
+    Omits values near to bounds or center, and those too small by absolute value.
+    Values on non-uniform grids are divided by square roots of cell volumes, see WaveFunction.point_values.
+
+    :param grid: Grid object
+    :param vectors: Matrix with normalized wave function values as columns
+    :param op: LinearOperator object
+    :param chunk_size: Number of wave functions processed at once
+    :return: Tuple of operator values array and errors array, both contain NaN if calculation failed
+    """
+    region = naive_region_mask(grid)[:, np.newaxis]
+    avg_abs = 1 / len(grid)
+    count = vectors.shape[1]
+    values = np.zeros(count, dtype=complex)
+    errors = np.zeros(count)
+    weights = None if grid.is_uniform() else np.sqrt(grid.cell_volumes())[:, np.newaxis]
+    for start in range(0, count, chunk_size):
+        chunk = np.asarray(vectors[:, start:start + chunk_size])
+        op_values = op.matmat(chunk)
+        mask = region & (abs(chunk) > avg_abs / 10)
+        if weights is not None:
+            chunk, op_values = chunk / weights, op_values / weights
+        ratios = np.divide(op_values, chunk, out=np.zeros(op_values.shape, np.result_type(op_values, chunk)), where=mask)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = ratios.sum(axis=0) / mask.sum(axis=0)
+        deviations = np.where(mask, abs(op_values - avg * chunk) ** 2, 0)
+        values[start:start + chunk_size] = avg
+        errors[start:start + chunk_size] = np.where(np.isnan(avg), np.nan, deviations.sum(axis=0) ** 0.5)
+    return values, errors
 
 
 def naive_operator_value_error(wf: WaveFunction, op: LinearOperator):
@@ -51,20 +151,541 @@ def naive_operator_value_error(wf: WaveFunction, op: LinearOperator):
     :param op: LinearOperator object
     :return: Operator value and error
     """
-    op_values = np.dot(op.mat, wf.values)
-    r = min(min(abs(k) for k in bounds) for bounds in wf.grid.bounds)
-    avg_abs = 1 / len(wf.grid)
-    values = []
-    for pt in wf.grid.points_inside():
-        if sum(a ** 2 for a in wf.grid.point_to_absolute(pt)) ** 0.5 > r / 4:
-            wf_value = wf.value_at(pt)
-            if abs(wf_value) > avg_abs / 10:
-                values.append((op_values[wf.grid.index(pt)], wf_value))
-    if len(values) == 0:
+    values, errors = naive_operator_values_errors(wf.grid, wf.values[:, np.newaxis], op)
+    if np.isnan(errors[0]):
         return None, None
-    avg = sum(pair[0] / pair[1] for pair in values) / len(values)
-    err = (sum((abs((pair[0] / pair[1] - avg) * pair[1])) ** 2 for pair in values)) ** 0.5
-    return avg, err
+    return complex(values[0]), errors[0]
+
+
+@traced('eigs')
+def partial_eig(operator: LinearOperator, n_states, which='lowest', sigma=None):
+    """
+    Finds several eigenvalues and eigenvectors of an operator with an iterative solver.
+
+    :param operator: Operator object
+    :param n_states: Number of eigenstates to find
+    :param which: 'lowest' or 'highest' to select eigenvalues by their real part
+    :param sigma: Energy to find nearest eigenvalues to, uses shift-invert mode. Overrides which
+    :return: Tuple of eigenvalues array and eigenvectors matrix with eigenvectors as columns
+    """
+    if which not in ('lowest', 'highest'):
+        raise ValueError('Unknown eigenvalue selection rule {}'.format(which))
+    size = len(operator.grid)
+    if not 0 < n_states <= size:
+        raise ValueError('Cannot find {} eigenstates of an operator of size {}'.format(n_states, size))
+    if n_states < size - 1:
+        if sigma is not None:
+            values, vectors = spla.eigs(operator.mat, n_states, sigma=sigma, which='LM')
+        else:
+            mat = operator.as_linear_operator() if operator.is_matrix_free() else operator.mat
+            values, vectors = spla.eigs(mat, n_states, which='SR' if which == 'lowest' else 'LR')
+    else:
+        values, vectors = np.linalg.eig(operator.dense_mat())
+    return select_eigenstates(values, vectors, n_states, which, sigma)
+
+
+def counted_linear_operator(mat, span):
+    """
+    Wraps a matrix into a scipy LinearOperator that adds the number of vectors it is applied to
+    to the matvecs attribute of a span.
+
+    :param mat: Matrix or scipy LinearOperator
+    :param span: Span object
+    :return: scipy LinearOperator
+    """
+    def matmat(vectors):
+        vectors = np.asarray(vectors)
+        span.set(matvecs=span.attributes.get('matvecs', 0) + (vectors.shape[1] if vectors.ndim > 1 else 1))
+        return mat @ vectors
+
+    return spla.LinearOperator(mat.shape, matvec=matmat, matmat=matmat, dtype=mat.dtype)
+
+
+@traced('eigsh')
+def partial_eigh(mat, n_states, which='lowest', sigma=None):
+    """
+    Finds several eigenvalues and eigenvectors of a Hermitian matrix with the Lanczos method.
+
+    :param mat: Hermitian matrix, dense array, sparse matrix or scipy LinearOperator
+    :param n_states: Number of eigenstates to find
+    :param which: 'lowest' or 'highest' to select eigenvalues
+    :param sigma: Energy to find nearest eigenvalues to, uses shift-invert mode. Overrides which
+    :return: Tuple of eigenvalues array and eigenvectors matrix with eigenvectors as columns
+    """
+    if which not in ('lowest', 'highest'):
+        raise ValueError('Unknown eigenvalue selection rule {}'.format(which))
+    size = mat.shape[0]
+    if not 0 < n_states <= size:
+        raise ValueError('Cannot find {} eigenstates of an operator of size {}'.format(n_states, size))
+    if n_states < size - 1:
+        if sigma is not None:
+            values, vectors = spla.eigsh(mat, n_states, sigma=sigma, which='LM')
+        else:
+            if Instrumentation.enabled():
+                mat = counted_linear_operator(mat, current_span())
+            values, vectors = spla.eigsh(mat, n_states, which='SA' if which == 'lowest' else 'LA')
+    else:
+        if isinstance(mat, spla.LinearOperator):
+            mat = mat @ np.eye(size)
+        values, vectors = scipy.linalg.eigh(convert_operator_mat(mat, DENSE))
+    return select_eigenstates(values, vectors, n_states, which, sigma)
+
+
+def get_shifted_preconditioner(mat, drop_tol=1E-5, fill_factor=20):
+    """
+    Builds a preconditioner for iterative eigensolvers from the incomplete LU factorization of a Hermitian matrix
+    shifted below its lowest Gershgorin bound, so the shifted matrix is positive definite.
+
+    :param mat: Sparse Hermitian matrix
+    :return: scipy LinearOperator that approximately applies the inverse of the shifted matrix,
+      None if the factorization fails
+    """
+    mat = sp.csc_array(mat)
+    diagonal = mat.diagonal().real
+    radii = np.asarray(abs(mat).sum(axis=1)).ravel() - abs(diagonal)
+    bound = (diagonal - radii).min()
+    shift = bound - max(1E-3 * (diagonal + radii - bound).max(), np.finfo(float).tiny)
+    try:
+        factor = spla.spilu(sp.csc_array(mat - shift * sp.eye_array(mat.shape[0], format='csc')),
+                            drop_tol=drop_tol, fill_factor=fill_factor)
+    except RuntimeError:
+        return None
+    return spla.LinearOperator(mat.shape, matvec=factor.solve, matmat=factor.solve, dtype=mat.dtype)
+
+
+@traced('lobpcg')
+def seeded_eigh(mat, initial, n_states, which='lowest', tol=1E-8, maxiter=500):
+    """
+    Finds several eigenvalues and eigenvectors of a Hermitian matrix with LOBPCG, starting from approximate
+    eigenvectors, like interpolated eigenvectors of a coarser grid. Sparse matrices are preconditioned,
+    see get_shifted_preconditioner. Falls back to partial_eigh if some residuals stay too large.
+
+    :param mat: Hermitian matrix, sparse matrix or scipy LinearOperator
+    :param initial: Matrix with approximate eigenvectors as columns, random vectors are added if there are
+      less than n_states of them
+    :param n_states: Number of eigenstates to find
+    :param which: 'lowest' or 'highest' to select eigenvalues
+    :param tol: Residual tolerance relative to eigenvalues, or absolute for eigenvalues less than 1
+    :param maxiter: Maximal number of iterations
+    :return: Tuple of eigenvalues array and eigenvectors matrix with eigenvectors as columns
+    """
+    if which not in ('lowest', 'highest'):
+        raise ValueError('Unknown eigenvalue selection rule {}'.format(which))
+    size = mat.shape[0]
+    if not 0 < n_states <= size:
+        raise ValueError('Cannot find {} eigenstates of an operator of size {}'.format(n_states, size))
+    if 5 * n_states >= size:
+        return partial_eigh(mat, n_states, which)
+    initial = np.asarray(initial)[:, :n_states]
+    if initial.shape[1] < n_states:
+        random = np.random.default_rng(0).standard_normal((size, n_states - initial.shape[1]))
+        initial = np.hstack([initial, random])
+    preconditioner = get_shifted_preconditioner(mat) if sp.issparse(mat) and which == 'lowest' else None
+    with warnings.catch_warnings():
+        # Convergence is checked below
+        warnings.simplefilter('ignore', UserWarning)
+        values, vectors, history = spla.lobpcg(mat, initial, M=preconditioner, tol=tol, maxiter=maxiter,
+                                               largest=which == 'highest', retResidualNormsHistory=True)
+    residuals = np.linalg.norm(mat @ vectors - vectors * values, axis=0)
+    converged = not np.any(residuals > 10 * tol * np.maximum(abs(values), 1))
+    current_span().set(iterations=len(history), preconditioned=preconditioner is not None, converged=converged)
+    if not converged:
+        return partial_eigh(mat, n_states, which)
+    order = np.argsort(values)
+    return values[order], vectors[:, order]
+
+
+def get_bandwidth(mat):
+    """
+    :param mat: Sparse matrix
+    :return: Number of nonzero diagonals above or below the main one, whichever is larger
+    """
+    mat = sp.coo_array(mat)
+    return int(abs(mat.row[mat.data != 0] - mat.col[mat.data != 0]).max(initial=0))
+
+
+@traced('banded_eigh')
+def banded_eigh(mat, bandwidth, values_only=False, subset_by_index=None, subset_by_value=None, iterations=3):
+    """
+    Finds eigenvalues of a sparse Hermitian band matrix with LAPACK band solvers, without converting it to
+    a dense matrix, and eigenvectors by inverse iteration. Eigenvectors of more than MAX_BAND_FRACTION
+    of the spectrum are found with a dense solver instead. Selection arguments are the same as scipy.linalg.eigh takes.
+
+    :param mat: Sparse Hermitian matrix
+    :param bandwidth: Number of nonzero diagonals above the main one
+    :param values_only: True if eigenvectors are not needed
+    :param iterations: Number of inverse iterations for every eigenvector
+    :return: Tuple of eigenvalues array and eigenvectors matrix, None instead of it if only values are requested
+    """
+    mat = sp.coo_array(mat)
+    size = mat.shape[0]
+    band = np.zeros((2 * bandwidth + 1, size), dtype=mat.dtype)
+    band[bandwidth + mat.row - mat.col, mat.col] = mat.data
+    select, select_range = 'a', None
+    if subset_by_index is not None:
+        select, select_range = 'i', subset_by_index
+    elif subset_by_value is not None:
+        select, select_range = 'v', subset_by_value
+    values = scipy.linalg.eig_banded(band[:bandwidth + 1], eigvals_only=True, select=select, select_range=select_range)
+    current_span().set(bandwidth=bandwidth, selected=len(values))
+    if values_only:
+        return values, None
+    if len(values) > MAX_BAND_FRACTION * size:
+        return scipy.linalg.eigh(mat.toarray(), subset_by_index=subset_by_index, subset_by_value=subset_by_value)
+
+    # Shifts slightly off the eigenvalues keep shifted matrices invertible
+    scale = max(abs(band).sum(axis=0).max(), np.finfo(float).tiny)
+    offset = scale * 1E-12
+    vectors = np.random.default_rng(0).standard_normal((size, len(values))).astype(np.result_type(mat.dtype, float))
+    cluster_start = 0
+    for i, value in enumerate(values):
+        if i > 0 and value - values[i - 1] > scale * 1E-3:
+            cluster_start = i
+        shifted = band.copy()
+        shifted[bandwidth] -= value + offset
+        vector = vectors[:, i]
+        for iteration in range(iterations):
+            vector = scipy.linalg.solve_banded((bandwidth, bandwidth), shifted, vector, check_finite=False)
+            # Eigenvectors of close eigenvalues are orthogonalized with the ones already found, like LAPACK stein does
+            cluster = vectors[:, cluster_start:i]
+            vector = vector - cluster @ (cluster.conj().T @ vector)
+            vector /= np.linalg.norm(vector)
+        vectors[:, i] = vector
+    current_span().set(inverse_iterations=iterations * len(values))
+    return values, vectors
+
+
+def restricted_linear_operator(operator: LinearOperator, points):
+    """
+    Creates a scipy LinearOperator that applies an operator to wave functions that are zero outside given points
+    and keeps only the values at these points.
+
+    :param operator: Operator object
+    :param points: Boolean array ordered by point indices
+    :return: scipy LinearOperator
+    """
+    indices = np.flatnonzero(points)
+
+    def matmat(vectors):
+        vectors = np.asarray(vectors).reshape((len(indices), -1))
+        full = np.zeros((len(operator.grid), vectors.shape[1]), dtype=np.result_type(vectors, operator.dtype()))
+        full[indices] = vectors
+        return operator.matmat(full)[indices]
+
+    return spla.LinearOperator((len(indices),) * 2, matvec=matmat, matmat=matmat, dtype=operator.dtype())
+
+
+def select_eigenstate_indices(values, n_states, which='lowest', sigma=None):
+    """
+    Selects eigenvalues nearest to sigma if specified, otherwise the lowest or highest ones.
+
+    :return: Array of indices of the selected eigenvalues, ordered by eigenvalues
+    """
+    if sigma is not None:
+        order = np.argsort(abs(values - sigma))[:n_states]
+        return order[np.argsort(values[order].real)]
+    if which == 'lowest':
+        return np.argsort(values.real)[:n_states]
+    return np.argsort(values.real)[-n_states:]
+
+
+def select_eigenstates(values, vectors, n_states, which='lowest', sigma=None):
+    """
+    Selects eigenstates with eigenvalues nearest to sigma if specified, otherwise the lowest or highest ones.
+
+    :return: Tuple of eigenvalues array and eigenvectors matrix, ordered by eigenvalues
+    """
+    order = select_eigenstate_indices(values, n_states, which, sigma)
+    return values[order], vectors[:, order]
+
+
+@traced('eigensolve')
+def solve_eigenproblem(operator: LinearOperator, n_states=None, which='lowest', sigma=None,
+                       values_only=False, subset_by_index=None, subset_by_value=None, initial=None):
+    """
+    Finds eigenvalues and eigenvectors of an operator choosing the most suitable solver.
+
+    Hermitian operators are diagonalized with eigh-family solvers, which return real ordered eigenvalues
+    and orthonormal eigenvectors. Sparse matrices with at most MAX_BANDWIDTH nonzero diagonals on each side,
+    like those of single-dimensional problems, are diagonalized with band solvers if only eigenvalues
+    or at most MAX_BAND_FRACTION of the eigenstates are requested. Points that the operator does not map onto other points (like grid bounds
+    with Dirichlet conditions) are excluded from the problem if the rest of the operator is Hermitian.
+    Eigenvectors then have zero values at these points.
+
+    :param operator: Operator object
+    :param n_states: Number of eigenstates to find with an iterative solver, all are found if not specified
+    :param which: 'lowest' or 'highest', selects eigenstates to find if n_states is given
+    :param sigma: Energy to find the nearest eigenstates to if n_states is given
+    :param values_only: True if eigenvectors are not needed
+    :param subset_by_index: Tuple with the lowest and the highest indices of the eigenvalues to find
+    :param subset_by_value: Tuple with the bounds of the half-open interval to find eigenvalues in
+    :param initial: Matrix with approximate eigenvectors as columns to start the iterative solver from
+      if n_states is given, see seeded_eigh. Used for Hermitian operators only
+    :return: Tuple of eigenvalues array and eigenvectors matrix with eigenvectors as columns,
+      None instead of the eigenvectors matrix if only values are requested
+    """
+    if operator.hermitian is False:
+        active = np.ones(len(operator.grid), dtype=bool)
+        hermitian = False
+    else:
+        active = ~operator.decoupled_points()
+        if not active.any():
+            active[:] = True
+        hermitian = operator.is_hermitian(points=active)
+
+    if hermitian:
+        if n_states is not None and sigma is None and operator.is_matrix_free():
+            mat = restricted_linear_operator(operator, active)
+        else:
+            mat = operator.mat
+            if not active.all():
+                mat = mat[active][:, active] if operator.is_sparse() else mat[np.ix_(active, active)]
+        current_span().set(operator=type(operator).__name__, n_states=n_states, hermitian=True,
+                           **matrix_attributes(mat))
+        size = mat.shape[0]
+        bandwidth = get_bandwidth(mat) if sp.issparse(mat) and sigma is None else None
+        band = bandwidth is not None and bandwidth <= MAX_BANDWIDTH
+        if band and n_states is not None and (values_only or n_states <= MAX_BAND_FRACTION * size):
+            if not 0 < n_states <= size:
+                raise ValueError('Cannot find {} eigenstates of an operator of size {}'.format(n_states, size))
+            subset = (0, n_states - 1) if which == 'lowest' else (size - n_states, size - 1)
+            values, vectors = banded_eigh(mat, bandwidth, values_only, subset_by_index=subset)
+        elif n_states is not None and sigma is None and initial is not None:
+            values, vectors = seeded_eigh(mat, np.asarray(initial)[active], n_states, which)
+        elif n_states is not None:
+            values, vectors = partial_eigh(mat, n_states, which, sigma)
+        elif band and (values_only or subset_by_value is not None or subset_by_index is not None and
+                       subset_by_index[1] - subset_by_index[0] < MAX_BAND_FRACTION * size):
+            values, vectors = banded_eigh(mat, bandwidth, values_only, subset_by_index, subset_by_value)
+        elif values_only:
+            values, vectors = scipy.linalg.eigvalsh(convert_operator_mat(mat, DENSE), subset_by_index=subset_by_index,
+                                                    subset_by_value=subset_by_value), None
+        else:
+            values, vectors = scipy.linalg.eigh(convert_operator_mat(mat, DENSE), subset_by_index=subset_by_index,
+                                                subset_by_value=subset_by_value)
+        if vectors is not None and not active.all():
+            full_vectors = np.zeros((len(operator.grid), vectors.shape[1]), dtype=vectors.dtype)
+            full_vectors[active] = vectors
+            vectors = full_vectors
+    else:
+        current_span().set(operator=type(operator).__name__, n_states=n_states, hermitian=False,
+                           points=len(operator.grid))
+        if n_states is not None:
+            values, vectors = partial_eig(operator, n_states, which, sigma)
+        else:
+            values, vectors = np.linalg.eig(operator.dense_mat())
+            values = np.real_if_close(values, tol=1E7)
+            if subset_by_index is not None or subset_by_value is not None:
+                order = np.argsort(values.real)
+                if subset_by_index is not None:
+                    order = order[subset_by_index[0]:subset_by_index[1] + 1]
+                if subset_by_value is not None:
+                    order = order[(subset_by_value[0] < values[order].real) &
+                                  (values[order].real <= subset_by_value[1])]
+                values, vectors = values[order], vectors[:, order]
+        if values_only:
+            vectors = None
+    return values, vectors
+
+
+@traced('symmetric_eigensolve')
+def solve_symmetric_eigenproblem(operator: LinearOperator, group: SymmetryGroup, n_states=None, which='lowest',
+                                 sigma=None, values_only=False, subset_by_index=None, subset_by_value=None,
+                                 workers=None):
+    """
+    Finds eigenvalues and eigenvectors of a Hermitian operator invariant under a symmetry group.
+
+    The operator is projected onto the subspace of every character of the group, and these blocks
+    are diagonalized independently in a thread pool. Selection arguments apply to the whole spectrum,
+    see solve_eigenproblem.
+
+    :param operator: Operator object
+    :param group: SymmetryGroup object, the operator must be invariant under its symmetries
+    :param workers: Number of blocks diagonalized at once, the number of cores if not specified
+    :return: Tuple of eigenvalues array, eigenvectors matrix (None if only values are requested)
+      and characters matrix with eigenvalues of the generators of the group in rows, one for every eigenstate
+    """
+    active = ~operator.decoupled_points()
+    if not active.any():
+        active[:] = True
+    if not operator.is_hermitian(points=active):
+        raise ValueError('Symmetry blocks can be diagonalized for Hermitian operators only')
+    blocks = group.blocks(active)
+    matrix_free = n_states is not None and sigma is None and operator.is_matrix_free()
+    parent = current_span()
+    parent.set(operator=type(operator).__name__, n_states=n_states, points=int(active.sum()), blocks=len(blocks))
+
+    def solve_block(block):
+        character, basis = block
+        with Instrumentation.span('block', parent, character=group.label(character), size=basis.shape[1]):
+            return solve_projected_block(character, basis)
+
+    def solve_projected_block(character, basis):
+        mat = project_operator(operator, basis, matrix_free)
+        size = basis.shape[1]
+        if n_states is not None:
+            values, vectors = partial_eigh(mat, min(n_states, size), which, sigma)
+        else:
+            block_index = None
+            if subset_by_index is not None:
+                block_index = (0, min(subset_by_index[1], size - 1))
+            mat = convert_operator_mat(mat, DENSE)
+            if values_only:
+                values, vectors = scipy.linalg.eigvalsh(mat, subset_by_index=block_index,
+                                                        subset_by_value=subset_by_value), None
+            else:
+                values, vectors = scipy.linalg.eigh(mat, subset_by_index=block_index, subset_by_value=subset_by_value)
+        if vectors is not None:
+            vectors = basis @ vectors
+        return values, vectors, np.tile(character, (len(values), 1))
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(solve_block, blocks))
+    values = np.concatenate([result[0] for result in results])
+    characters = np.concatenate([result[2] for result in results]).reshape((-1, len(group)))
+    if n_states is not None:
+        order = select_eigenstate_indices(values, n_states, which, sigma)
+    else:
+        order = np.argsort(values)
+        if subset_by_index is not None:
+            order = order[subset_by_index[0]:subset_by_index[1] + 1]
+    vectors = None
+    if not values_only:
+        vectors = np.hstack([result[1] for result in results])[:, order]
+    return values[order], vectors, characters[order]
+
+
+class StateList:
+    """
+    A sequence of wave functions backed by a single matrix with wave function values as columns.
+
+    WaveFunction objects are created on access and share memory with the matrix.
+    A list may also be a view of selected matrix columns, which are then only copied if the vectors are requested.
+    """
+
+    def __init__(self, grid: Grid, vectors: np.ndarray, labels=None, indices=None):
+        """
+        :param grid: Grid object
+        :param vectors: Matrix with normalized wave function values as columns
+        :param labels: List with labels of the matrix columns
+        :param indices: Array with indices of the matrix columns in the list, all columns if not specified
+        """
+        self.grid = grid
+        self.__matrix = vectors
+        self.indices = None if indices is None else np.asarray(indices, dtype=int).ravel()
+        if labels is not None and self.indices is not None:
+            labels = [labels[i] for i in self.indices]
+        self.labels = labels
+
+    @property
+    def vectors(self):
+        """
+        Matrix with wave function values of the list as columns.
+        """
+        if self.indices is None:
+            return self.__matrix
+        return self.__matrix[:, self.indices]
+
+    def __getitem__(self, item):
+        if isinstance(item, (slice, list, np.ndarray)):
+            labels = self.labels
+            if self.indices is None and isinstance(item, slice):
+                return StateList(self.grid, self.__matrix[:, item], labels[item] if labels is not None else None)
+            positions = np.arange(len(self))[item]
+            indices = positions if self.indices is None else self.indices[positions]
+            view = StateList(self.grid, self.__matrix, None, indices)
+            view.labels = [labels[i] for i in positions] if labels is not None else None
+            return view
+        column = item if self.indices is None else self.indices[item]
+        return WaveFunction(self.grid, self.__matrix[:, column], normalize=False,
+                            label=self.labels[item] if self.labels is not None else None)
+
+    def __len__(self):
+        return self.__matrix.shape[1] if self.indices is None else len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class EnergyIndex:
+    """
+    Energies sorted once to answer nearest energy and energy window queries with binary search.
+    Complex energies are ordered by their real parts.
+    """
+
+    def __init__(self, values):
+        """
+        :param values: Array with energies ordered by state indices
+        """
+        self.values = np.real(np.asarray(values)).ravel()
+        self.order = np.argsort(self.values, kind='stable')
+        self.sorted = self.values[self.order]
+
+    def nearest(self, energies):
+        """
+        Finds states with the nearest energies, the lower one if two are equally near.
+
+        :param energies: Energy or array of energies
+        :return: State index, or array of state indices shaped like energies
+        """
+        if len(self.sorted) == 0:
+            raise ValueError('No energies to search')
+        energies = np.real(np.asarray(energies, dtype=complex))
+        positions = np.clip(np.searchsorted(self.sorted, energies), 1, max(len(self.sorted) - 1, 1))
+        lower = positions - 1
+        upper = np.minimum(positions, len(self.sorted) - 1)
+        nearest = np.where(abs(energies - self.sorted[upper]) < abs(energies - self.sorted[lower]), upper, lower)
+        return self.order[nearest]
+
+    def window(self, low, high):
+        """
+        :return: Array with ascending indices of the states with energies from low to high inclusive
+        """
+        start, stop = np.searchsorted(self.sorted, low, 'left'), np.searchsorted(self.sorted, high, 'right')
+        return np.sort(self.order[start:stop])
+
+    def windows(self, lows, highs):
+        """
+        Answers many energy window queries at once, see window.
+
+        :param lows: Array with lower bounds
+        :param highs: Array with upper bounds
+        :return: List of arrays with ascending state indices
+        """
+        starts = np.searchsorted(self.sorted, np.ravel(lows), 'left')
+        stops = np.searchsorted(self.sorted, np.ravel(highs), 'right')
+        return [np.sort(self.order[start:stop]) for start, stop in zip(starts, stops)]
+
+    def near(self, energies, tolerance=0):
+        """
+        Finds states with the nearest energy and the ones that differ from it by no more than tolerance.
+
+        :param energies: Energy or array of energies
+        :param tolerance: Maximal difference of energies considered equal
+        :return: Array with ascending state indices, or a list of them for an array of energies
+        """
+        nearest = self.values[self.nearest(energies)]
+        if np.ndim(nearest) == 0:
+            return self.window(nearest - tolerance, nearest + tolerance)
+        return self.windows(nearest - tolerance, nearest + tolerance)
+
+    def __len__(self):
+        return len(self.sorted)
+
+
+def normalize_columns(vectors):
+    """
+    Normalizes all columns of a matrix at once and lays it out in memory column by column.
+
+    :param vectors: Matrix with wave function values as columns
+    :return: Normalized matrix in Fortran order
+    """
+    vectors = np.asfortranarray(vectors)
+    norms = np.linalg.norm(vectors, axis=0)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
 
 
 class SchrodingerSolution:
@@ -72,33 +693,81 @@ class SchrodingerSolution:
     A structure that contains solutions of a Schrodinger equation.
     """
 
+    @traced('solution')
     def __init__(self, **kwargs):
         """
         Creates a new SchrodingerSolution instance.
 
-        Specify hamiltonian or grid to solve directly, or filename to load form CSV table.
+        Specify hamiltonian or grid to solve directly, or filename to load form CSV table or binary file.
+        All eigenstates are found unless n_states is specified. Hermitian hamiltonians are solved
+        with eigh-family solvers, see solve_eigenproblem.
 
         :key hamiltonian: Hamiltonian operator object
         :key grid: Grid object
+        :key n_states: Number of eigenstates to find with an iterative solver
+        :key which: 'lowest' (default) or 'highest', selects eigenstates to find if n_states is given
+        :key sigma: Energy to find the nearest eigenstates to if n_states is given
+        :key values_only: True to find eigenvalues only, states are left empty then
+        :key subset_by_index: Tuple with the lowest and the highest indices of the eigenvalues to find
+        :key subset_by_value: Tuple with the bounds of the half-open interval to find eigenvalues in
         :key filename: File to load solution from
+        :key mmap: False to read binary solution file or cached eigenstates into memory instead of mapping it,
+          True by default
+        :key cache: DiskCache object to load eigenstates from, None for the default cache, False to disable
+        :key symmetry: SymmetryGroup object the hamiltonian is invariant under, or True to detect it.
+          The hamiltonian is then diagonalized by symmetry blocks, and states are labeled
+        :key workers: Number of symmetry blocks diagonalized at once, the number of cores by default
         """
         print('Schrodinger equation initialization started')
+        self.key = None
+        self.symmetry = None
+        self.characters = None
+        self.__energy_index = None
         if 'hamiltonian' in kwargs and 'grid' in kwargs:
             ham, grid = kwargs['hamiltonian'], kwargs['grid']
+            solver_args = (kwargs.get('n_states'), kwargs.get('which', 'lowest'), kwargs.get('sigma'),
+                           kwargs.get('values_only', False), kwargs.get('subset_by_index'),
+                           kwargs.get('subset_by_value'))
+            symmetry = kwargs.get('symmetry')
+            if symmetry is True:
+                print('Detecting symmetries...')
+                symmetry = SymmetryGroup.detect(ham)
+            if symmetry:
+                self.symmetry = symmetry
 
-            print('Finding eigenvalues...')
-            eig = np.linalg.eig(ham.mat)
+            def solve():
+                if self.symmetry is not None:
+                    print('Finding eigenvalues in {} symmetry blocks...'.format(self.symmetry.order()))
+                    eig = solve_symmetric_eigenproblem(ham, self.symmetry, *solver_args, workers=kwargs.get('workers'))
+                else:
+                    print('Finding eigenvalues...')
+                    eig = solve_eigenproblem(ham, *solver_args)
+                with Instrumentation.span('normalize'):
+                    result = {
+                        'values': np.real_if_close(eig[0], tol=1E7),
+                        'vectors': normalize_columns(eig[1] if eig[1] is not None else np.zeros((len(grid), 0)))
+                    }
+                if self.symmetry is not None:
+                    result['characters'] = eig[2]
+                return result
 
-            self.values = np.real_if_close(eig[0], tol=1E7)
+            if self.symmetry is None:
+                self.key = operator_key(ham, kind='eigenproblem', solver_args=solver_args)
+            else:
+                self.key = operator_key(ham, kind='eigenproblem', solver_args=solver_args,
+                                        symmetry=self.symmetry.names())
+            eig = cached(self.key, solve, kwargs.get('cache'), kwargs.get('mmap', True))
+            self.values = np.array(eig['values'])
             self.grid = grid
-            p = ProgressInformer(caption='Evaluating wave functions', length=40)
-            i = 0
-            self.states = []
-            for line in eig[1].transpose():
-                self.states.append(WaveFunction(self.grid, line))
-                i += 1
-                p.report_progress(i / len(eig[1]))
-            p.finish()
+            self.vectors = eig['vectors']
+            labels = None
+            with Instrumentation.span('states', states=len(self.values)):
+                if self.symmetry is not None:
+                    self.characters = np.array(eig['characters'])
+                    labels = [self.symmetry.label(character) for character in self.characters]
+                self.states = StateList(self.grid, self.vectors, labels)
+            current_span().set(hamiltonian=type(ham).__name__, points=len(grid), states=len(self.values),
+                               symmetry=self.symmetry.names() if self.symmetry is not None else None)
             self.alias = '{}_{}'.format(
                 type(ham).__name__,
                 '_'.join('({},{},{})'.format(*b, s) for b, s in zip(grid.bounds, grid.sizes))
@@ -106,19 +775,31 @@ class SchrodingerSolution:
             print('Schrodinger equation initialization done\n')
         elif 'filename' in kwargs:
             print('Loading solution from file...')
-            self.load(kwargs['filename'])
+            self.load(kwargs['filename'], kwargs.get('mmap', True))
             print('Schrodinger equation initialization done\n')
         else:
             raise ValueError('Cannot instantiate Solution with arguments given')
 
-    def dump(self, filename: str):
+    @traced('solution_dump')
+    def dump(self, filename: str, binary=False):
         """
-        Dump solution to a CSV file.
+        Dump solution to a CSV file, or to a binary file if filename has NPY extension.
+
+        Binary solution consists of the NPY file with wave function values as columns
+        and a JSON header with the same name containing grid parameters, alias and energies.
+        Coordinates of non-uniform grids are stored in the header too.
 
         :param filename: File to dump solution to
+        :param binary: True to dump to a binary file even if filename has no NPY extension
         """
+        if binary or filename.endswith('.npy'):
+            self.dump_binary(filename)
+            return
+        if not self.grid.is_uniform():
+            raise ValueError('Solutions on non-uniform grids can only be dumped to binary files')
         if not filename.endswith('.csv'):
             filename += '.csv'
+        current_span().set(filename=filename, states=len(self.states))
         writer = csv.writer(open(filename, 'w'))
         writer.writerow([b[0] for b in self.grid.bounds])
         writer.writerow([b[1] for b in self.grid.bounds])
@@ -130,14 +811,43 @@ class SchrodingerSolution:
             p.report_progress((i + 1) / len(self.states))
         p.finish()
 
-    def load(self, filename: str):
+    @traced('solution_dump')
+    def dump_binary(self, filename: str):
+        """
+        Dump solution to a binary NPY file with a JSON header.
+
+        :param filename: File to dump wave functions to
+        """
+        if not filename.endswith('.npy'):
+            filename += '.npy'
+        current_span().set(filename=filename, states=len(self.states))
+        values = np.asarray(self.values)
+        header = {
+            'bounds': [[float(b) for b in bounds] for bounds in self.grid.bounds],
+            'sizes': [int(s) for s in self.grid.sizes],
+            'alias': self.alias,
+            'values': [float(v) for v in values.real],
+            'values_imag': [float(v) for v in values.imag] if np.iscomplexobj(values) else None,
+            'coordinates': None if self.grid.is_uniform() else
+            [[float(c) for c in self.grid.axis_coordinates(dim)] for dim in range(self.grid.dimensions())]
+        }
+        with open(filename[:-4] + '.json', 'w') as header_writer:
+            json.dump(header, header_writer)
+        np.save(filename, self.vectors)
+
+    @traced('solution_load')
+    def load(self, filename: str, mmap=True):
         """
-        Loads solution from provided CSV file.
+        Loads solution from provided CSV or binary NPY file.
 
         :param filename: File to load solution from
+        :param mmap: False to read binary solution file into memory instead of mapping it
         """
+        if filename.endswith('.npy'):
+            self.load_binary(filename, mmap)
+            return
         if not filename.endswith('.csv'):
-            raise ValueError('Solution file must have CSV extension')
+            raise ValueError('Solution file must have CSV or NPY extension')
         self.alias = filename[:-4]
         reader = csv.reader(open(filename))
         l_bounds = [float(a) for a in reader.__next__()]
@@ -145,13 +855,41 @@ class SchrodingerSolution:
         sizes = [int(a) for a in reader.__next__()]
         self.grid = Grid(list(zip(l_bounds, u_bounds)), sizes)
         self.values = np.array([complex(a) for a in reader.__next__()])
-        self.states = []
+        rows = []
         p = ProgressInformer(caption='Loading wave functions', length=40)
         p.report_progress(0)
         for i in range(len(self.values)):
-            self.states.append(WaveFunction(self.grid, reader.__next__()))
+            rows.append(np.array(reader.__next__(), dtype=complex))
             p.report_progress((i + 1) / len(self.values))
         p.finish()
+        self.vectors = normalize_columns(np.array(rows).reshape((len(self.values), len(self.grid))).transpose())
+        self.states = StateList(self.grid, self.vectors)
+        current_span().set(filename=filename, states=len(self.values))
+
+    @traced('solution_load')
+    def load_binary(self, filename: str, mmap=True):
+        """
+        Loads solution from binary NPY file with a JSON header.
+        The file is memory-mapped by default, so wave functions are read from disk only when accessed.
+
+        :param filename: File to load wave functions from
+        :param mmap: False to read the file into memory instead of mapping it
+        """
+        with open(filename[:-4] + '.json') as header_reader:
+            header = json.load(header_reader)
+        self.alias = header['alias']
+        if header.get('coordinates') is not None:
+            self.grid = NonUniformGrid(header['coordinates'])
+        else:
+            self.grid = Grid([tuple(b) for b in header['bounds']], header['sizes'])
+        self.values = np.array(header['values'])
+        if header['values_imag'] is not None:
+            self.values = self.values + 1j * np.array(header['values_imag'])
+        self.vectors = np.load(filename, mmap_mode='r' if mmap else None)
+        if self.vectors.shape != (len(self.grid), len(self.values)):
+            raise ValueError('Solution file does not correspond to its header')
+        self.states = StateList(self.grid, self.vectors)
+        current_span().set(filename=filename, states=len(self.values), mmap=mmap)
 
     def __getitem__(self, args):
         """
@@ -162,16 +900,38 @@ class SchrodingerSolution:
         Given one argument, takes it as the energy and tolerance as 0.
         Given the second argument, takes it as the tolerance value.
 
-        :return: Tuple with states
+        :return: StateList view of the states ordered by indices
         """
         if type(args) == tuple:
             energy, tolerance = args
         else:
             energy = args
             tolerance = 0
+        return self.states[self.energy_index().near(energy, tolerance)]
+
+    def energy_index(self):
+        """
+        :return: EnergyIndex object of the solution energies, built on the first call
+        """
+        if self.__energy_index is None or len(self.__energy_index) != len(self.values):
+            self.__energy_index = EnergyIndex(self.values)
+        return self.__energy_index
+
+    def nearest(self, energies, tolerance=0):
+        """
+        Finds states with the energy nearest to given and the ones that differ from it by no more than tolerance.
+
+        :param energies: Energy or array of energies
+        :param tolerance: Maximal difference of energies considered equal
+        :return: Array with ascending state indices, or a list of them for an array of energies
+        """
+        return self.energy_index().near(energies, tolerance)
 
-        nearest_nrg = min(list(self.values), key=lambda current_energy: abs(energy - current_energy))
-        return tuple(self.states[i] for i in range(len(self.values)) if abs(self.values[i] - nearest_nrg) <= tolerance)
+    def window(self, low, high):
+        """
+        :return: Array with ascending indices of the states with energies from low to high inclusive
+        """
+        return self.energy_index().window(low, high)
 
     def __iter__(self):
         """
@@ -0,0 +1,395 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import scipy.fft
+import scipy.linalg
+import scipy.special
+from scipy import sparse as sp
+from scipy.sparse import linalg as spla
+
+from General.Instrumentation import current_span, traced
+from General.Utils import ProgressInformer
+from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator, StencilOperator, H
+from Projects.LinearAlgebraModel.Model.Equation import WaveFunction, operator_values_errors, \
+    restricted_linear_operator
+
+
+class Snapshot:
+    """
+    State of a propagated wave function at some moment of time.
+    """
+
+    def __init__(self, t, state: WaveFunction = None, observables: dict = None):
+        """
+        :param t: Time
+        :param state: WaveFunction object, None if states are not recorded
+        :param observables: Dictionary with (value, error) tuples of observables by their aliases
+        """
+        self.t = t
+        self.state = state
+        self.observables = observables if observables is not None else {}
+
+    def __getitem__(self, alias):
+        return self.observables[alias]
+
+
+class Propagator(ABC):
+    """
+    Base class of schemes solving the time-dependent Schrodinger equation i H d psi / dt = hamiltonian psi.
+
+    Like solve_eigenproblem, schemes work on the points coupled by the hamiltonian. Values at decoupled
+    points, like the bounds of the grid with Dirichlet boundary conditions, only get their phase rotated.
+    """
+
+    def __init__(self, hamiltonian: LinearOperator):
+        """
+        :param hamiltonian: Hamiltonian operator, Hermitian on the coupled points
+        """
+        self.hamiltonian = hamiltonian
+        decoupled = hamiltonian.decoupled_points()
+        self.active = ~decoupled
+        if np.all(self.active):
+            self.active = None
+            self.decoupled_diagonal = np.zeros(0)
+        else:
+            diagonal = getattr(hamiltonian, 'diagonal', None)
+            if not isinstance(diagonal, np.ndarray):
+                diagonal = hamiltonian.mat.diagonal()
+            self.decoupled_diagonal = diagonal[decoupled]
+
+    def active_count(self):
+        """
+        :return: Number of points the scheme works on
+        """
+        return len(self.hamiltonian.grid) if self.active is None else int(np.count_nonzero(self.active))
+
+    def restricted_mat(self):
+        """
+        :return: Sparse hamiltonian matrix restricted to the coupled points
+        """
+        mat = sp.csr_array(self.hamiltonian.mat)
+        return mat if self.active is None else mat[self.active][:, self.active]
+
+    def restricted_operator(self):
+        """
+        :return: scipy LinearOperator applying the hamiltonian on the coupled points
+        """
+        if self.active is None:
+            return self.hamiltonian.as_linear_operator()
+        return restricted_linear_operator(self.hamiltonian, self.active)
+
+    @abstractmethod
+    def perform_step(self, values, step):
+        """
+        Propagates wave function values at the coupled points.
+
+        :param values: Array with values at the coupled points
+        :param step: Time step
+        :return: Array with propagated values
+        """
+        return values
+
+    def step(self, values, step):
+        """
+        Propagates wave function values by a single time step.
+
+        :param values: Array with wave function values ordered by point indices
+        :param step: Time step
+        :return: Array with propagated values
+        """
+        values = np.asarray(values, dtype=complex)
+        if self.active is None:
+            return self.perform_step(values, step)
+        result = np.empty_like(values)
+        result[self.active] = self.perform_step(values[self.active], step)
+        result[~self.active] = values[~self.active] * np.exp(-1j * step / H * self.decoupled_diagonal)
+        return result
+
+    def evolve(self, wave_function: WaveFunction, target, step, snapshot_every=1, observables=(), states=True,
+               start=0., verbose=False):
+        """
+        Propagates wave function in time, streaming snapshots instead of storing every step.
+
+        The step is adjusted slightly so that the target time is reached exactly.
+
+        :param wave_function: Initial WaveFunction object
+        :param target: Time to propagate to
+        :param step: Time step, must be positive
+        :param snapshot_every: Number of steps between snapshots, the initial and the final states are always yielded
+        :param observables: Dictionary with operators by their aliases or list of operators to evaluate
+          in every snapshot, aliases are class names then
+        :param states: False to yield observables only
+        :param start: Initial time
+        :param verbose: True to show the progress bar
+        :return: Generator of Snapshot objects
+        """
+        if step <= 0:
+            raise ValueError('Step must be strictly positive')
+        if not isinstance(observables, dict):
+            observables = {type(operator).__name__: operator for operator in observables}
+        n_steps = max(1, int(round(abs(target - start) / step)))
+        step = (target - start) / n_steps
+        grid = wave_function.grid
+        p = ProgressInformer(caption='Propagating', length=40, max=n_steps, verbose=verbose)
+
+        def snapshot(i, values):
+            measured = {}
+            for alias, operator in observables.items():
+                op_values, op_errors = operator_values_errors(values[:, np.newaxis], operator)
+                measured[alias] = complex(op_values[0]), float(op_errors[0])
+            return Snapshot(start + i * step, WaveFunction(grid, values.copy(), normalize=False) if states else None,
+                            measured)
+
+        values = np.asarray(wave_function.values, dtype=complex)
+        yield snapshot(0, values)
+        for i in range(1, n_steps + 1):
+            values = self.step(values, step)
+            if i % snapshot_every == 0 or i == n_steps:
+                yield snapshot(i, values)
+            p.report_increment()
+        p.finish()
+
+    @traced('propagate')
+    def propagate(self, wave_function: WaveFunction, duration, step):
+        """
+        Propagates wave function in time without intermediate snapshots.
+
+        :param wave_function: Initial WaveFunction object
+        :param duration: Time to propagate by
+        :param step: Time step
+        :return: WaveFunction object
+        """
+        current_span().set(propagator=type(self).__name__, points=self.active_count(),
+                           steps=max(1, int(round(abs(duration) / step))))
+        *_, last = self.evolve(wave_function, duration, step, snapshot_every=np.inf)
+        return last.state
+
+
+class CrankNicolsonPropagator(Propagator):
+    """
+    Crank-Nicolson scheme, unitary and unconditionally stable, second order in the time step.
+
+    Sparse LU factorization of (1 + i step hamiltonian / 2H) is computed once per step size.
+    """
+
+    def __init__(self, hamiltonian: LinearOperator):
+        super().__init__(hamiltonian)
+        self.mat = sp.csc_array(self.restricted_mat())
+        self.factorizations = {}
+
+    def factorization(self, step):
+        """
+        :param step: Time step
+        :return: Cached factorization of the implicit half-step matrix
+        """
+        if step not in self.factorizations:
+            identity = sp.eye_array(self.mat.shape[0], format='csc')
+            self.factorizations[step] = spla.splu(sp.csc_array(identity + 0.5j * step / H * self.mat))
+        return self.factorizations[step]
+
+    def perform_step(self, values, step):
+        return self.factorization(step).solve(values - 0.5j * step / H * (self.mat @ values))
+
+
+def spectral_bounds(operator: spla.LinearOperator, margin=0.05):
+    """
+    Estimates the bounds of the spectrum of a Hermitian operator with Lanczos iterations.
+
+    :param operator: scipy LinearOperator
+    :param margin: Relative margin to widen the bounds by
+    :return: Tuple with the lower and the upper bounds
+    """
+    size = operator.shape[0]
+    if size <= 64:
+        values = scipy.linalg.eigvalsh(operator @ np.eye(size))
+        lower, upper = values[0], values[-1]
+    else:
+        lower = spla.eigsh(operator, k=1, which='SA', tol=1E-4, return_eigenvectors=False)[0]
+        upper = spla.eigsh(operator, k=1, which='LA', tol=1E-4, return_eigenvectors=False)[0]
+    width = max(upper - lower, abs(upper), 1E-12)
+    return lower - margin * width, upper + margin * width
+
+
+class ChebyshevPropagator(Propagator):
+    """
+    Expands the exponential propagator in Chebyshev polynomials of the hamiltonian.
+
+    Accurate to the given tolerance for any step, larger steps need proportionally more hamiltonian
+    applications. Only hamiltonian-vector products are needed, so matrix-free operators are not assembled.
+    """
+
+    def __init__(self, hamiltonian: LinearOperator, bounds=None, tol=1E-12):
+        """
+        :param hamiltonian: Hamiltonian operator
+        :param bounds: Tuple with the lower and the upper bounds of the hamiltonian spectrum, estimated if not given
+        :param tol: Truncation threshold of the expansion coefficients
+        """
+        super().__init__(hamiltonian)
+        self.operator = self.restricted_operator()
+        lower, upper = bounds if bounds is not None else spectral_bounds(self.operator)
+        self.center = (upper + lower) / 2
+        self.radius = max((upper - lower) / 2, 1E-12)
+        self.tol = tol
+        self.coefficients = {}
+
+    def expansion(self, step):
+        """
+        :param step: Time step
+        :return: Cached array with expansion coefficients
+        """
+        if step not in self.coefficients:
+            alpha = self.radius * abs(step) / H
+            orders = np.arange(int(1.5 * alpha) + 40)
+            bessel = scipy.special.jv(orders, alpha)
+            significant = np.flatnonzero(abs(bessel) > self.tol)
+            count = significant[-1] + 1 if len(significant) else 1
+            coefficients = 2 * (-1j * np.sign(step)) ** orders[:count] * bessel[:count]
+            coefficients[0] /= 2
+            self.coefficients[step] = coefficients
+        return self.coefficients[step]
+
+    def perform_step(self, values, step):
+        coefficients = self.expansion(step)
+
+        def apply(vector):
+            return (self.operator @ vector - self.center * vector) / self.radius
+
+        result = coefficients[0] * values
+        if len(coefficients) == 1:
+            return np.exp(-1j * self.center * step / H) * result
+        previous, current = values, apply(values)
+        result += coefficients[1] * current
+        for coefficient in coefficients[2:]:
+            previous, current = current, 2 * apply(current) - previous
+            result += coefficient * current
+        return np.exp(-1j * self.center * step / H) * result
+
+
+class KrylovPropagator(Propagator):
+    """
+    Projects the exponential propagator onto the Krylov subspace built with Lanczos iterations.
+
+    Steps with too large estimated error are split in halves.
+    """
+
+    def __init__(self, hamiltonian: LinearOperator, krylov_dim=30, tol=1E-10):
+        """
+        :param hamiltonian: Hamiltonian operator
+        :param krylov_dim: Maximal dimension of the Krylov subspace
+        :param tol: Tolerance of the error estimate per step relative to the wave function norm
+        """
+        super().__init__(hamiltonian)
+        self.operator = self.restricted_operator()
+        self.krylov_dim = min(krylov_dim, self.active_count())
+        self.tol = tol
+
+    def perform_step(self, values, step):
+        norm = np.linalg.norm(values)
+        if norm == 0:
+            return values
+        basis = np.zeros((len(values), self.krylov_dim + 1), dtype=complex)
+        alphas, betas = [], []
+        basis[:, 0] = values / norm
+        for j in range(self.krylov_dim):
+            vector = self.operator @ basis[:, j]
+            alphas.append(np.vdot(basis[:, j], vector).real)
+            vector -= basis[:, :j + 1] @ (basis[:, :j + 1].conj().T @ vector)
+            betas.append(np.linalg.norm(vector))
+            if betas[-1] <= self.tol * norm * 1E-3:
+                break
+            basis[:, j + 1] = vector / betas[-1]
+        dim = len(alphas)
+        energies, vectors = scipy.linalg.eigh_tridiagonal(np.array(alphas), np.array(betas[:dim - 1]))
+        coefficients = vectors @ (np.exp(-1j * step / H * energies) * vectors[0])
+        if dim == self.krylov_dim and abs(betas[-1] * coefficients[-1]) > self.tol:
+            return self.perform_step(self.perform_step(values, step / 2), step / 2)
+        return norm * (basis[:, :dim] @ coefficients)
+
+
+class SplitOperatorPropagator(Propagator):
+    """
+    Strang splitting into potential and kinetic exponentials, second order in the time step.
+
+    The kinetic part is diagonalized exactly with FFT along looped axes and with the type I discrete
+    sine transform along bounded axes, so stencils must have no weights, and bounded axes only support
+    symmetric three-point stencils. Spectral terms of the hamiltonian are used as they are.
+    """
+
+    def __init__(self, hamiltonian: StencilOperator):
+        """
+        :param hamiltonian: StencilOperator with the potential as its diagonal, like ParticleHamiltonian
+        """
+        if not isinstance(hamiltonian, StencilOperator):
+            raise TypeError('Split-operator scheme requires a StencilOperator hamiltonian')
+        super().__init__(hamiltonian)
+        grid = hamiltonian.grid
+        active = np.ones(len(grid), dtype=bool) if self.active is None else self.active
+        mesh = grid.to_mesh(active)
+        if not np.any(mesh):
+            raise ValueError('Hamiltonian has no kinetic part')
+        self.box = tuple(slice(indices.min(), indices.max() + 1) for indices in np.nonzero(mesh))
+        if not np.all(mesh[self.box]) or np.count_nonzero(mesh) != mesh[self.box].size:
+            raise ValueError('Coupled points must form a box for split-operator scheme')
+        self.shape = mesh[self.box].shape
+        self.potential = hamiltonian.diagonal[active]
+        self.kinetic = np.zeros(self.shape, dtype=complex)
+        kinds = {}
+        for axis, offsets, coefficients, loop, weights in hamiltonian.stencils:
+            if weights is not None:
+                raise ValueError('Split-operator scheme requires stencils without weights')
+            if kinds.setdefault(axis, loop) != loop:
+                raise ValueError('Axis {} has both looped and bounded stencils'.format(axis))
+            self.kinetic += np.expand_dims(self.stencil_eigenvalues(axis, offsets, coefficients, loop),
+                                           tuple(a for a in range(len(self.shape)) if a != axis))
+        for axis, symbol in hamiltonian.spectral:
+            if not kinds.setdefault(axis, True):
+                raise ValueError('Axis {} has both looped and bounded stencils'.format(axis))
+            if self.shape[axis] != len(symbol):
+                raise ValueError('Coupled points do not match the stencils along axis {}'.format(axis))
+            self.kinetic += np.expand_dims(symbol, tuple(a for a in range(len(self.shape)) if a != axis))
+        self.fft_axes = [axis for axis, loop in kinds.items() if loop]
+        self.dst_axes = [axis for axis, loop in kinds.items() if not loop]
+        self.phases = {}
+
+    def stencil_eigenvalues(self, axis, offsets, coefficients, loop):
+        """
+        :return: Eigenvalues of a stencil along an axis in the order of FFT or DST frequencies
+        """
+        size = self.shape[axis]
+        if loop:
+            if size != self.hamiltonian.grid.sizes[axis]:
+                raise ValueError('Coupled points do not match the stencils along axis {}'.format(axis))
+            frequencies = np.arange(size)
+            return sum(c * np.exp(2j * np.pi * frequencies * o / size) for o, c in zip(offsets, coefficients))
+        if size != self.hamiltonian.grid.sizes[axis] - 2:
+            raise ValueError('Coupled points do not match the stencils along axis {}'.format(axis))
+        if any(np.ndim(c) for c in coefficients):
+            raise ValueError('Split-operator scheme does not support non-uniform axes')
+        stencil = dict(zip(offsets, coefficients))
+        if set(stencil) - {-1, 0, 1} or stencil.get(-1, 0) != stencil.get(1, 0):
+            raise ValueError('Split-operator scheme supports only symmetric three-point stencils on bounded axes')
+        frequencies = np.arange(1, size + 1)
+        return stencil.get(0, 0) + 2 * stencil.get(1, 0) * np.cos(np.pi * frequencies / (size + 1))
+
+    def phase(self, step):
+        """
+        :param step: Time step
+        :return: Cached tuple with potential half-step and kinetic step phase factors
+        """
+        if step not in self.phases:
+            self.phases[step] = np.exp(-0.5j * step / H * self.potential), np.exp(-1j * step / H * self.kinetic)
+        return self.phases[step]
+
+    def perform_step(self, values, step):
+        potential_phase, kinetic_phase = self.phase(step)
+        mesh = (potential_phase * values).reshape(self.shape, order='F')
+        if self.dst_axes:
+            mesh = scipy.fft.dstn(mesh, type=1, axes=self.dst_axes, norm='ortho')
+        if self.fft_axes:
+            mesh = scipy.fft.fftn(mesh, axes=self.fft_axes)
+        mesh *= kinetic_phase
+        if self.fft_axes:
+            mesh = scipy.fft.ifftn(mesh, axes=self.fft_axes)
+        if self.dst_axes:
+            mesh = scipy.fft.idstn(mesh, type=1, axes=self.dst_axes, norm='ortho')
+        return potential_phase * mesh.reshape(-1, order='F')
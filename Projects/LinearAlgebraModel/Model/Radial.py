@@ -0,0 +1,227 @@
+import numpy as np
+import scipy.sparse as sp
+
+from General.Grid import Grid
+from Projects.LinearAlgebraModel.Model.BaseOperators import ParticleHamiltonian, H, add_operator_mat, \
+    get_central_stencil
+from Projects.LinearAlgebraModel.Model.Equation import SchrodingerSolution, StateList, WaveFunction, \
+    normalize_columns, operator_values_errors
+from Projects.LinearAlgebraModel.Model.Spectrum import Spectrum
+
+try:
+    from scipy.special import sph_harm_y
+except ImportError:
+    sph_harm_y = None
+    from scipy.special import sph_harm
+
+
+def spherical_harmonic(l, m, theta, phi):
+    """
+    Evaluates the spherical harmonic Y_lm.
+
+    :param theta: Array with polar angles
+    :param phi: Array with azimuthal angles
+    :return: Array with complex values
+    """
+    if sph_harm_y is not None:
+        return sph_harm_y(l, m, theta, phi)
+    return sph_harm(m, l, phi, theta)
+
+
+def radial_grid(r_max, size):
+    """
+    Creates a grid of radii from 0 to r_max.
+
+    :param r_max: Maximal radius, wave functions vanish there
+    :param size: Number of points
+    :return: Single-dimensional Grid object
+    """
+    return Grid([(0, r_max)], [size])
+
+
+def central_hamiltonian(hamiltonian_class, *args, **kwargs):
+    """
+    Creates a hamiltonian with a central potential on a single point grid, only to evaluate its potential.
+
+    :param hamiltonian_class: ParticleHamiltonian subclass with a spherically symmetric potential, like Coulomb
+    :return: Hamiltonian object
+    """
+    return hamiltonian_class(Grid([(1, 2)] * 3, [1] * 3), *args, matrix_free=True, cache=False, **kwargs)
+
+
+class RadialHamiltonian(ParticleHamiltonian):
+    """
+    Represents the radial part of the hamiltonian of a particle in a central potential for given angular momentum.
+
+    Acts on u(r) = r R(r), where the wave function is R(r) Y_lm(theta, phi), and includes the centrifugal term
+    H^2 l (l + 1) / (2 m r^2). The grid of radii should start at 0, so u vanishes there.
+    Wider stencils reach beyond the origin, where u is continued as an odd function.
+    """
+
+    def __init__(self, grid: Grid, central: ParticleHamiltonian, l, **kwargs):
+        """
+        :param grid: Single-dimensional grid of radii
+        :param central: Hamiltonian of the particle with a central potential, see central_hamiltonian
+        :param l: Angular momentum
+        """
+        if grid.dimensions() != 1:
+            raise ValueError('Grid must be single-dimensional')
+        self.central = central
+        self.l = l
+        super(RadialHamiltonian, self).__init__(grid, central.m, **kwargs)
+        self.__reflection = self.__origin_reflection_mat()
+        if not self.is_matrix_free() and self.__reflection.nnz:
+            self.mat = add_operator_mat(self.mat, self.__reflection)
+
+    def __origin_reflection_mat(self):
+        """
+        Generates the matrix of the kinetic energy stencil parts that reach beyond the origin, with u(-r) = -u(r).
+        """
+        size = self.grid.sizes[0]
+        rows, cols, data = [], [], []
+        if self.grid.bounds[0][0] == 0 and size > 2 and self.order > 2:
+            offsets, coefficients = get_central_stencil(2, self.order, self.grid.grid_step(0), - H ** 2 / (self.m * 2))
+            for offset, coefficient in zip(offsets, coefficients):
+                for row in range(1, min(-offset, size - 1)):
+                    rows.append(row)
+                    cols.append(-row - offset)
+                    data.append(-coefficient)
+        return sp.csr_array((data, (rows, cols)), shape=(size, size))
+
+    def _materialize(self):
+        return sp.csr_array(super(RadialHamiltonian, self)._materialize() + self.__reflection)
+
+    def matmat(self, vectors):
+        result = super(RadialHamiltonian, self).matmat(vectors)
+        if self.is_matrix_free() and self.__reflection.nnz:
+            result = result + self.__reflection @ np.asarray(vectors)
+        return result
+
+    def get_potential(self, x: list) -> np.ndarray:
+        r = np.asarray(x[0], dtype=float)
+        zeros = np.zeros_like(r)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            potential = self.central.get_potential([r, zeros, zeros]) + \
+                        H ** 2 * self.l * (self.l + 1) / (2 * self.m * r ** 2)
+        # Singularities at the origin, where the wave function vanishes
+        return np.where(np.isfinite(potential), potential, 0)
+
+
+class RadialSolution:
+    """
+    A structure that contains eigenstates of a particle in a central potential, found by separation of variables.
+
+    The radial equation is solved for every angular momentum l, then every radial state gives 2 l + 1 states
+    with m from -l to l. States are labeled by (n, l, m) with the principal quantum number n = n_r + l + 1,
+    where n_r is the number of the radial state.
+    """
+
+    def __init__(self, central: ParticleHamiltonian, grid: Grid, l_max, n_states=None, cache=None, **kwargs):
+        """
+        :param central: Hamiltonian of the particle with a central potential, see central_hamiltonian
+        :param grid: Single-dimensional grid of radii, see radial_grid
+        :param l_max: Maximal angular momentum
+        :param n_states: Number of radial states to find for every l, all are found if not specified
+        :param cache: DiskCache object, None for the default cache, False to disable caching
+        :param kwargs: RadialHamiltonian arguments, like sparse or order
+        """
+        self.central = central
+        self.grid = grid
+        self.l_max = l_max
+        self.radial = []
+        values, errors, numbers = [], [], []
+        for l in range(l_max + 1):
+            hamiltonian = RadialHamiltonian(grid, central, l, cache=cache, **kwargs)
+            sol = SchrodingerSolution(hamiltonian=hamiltonian, grid=grid, n_states=n_states, cache=cache)
+            energies, energy_errors = operator_values_errors(sol.vectors, hamiltonian)
+            self.radial.append(sol)
+            for n_r in range(len(sol.values)):
+                for m in range(-l, l + 1):
+                    values.append(sol.values[n_r])
+                    errors.append(energy_errors[n_r])
+                    numbers.append((n_r + l + 1, l, m))
+        order = np.argsort(np.real(values), kind='stable')
+        self.values = np.array(values)[order]
+        self.errors = np.array(errors)[order]
+        self.quantum_numbers = np.array(numbers, dtype=int).reshape((-1, 3))[order]
+        self.alias = 'Radial{}_l{}_({},{},{})'.format(type(central).__name__, l_max, *grid.bounds[0], grid.sizes[0])
+
+    def radial_function(self, n, l):
+        """
+        Obtains R(r) = u(r) / r of a radial state on the grid of radii, normalized by the integral of R^2 r^2.
+
+        :param n: Principal quantum number
+        :param l: Angular momentum
+        :return: Array ordered by point indices
+        """
+        u = np.asarray(self.radial[l].vectors[:, n - l - 1]) / np.sqrt(self.grid.cell_volumes())
+        r = self.grid.axis_coordinates(0)
+        values = np.divide(u, r, out=np.zeros(len(u), dtype=u.dtype), where=r > 0)
+        if l == 0 and r[0] == 0:
+            values[0] = values[1]
+        return values
+
+    def wave_function(self, index, grid: Grid):
+        """
+        Reconstructs an eigenstate on a three-dimensional Cartesian grid.
+
+        :param index: Index of the state ordered by energy
+        :param grid: Three-dimensional Grid object
+        :return: WaveFunction object labeled by (n, l, m)
+        """
+        n, l, m = (int(number) for number in self.quantum_numbers[index])
+        return WaveFunction(grid, self.__state_values(n, l, m, grid), label=(n, l, m))
+
+    def states(self, grid: Grid, indices=None):
+        """
+        Reconstructs eigenstates on a three-dimensional Cartesian grid.
+
+        :param grid: Three-dimensional Grid object
+        :param indices: Indices of the states ordered by energy, all states if not specified
+        :return: StateList object with states labeled by (n, l, m)
+        """
+        if indices is None:
+            indices = range(len(self))
+        labels = [tuple(int(number) for number in self.quantum_numbers[i]) for i in indices]
+        vectors = np.zeros((len(grid), len(labels)), dtype=complex)
+        for column, (n, l, m) in enumerate(labels):
+            vectors[:, column] = self.__state_values(n, l, m, grid)
+        return StateList(grid, normalize_columns(vectors), labels)
+
+    def __state_values(self, n, l, m, grid: Grid):
+        if grid.dimensions() != 3:
+            raise ValueError('Grid must be three-dimensional')
+        x, y, z = grid.coordinate_columns()
+        r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+        theta = np.arccos(np.divide(z, r, out=np.ones_like(r), where=r > 0))
+        phi = np.arctan2(y, x)
+        radial = np.interp(r, self.grid.axis_coordinates(0), self.radial_function(n, l), right=0)
+        values = radial * spherical_harmonic(l, m, theta, phi)
+        if not grid.is_uniform():
+            # Values on non-uniform grids are stored weighted, see NonUniformGrid
+            values = values * np.sqrt(grid.cell_volumes())
+        return values
+
+    def spectrum(self):
+        """
+        Creates a spectrum of the energy, squared angular momentum and its projection on the z axis.
+        Entries are labeled by (n, l, m) and named like the operators of a three-dimensional solution,
+        the angular momentum values are exact.
+
+        :return: Spectrum object
+        """
+        l, m = self.quantum_numbers[:, 1], self.quantum_numbers[:, 2]
+        exact = np.zeros(len(self))
+        return Spectrum(values={type(self.central).__name__: self.values,
+                                'TorqueSquaredOperator': H ** 2 * l * (l + 1),
+                                'TorqueOperator': H * m},
+                        errors={type(self.central).__name__: self.errors,
+                                'TorqueSquaredOperator': exact,
+                                'TorqueOperator': exact},
+                        labels=[tuple(int(number) for number in numbers) for numbers in self.quantum_numbers])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __str__(self):
+        return self.alias
@@ -1,12 +1,31 @@
 import csv
 
+import numpy as np
+
+from General import Instrumentation
+from General.Instrumentation import current_span, traced
 from General.Utils import ProgressInformer
-from Projects.LinearAlgebraModel.Model.Equation import naive_operator_value_error
+from Projects.LinearAlgebraModel.Model.Cache import cached, operator_key
+from Projects.LinearAlgebraModel.Model.Equation import naive_operator_values_errors, operator_values_errors
+
+
+def is_error_too_large(value, error):
+    """
+    Checks if the operator value error is too large to consider the state its eigenstate.
+    Accepts both single values and arrays.
+
+    :param value: Operator value
+    :param error: Operator value error
+    :return: True if error is too large
+    """
+    value, error = np.abs(value), np.abs(error)
+    return ((error / 100 > value) & (value > 0.1)) | ((error > 1) & (value < 0.1))
 
 
 class SpectrumEntry:
-    def __init__(self, tol, **kw):
+    def __init__(self, tol, label=None, **kw):
         self.rel_tolerance = tol
+        self.label = label
         self.operator_values = {}
         for operator_alias in kw:
             value, error = kw[operator_alias]['value'], kw[operator_alias]['error']
@@ -29,9 +48,37 @@ class SpectrumEntry:
         return False
 
 
+def tolerance_groups(values, errors, rel_tolerance=1, atol=0., groups=None):
+    """
+    Splits states into groups of close values: neighbours by value belong to one group if they differ by no more
+    than rel_tolerance times the sum of their errors plus atol. Existing groups are only split further.
+
+    :param values: Array with operator values
+    :param errors: Array with operator value errors
+    :param rel_tolerance: Tolerance coefficient
+    :param atol: Absolute tolerance
+    :param groups: Array with group ids of previously compared values, all states in one group if not specified
+    :return: Array with group ids, ordered like the groups and by the real parts of values within them
+    """
+    values, errors = np.asarray(values), np.abs(np.asarray(errors))
+    if groups is None:
+        groups = np.zeros(len(values), dtype=int)
+    order = np.lexsort((values.real, groups))
+    values, errors, groups = values[order], errors[order], groups[order]
+    new_group = np.ones(len(values), dtype=bool)
+    new_group[1:] = (groups[1:] != groups[:-1]) | \
+                    (np.abs(np.diff(values)) > rel_tolerance * (errors[1:] + errors[:-1]) + atol)
+    ids = np.empty(len(values), dtype=int)
+    ids[order] = np.cumsum(new_group) - 1
+    return ids
+
+
 class Spectrum:
     """
     A structure that contains operator spectrum data and implements methods to analyze it.
+
+    Data is stored by columns: an array of values and an array of errors for every operator, indexed by states.
+    Iteration and the entry method present states as SpectrumEntry objects.
     """
 
     def __init__(self, **kwargs):
@@ -41,12 +88,15 @@ class Spectrum:
         :key solution: Solution object to obtain spectrum from
         :key operators: List of Operators to evaluate
         :key operator: The same if only one operator is needed
+        :key naive: True to estimate operator values with naive_operator_values_errors
+        :key cache: DiskCache object to load operator values from, None for the default cache, False to disable
         :key filename: Filename to load spectrum data from
+        :key values: Dictionary with arrays of values by operator aliases, used with errors
+        :key errors: Dictionary with arrays of value errors by operator aliases
+        :key labels: List with labels of the states, used with values
         """
-        if 'naive' in kwargs:
-            naive = kwargs['naive']
-        else:
-            naive = False
+        naive = kwargs.get('naive', False)
+        self.values, self.errors, self.labels = {}, {}, None
 
         if 'solution' in kwargs:
             sol = kwargs['solution']
@@ -57,86 +107,186 @@ class Spectrum:
             else:
                 raise KeyError('No operators passed, cannot create empty spectrum object')
 
-            p = ProgressInformer(caption='Evaluating spectrum', length=40)
-            counter = 0
-            self.entries = []
-            for wf in sol.states:
-                kw = {}
-                for operator in ops:
-                    value, error = naive_operator_value_error(wf, operator) if naive else wf.operator_value_error(
-                        operator)
-                    if value is None or error is None:
-                        break  # Failed to calculate value / error
-                    if abs(error) / 100 > abs(value) > 0.1 or (abs(error) > 1 and abs(value) < 0.1):
-                        break  # Too large error
-                    kw[type(operator).__name__] = {'value': value, 'error': error}
-                else:
-                    self.entries.append(SpectrumEntry(1, **kw))
-                counter += 1
-                p.report_progress(counter / len(sol.states))
-            p.finish()
+            self.__evaluate_batched(sol, ops, naive, kwargs.get('cache'))
         elif 'filename' in kwargs:
-            with open(kwargs['filename']) as spectrum_reader:
+            with Instrumentation.span('spectrum_load', filename=kwargs['filename']), \
+                    open(kwargs['filename']) as spectrum_reader:
                 reader = csv.reader(spectrum_reader)
                 length = int(reader.__next__()[0])
                 operator_aliases = reader.__next__()
-                data_dict = {}
                 for alias in operator_aliases:
-                    data_dict.update({alias: {
-                        'values': [complex(a) for a in reader.__next__()],
-                        'errors': [complex(a).real for a in reader.__next__()]
-                    }})
-                self.entries = [SpectrumEntry(1, **{alias: {
-                    'value': data_dict[alias]['values'][i],
-                    'error': data_dict[alias]['errors'][i]}
-                    for alias in data_dict}) for i in range(length)]
+                    self.values[alias] = np.array([complex(a) for a in reader.__next__()], dtype=complex)
+                    self.errors[alias] = np.array([complex(a).real for a in reader.__next__()], dtype=float)
+                    if len(self.values[alias]) != length:
+                        raise ValueError('Spectrum file is corrupted')
+        elif 'values' in kwargs:
+            self.__set_columns(kwargs['values'], kwargs['errors'], kwargs.get('labels'))
         elif '__list' in kwargs:
-            self.entries = kwargs['__list']
+            entries = kwargs['__list']
+            aliases = entries[0].operators() if len(entries) != 0 else []
+            self.__set_columns({alias: [e[alias][0] for e in entries] for alias in aliases},
+                               {alias: [e[alias][1] for e in entries] for alias in aliases},
+                               [e.label for e in entries] if any(e.label is not None for e in entries) else None)
+
+    def __set_columns(self, values, errors, labels=None):
+        self.values = {alias: np.asarray(values[alias], dtype=complex) for alias in values}
+        self.errors = {alias: np.asarray(errors[alias], dtype=float) for alias in values}
+        if labels is not None:
+            self.labels = np.empty(len(labels), dtype=object)
+            for i, label in enumerate(labels):
+                self.labels[i] = label
+
+    @traced('spectrum')
+    def __evaluate_batched(self, sol, ops, naive=False, cache=None):
+        """
+        Evaluates values and errors of all operators for all states with matrix-matrix products
+        and keeps the states with acceptable errors.
+
+        :param sol: Solution object
+        :param ops: List of Operators to evaluate
+        :param naive: True to estimate operator values with naive_operator_values_errors
+        :param cache: DiskCache object, None for the default cache, False to disable caching
+        """
+        p = ProgressInformer(caption='Evaluating spectrum', length=40)
+        values, errors = {}, {}
+        accepted = np.ones(len(sol.states), dtype=bool)
+        for i, operator in enumerate(ops):
+            def evaluate():
+                if naive:
+                    operator_values, operator_errors = naive_operator_values_errors(sol.grid, sol.vectors, operator)
+                else:
+                    operator_values, operator_errors = operator_values_errors(sol.vectors, operator)
+                return {'values': operator_values, 'errors': operator_errors}
+
+            key = None
+            if getattr(sol, 'key', None) is not None:
+                key = operator_key(operator, kind='spectrum', solution=sol.key, naive=naive)
+            alias = type(operator).__name__
+            with Instrumentation.span('operator_values', operator=alias, states=len(sol.states)):
+                evaluated = cached(key, evaluate, cache)
+            values[alias], errors[alias] = np.asarray(evaluated['values']), np.real(evaluated['errors'])
+            accepted &= ~np.isnan(errors[alias]) & ~is_error_too_large(values[alias], errors[alias])
+            p.report_progress((i + 1) / len(ops))
+        p.finish()
+        current_span().set(operators=len(ops), states=len(sol.states), accepted=int(accepted.sum()))
+        labels = getattr(sol.states, 'labels', None)
+        self.__set_columns({alias: values[alias][accepted] for alias in values},
+                           {alias: errors[alias][accepted] for alias in errors},
+                           [labels[i] for i in np.flatnonzero(accepted)] if labels is not None else None)
 
     def operators(self):
-        return self.entries[0].operators() if len(self.entries) != 0 else []
+        return list(self.values)
 
+    @traced('spectrum_dump')
     def dump(self, filename):
         """
         Dumps spectrum data to file.
 
         :param filename: Filename to write spectrum data to
         """
+        current_span().set(filename=filename, states=len(self))
         with open(filename, 'w') as spectrum_writer:
             writer = csv.writer(spectrum_writer)
             writer.writerow([len(self)])
             writer.writerow(self.operators())
             for alias in self.operators():
-                values = [e[alias][0] for e in self.entries]
-                errors = [e[alias][1] for e in self.entries]
-                writer.writerows((values, errors))
+                writer.writerows((self.values[alias].tolist(), self.errors[alias].tolist()))
+
+    def entry(self, index):
+        """
+        :param index: State index
+        :return: SpectrumEntry object with the state data
+        """
+        return SpectrumEntry(1, label=self.labels[index] if self.labels is not None else None, **{
+            alias: {'value': complex(self.values[alias][index]), 'error': float(self.errors[alias][index])}
+            for alias in self.values})
+
+    @property
+    def entries(self):
+        return [self.entry(i) for i in range(len(self))]
+
+    def take(self, indices):
+        """
+        Creates new Spectrum instance with selected states.
+
+        :param indices: Array with state indices or boolean mask ordered by states
+        :return: Spectrum instance
+        """
+        indices = np.asarray(indices)
+        return Spectrum(values={alias: self.values[alias][indices] for alias in self.values},
+                        errors={alias: self.errors[alias][indices] for alias in self.errors},
+                        labels=self.labels[indices] if self.labels is not None else None)
 
     def slice(self, rule):
         """
         Creates new Spectrum instance with states that match given rule.
 
-        :param rule: A function that accepts state data as SpectrumEntry object.
-          Must return True if state matches condition, False otherwise.
+        :param rule: Boolean mask ordered by states, built from the value and error columns,
+          like spectrum.values['Harmonic'].real < 5. Or a function that accepts state data as SpectrumEntry object,
+          which must return True if state matches condition, False otherwise
         :return: Spectrum instance
         """
-        new_list = [e for e in self.entries if rule(e)]
-        return Spectrum(__list=new_list)
+        if callable(rule):
+            rule = np.array([bool(rule(self.entry(i))) for i in range(len(self))], dtype=bool)
+        return self.take(rule)
 
-    def sort(self, rel_tolerance=1):
+    def sort_indices(self, rel_tolerance=1, operators=None, atol=0.):
         """
-        Sorts spectrum entries according to their eigenvalues.
+        Orders states lexicographically by operator values: values that are equal within tolerance,
+        see tolerance_groups, are ordered by values of the next operator.
 
         :param rel_tolerance: Tolerance coefficient
+        :param operators: List of operator aliases to compare by, all operators if not specified
+        :param atol: Absolute tolerance
+        :return: Array with state indices
+        """
+        groups = np.zeros(len(self), dtype=int)
+        for alias in operators if operators is not None else self.operators():
+            groups = tolerance_groups(self.values[alias], self.errors[alias], rel_tolerance, atol, groups)
+        return np.argsort(groups, kind='stable')
+
+    def sort(self, rel_tolerance=1, operators=None, atol=0.):
+        """
+        Sorts spectrum entries according to their eigenvalues, see sort_indices.
+
+        :param rel_tolerance: Tolerance coefficient
+        :param operators: List of operator aliases to compare by, all operators if not specified
+        :param atol: Absolute tolerance
+        """
+        order = self.sort_indices(rel_tolerance, operators, atol)
+        self.values = {alias: self.values[alias][order] for alias in self.values}
+        self.errors = {alias: self.errors[alias][order] for alias in self.errors}
+        if self.labels is not None:
+            self.labels = self.labels[order]
+
+    def multiplets(self, operators=None, rel_tolerance=1, atol=0.):
+        """
+        Groups states into degenerate multiplets: states with values equal within tolerance, see tolerance_groups.
+
+        :param operators: List of operator aliases to compare by, the first operator if not specified
+        :param rel_tolerance: Tolerance coefficient
+        :param atol: Absolute tolerance
+        :return: List of arrays with state indices, ordered by values
+        """
+        if operators is None:
+            operators = self.operators()[:1]
+        groups = np.zeros(len(self), dtype=int)
+        for alias in operators:
+            groups = tolerance_groups(self.values[alias], self.errors[alias], rel_tolerance, atol, groups)
+        order = np.argsort(groups, kind='stable')
+        return np.split(order, np.flatnonzero(np.diff(groups[order])) + 1) if len(self) else []
+
+    def degeneracies(self, operators=None, rel_tolerance=1, atol=0.):
+        """
+        :return: Array with sizes of degenerate multiplets, see multiplets
         """
-        for e in self.entries:
-            e.rel_tolerance = rel_tolerance
-        self.entries.sort()
+        return np.array([len(multiplet) for multiplet in self.multiplets(operators, rel_tolerance, atol)], dtype=int)
 
     def __len__(self):
-        return len(self.entries)
+        return len(next(iter(self.values.values()))) if self.values else 0
 
     def __getitem__(self, operator_alias):
-        return [e[operator_alias][0] for e in self.entries], [e[operator_alias][1] for e in self.entries]
+        return self.values[operator_alias], self.errors[operator_alias]
 
     def __iter__(self):
-        return iter(self.entries)
+        return (self.entry(i) for i in range(len(self)))
@@ -0,0 +1,254 @@
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import numpy as np
+
+from General.Utils import ProgressInformer
+from Projects.LinearAlgebraModel.Model.Equation import SchrodingerSolution
+from Projects.LinearAlgebraModel.Model.Spectrum import Spectrum
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+class SweepResult:
+    """
+    Result of solving a hamiltonian for a single point of a parameter sweep.
+    """
+
+    def __init__(self, index, hamiltonian, parameters: dict, grid_parameters: dict, alias, values,
+                 spectrum: Spectrum = None):
+        """
+        :param index: Index of the point in the sweep
+        :param hamiltonian: Name of the hamiltonian class
+        :param parameters: Hamiltonian parameters
+        :param grid_parameters: Arguments the grid was created with
+        :param alias: Solution alias
+        :param values: Array with energies
+        :param spectrum: Spectrum of the solution with the hamiltonian as the first operator,
+          None if no operators were evaluated
+        """
+        self.index = index
+        self.hamiltonian = hamiltonian
+        self.parameters = parameters
+        self.grid_parameters = grid_parameters
+        self.alias = alias
+        self.values = values
+        self.spectrum = spectrum
+
+    def __str__(self):
+        return self.alias
+
+
+class SweepResults:
+    """
+    Combined result set of a parameter sweep, filled in the order the points are solved.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def append(self, result: SweepResult):
+        self.results.append(result)
+
+    def ordered(self):
+        """
+        :return: List of results in the order of sweep points
+        """
+        return sorted(self.results, key=lambda result: result.index)
+
+    def where(self, **parameters):
+        """
+        Selects results with given hamiltonian or grid parameter values.
+
+        :return: List of SweepResult objects in the order of sweep points
+        """
+        return [result for result in self.ordered()
+                if all({**result.grid_parameters, **result.parameters}.get(name) == value
+                       for name, value in parameters.items())]
+
+    def dump(self, filename):
+        """
+        Dumps energies and operator values of all states to a CSV table, one row per state.
+
+        :param filename: Filename to write results to
+        """
+        results = self.ordered()
+        parameter_names = sorted({name for result in results for name in result.parameters})
+        grid_names = sorted({name for result in results for name in result.grid_parameters})
+        aliases = []
+        for result in results:
+            for alias in [result.hamiltonian] + (result.spectrum.operators() if result.spectrum is not None else []):
+                if alias not in aliases:
+                    aliases.append(alias)
+        with open(filename, 'w') as sweep_writer:
+            writer = csv.writer(sweep_writer)
+            writer.writerow(parameter_names + grid_names +
+                            [column for alias in aliases for column in (alias, alias + '_error')])
+            for result in results:
+                prefix = [result.parameters.get(name) for name in parameter_names] + \
+                         [result.grid_parameters.get(name) for name in grid_names]
+                if result.spectrum is None:
+                    rows = [{result.hamiltonian: (value, '')} for value in result.values]
+                else:
+                    rows = [{alias: entry[alias] for alias in entry.operators()} for entry in result.spectrum]
+                writer.writerows(prefix + [part for alias in aliases for part in row.get(alias, ('', ''))]
+                                 for row in rows)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+
+def parameter_points(space):
+    """
+    Expands a parameter space into the list of its points.
+
+    :param space: Dictionary with a list of values for every parameter to take all combinations of,
+      or a list of dictionaries with parameter values
+    :return: List of dictionaries with parameter values
+    """
+    if space is None:
+        return [{}]
+    if isinstance(space, dict):
+        names = list(space)
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    return [dict(point) for point in space]
+
+
+@contextmanager
+def blas_threads_environment(threads):
+    """
+    Sets the number of BLAS threads for processes started within the context.
+
+    :param threads: Number of threads per process
+    """
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def init_worker(threads, quiet=True):
+    """
+    Prepares a worker process: limits BLAS threads of already loaded libraries and silences progress output.
+
+    :param threads: Number of BLAS threads
+    :param quiet: True to discard the output of the worker
+    """
+    if threadpool_limits is not None:
+        init_worker.limits = threadpool_limits(threads)
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+
+def solve_point(index, hamiltonian_class, parameters, grid_factory, grid_parameters, operators=(),
+                hamiltonian_kwargs=None, solver_kwargs=None, naive=False, cache=None):
+    """
+    Assembles and solves the hamiltonian for a single point of a sweep, then evaluates the spectrum.
+
+    The hamiltonian itself is evaluated along with the operators, so the spectrum has energies of the states
+    it accepts.
+
+    :return: SweepResult object
+    """
+    grid = grid_factory(**grid_parameters)
+    hamiltonian = hamiltonian_class(grid, **parameters, cache=cache, **(hamiltonian_kwargs or {}))
+    sol = SchrodingerSolution(hamiltonian=hamiltonian, grid=grid, cache=cache, **(solver_kwargs or {}))
+    spectrum = None
+    if operators:
+        spectrum = Spectrum(solution=sol, operators=[hamiltonian] + [operator(grid) for operator in operators],
+                            naive=naive, cache=cache)
+    return SweepResult(index, hamiltonian_class.__name__, parameters, grid_parameters, sol.alias, np.array(sol.values), spectrum)
+
+
+def iter_sweep(hamiltonian_class, parameters, grid_factory, grid_parameters=None, operators=(), workers=None,
+               blas_threads=1, hamiltonian_kwargs=None, solver_kwargs=None, naive=False, cache=None, verbose=True):
+    """
+    Solves a family of hamiltonians over all combinations of parameter values and grids in a process pool,
+    yielding results as soon as workers finish them.
+
+    Worker processes are spawned, so the hamiltonian class, the grid factory and operator classes must be
+    importable, not defined in the __main__ script or as lambdas. Each worker uses blas_threads BLAS threads,
+    keep workers * blas_threads within the number of cores. The environment of the calling process is only
+    changed while workers are started. Closing the generator early cancels the points not started yet.
+
+    :param hamiltonian_class: ParticleHamiltonian subclass, called as hamiltonian_class(grid, **parameters)
+    :param parameters: Hamiltonian parameter space, see parameter_points
+    :param grid_factory: Function that creates a Grid object from grid parameters
+    :param grid_parameters: Grid parameter space, see parameter_points
+    :param operators: List of operator classes or functions that accept grid, to evaluate spectra with
+    :param workers: Number of worker processes, cores divided by blas_threads if not specified,
+      1 to solve in the current process
+    :param blas_threads: Number of BLAS threads per worker
+    :param hamiltonian_kwargs: Additional hamiltonian arguments, like sparse or matrix_free
+    :param solver_kwargs: SchrodingerSolution arguments, like n_states
+    :param naive: True to estimate operator values with naive_operator_values_errors
+    :param cache: DiskCache object shared by workers, None for the default cache of every worker process.
+      Spawned workers only have a default cache if set_default_cache is called when a module they import
+      is imported, like the module of the hamiltonian class, not in the __main__ script
+    :param verbose: False to hide the progress bar
+    :return: Generator of SweepResult objects in the order they are solved
+    """
+    points = [(p, g) for g in parameter_points(grid_parameters) for p in parameter_points(parameters)]
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // blas_threads)
+    workers = min(workers, len(points))
+    tasks = [(index, hamiltonian_class, p, grid_factory, g, tuple(operators), hamiltonian_kwargs, solver_kwargs,
+              naive, cache) for index, (p, g) in enumerate(points)]
+    progress = ProgressInformer(caption='Sweeping parameters', length=40, max=len(points), verbose=verbose)
+    if workers <= 1:
+        for task in tasks:
+            yield solve_point(*task)
+            progress.report_increment()
+        progress.finish()
+        return
+    # Workers copy the environment when they are spawned, all of them are spawned by the time tasks are submitted
+    with blas_threads_environment(blas_threads):
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_worker, initargs=(blas_threads,))
+        try:
+            futures = [executor.submit(solve_point, *task) for task in tasks]
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+            progress.report_increment()
+    finally:
+        executor.shutdown(cancel_futures=True)
+    progress.finish()
+
+
+def sweep(hamiltonian_class, parameters, grid_factory, grid_parameters=None, operators=(), callback=None, **kwargs):
+    """
+    Solves a family of hamiltonians over a parameter space and collects the results, see iter_sweep.
+
+    :param callback: Function called with every SweepResult as soon as it is solved
+    :return: SweepResults object
+    """
+    results = SweepResults()
+    for result in iter_sweep(hamiltonian_class, parameters, grid_factory, grid_parameters, operators, **kwargs):
+        results.append(result)
+        if callback is not None:
+            callback(result)
+    return results
@@ -0,0 +1,234 @@
+import itertools
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from General.Grid import Grid
+from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator
+
+AXIS_NAMES = 'xyz'
+
+
+def axis_name(axis):
+    return AXIS_NAMES[axis] if axis < len(AXIS_NAMES) else str(axis)
+
+
+class Symmetry:
+    """
+    A symmetry operation of a grid: a permutation of its points that is its own inverse,
+    like a reflection along an axis or a transposition of two axes.
+    """
+
+    def __init__(self, name, indices):
+        """
+        :param name: Short name used in state labels
+        :param indices: Array with the index of the image of every grid point
+        """
+        indices = np.asarray(indices)
+        if not np.array_equal(indices[indices], np.arange(len(indices))):
+            raise ValueError('Symmetry {} is not an involution'.format(name))
+        self.name = name
+        self.indices = indices
+
+    def apply(self, vectors):
+        """
+        :param vectors: Array with wave function values ordered by point indices, or a matrix with them as columns
+        :return: Transformed array
+        """
+        return vectors[self.indices]
+
+    def commutes(self, other):
+        return np.array_equal(self.indices[other.indices], other.indices[self.indices])
+
+    def __str__(self):
+        return self.name
+
+
+def reflection(grid: Grid, axis):
+    """
+    :return: Symmetry that mirrors the grid along given axis
+    """
+    return Symmetry('P' + axis_name(axis), grid.reflection_indices(axis))
+
+
+def transposition(grid: Grid, axis_a, axis_b):
+    """
+    :return: Symmetry that swaps coordinates by two axes of equal size
+    """
+    return Symmetry('T' + axis_name(axis_a) + axis_name(axis_b), grid.transposition_indices(axis_a, axis_b))
+
+
+def grid_symmetries(grid: Grid):
+    """
+    Lists symmetry operations of a grid that an operator may be invariant under: reflections along every axis
+    and transpositions of axes with equally spaced points.
+
+    :param grid: Grid object
+    :return: List of Symmetry objects, reflections first
+    """
+    dimensions = grid.dimensions()
+    symmetries = [reflection(grid, axis) for axis in range(dimensions) if grid.sizes[axis] > 1]
+    for axis_a, axis_b in itertools.combinations(range(dimensions), 2):
+        coordinates_a, coordinates_b = grid.axis_coordinates(axis_a), grid.axis_coordinates(axis_b)
+        if grid.sizes[axis_a] == grid.sizes[axis_b] > 1 and \
+                np.allclose(coordinates_a - coordinates_a[0], coordinates_b - coordinates_b[0]):
+            symmetries.append(transposition(grid, axis_a, axis_b))
+    return symmetries
+
+
+def is_invariant(operator: LinearOperator, symmetry: Symmetry, tol=1E-9, probes=2):
+    """
+    Checks if an operator commutes with a symmetry operation by applying both to random wave functions.
+
+    :param operator: Operator object
+    :param symmetry: Symmetry object
+    :param tol: Relative tolerance
+    :param probes: Number of random wave functions
+    :return: True if the operator is invariant
+    """
+    vectors = np.random.default_rng(0).standard_normal((len(operator.grid), probes))
+    expected = symmetry.apply(operator.matmat(vectors))
+    return np.linalg.norm(operator.matmat(symmetry.apply(vectors)) - expected) <= tol * np.linalg.norm(expected)
+
+
+class SymmetryGroup:
+    """
+    Abelian group generated by commuting symmetry operations.
+
+    Irreducible representations of the group are its characters: choices of the eigenvalue +1 or -1
+    for every generator. The space of wave functions splits into orthogonal subspaces, one per character,
+    and an invariant operator maps every subspace onto itself.
+    """
+
+    def __init__(self, grid: Grid, generators=()):
+        """
+        :param grid: Grid object
+        :param generators: List of commuting Symmetry objects of the grid
+        """
+        generators = list(generators)
+        for generator in generators:
+            if len(generator.indices) != len(grid):
+                raise ValueError('Symmetry {} does not correspond to grid size'.format(generator))
+        for a, b in itertools.combinations(generators, 2):
+            if not a.commutes(b):
+                raise ValueError('Symmetries {} and {} do not commute'.format(a, b))
+        self.grid = grid
+        self.generators = generators
+        if generators:
+            self.exponents = np.array(list(itertools.product((0, 1), repeat=len(generators))), dtype=int)
+        else:
+            # Trivial group of the identity alone
+            self.exponents = np.zeros((1, 0), dtype=int)
+        self.images = np.empty((len(self.exponents), len(grid)), dtype=int)
+        for row, exponents in enumerate(self.exponents):
+            indices = np.arange(len(grid))
+            for generator, exponent in zip(generators, exponents):
+                if exponent:
+                    indices = generator.indices[indices]
+            self.images[row] = indices
+        if len(np.unique(self.images, axis=0)) != len(self.images):
+            raise ValueError('Symmetry generators are not independent')
+
+    @classmethod
+    def detect(cls, operator: LinearOperator, candidates=None, tol=1E-9):
+        """
+        Finds a group of symmetries the operator is invariant under, taking candidates in order
+        as long as they commute with the ones already taken.
+
+        :param operator: Operator object
+        :param candidates: List of Symmetry objects to check, see grid_symmetries if not specified
+        :param tol: Relative tolerance of the invariance check
+        :return: SymmetryGroup object
+        """
+        if candidates is None:
+            candidates = grid_symmetries(operator.grid)
+        generators = []
+        for candidate in candidates:
+            if all(candidate.commutes(generator) for generator in generators) and \
+                    is_invariant(operator, candidate, tol):
+                try:
+                    cls(operator.grid, generators + [candidate])
+                except ValueError:
+                    continue
+                generators.append(candidate)
+        return cls(operator.grid, generators)
+
+    def order(self):
+        """
+        :return: Number of group elements
+        """
+        return len(self.images)
+
+    def names(self):
+        return [generator.name for generator in self.generators]
+
+    def characters(self):
+        """
+        :return: List of characters, tuples with eigenvalues of the generators
+        """
+        return list(itertools.product((1, -1), repeat=len(self.generators)))
+
+    def label(self, character):
+        """
+        :param character: Tuple with eigenvalues of the generators
+        :return: Label like 'Px+Py-'
+        """
+        return ''.join(name + ('+' if value > 0 else '-') for name, value in zip(self.names(), character))
+
+    def orbit_basis(self, character, points=None):
+        """
+        Builds an orthonormal basis of the wave functions that transform by given character.
+        Every basis vector is supported on a single orbit of grid points.
+
+        :param character: Tuple with eigenvalues of the generators
+        :param points: Boolean array ordered by point indices, selects orbits to use. Must be invariant
+        :return: Real sparse matrix with basis vectors as columns
+        """
+        indices = np.arange(len(self.grid)) if points is None else np.flatnonzero(points)
+        representatives = np.unique(self.images[:, indices].min(axis=0))
+        signs = np.prod(np.where(self.exponents == 1, np.asarray(character, dtype=int), 1), axis=1)
+        count = len(representatives)
+        basis = sp.csc_array((np.repeat(signs, count).astype(float),
+                              (self.images[:, representatives].ravel(),
+                               np.tile(np.arange(count), self.order()))), shape=(len(self.grid), count))
+        basis.sum_duplicates()
+        norms = np.sqrt((basis * basis).sum(axis=0))
+        keep = np.flatnonzero(norms > 0.5)
+        return sp.csr_array(basis[:, keep] @ sp.diags_array(1 / norms[keep]))
+
+    def blocks(self, points=None):
+        """
+        Splits the space of wave functions into subspaces of the characters.
+
+        :param points: Boolean array ordered by point indices, selects points to use. Must be invariant
+        :return: List of (character, basis) tuples for the characters with non-empty subspaces
+        """
+        if points is not None and not all(np.array_equal(points, points[image]) for image in self.images):
+            raise ValueError('Selected points are not invariant under the symmetries')
+        blocks = [(character, self.orbit_basis(character, points)) for character in self.characters()]
+        return [(character, basis) for character, basis in blocks if basis.shape[1]]
+
+    def __len__(self):
+        return len(self.generators)
+
+
+def project_operator(operator: LinearOperator, basis, matrix_free=False):
+    """
+    Projects an operator onto the subspace spanned by real orthonormal basis vectors.
+
+    :param operator: Operator object
+    :param basis: Sparse matrix with basis vectors as columns, see SymmetryGroup.orbit_basis
+    :param matrix_free: True to return a scipy LinearOperator that applies the operator without assembling it
+    :return: Matrix of the projection, dense or sparse like the operator, or scipy LinearOperator
+    """
+    size = basis.shape[1]
+    if matrix_free:
+        def matmat(vectors):
+            vectors = np.asarray(vectors).reshape((size, -1))
+            return basis.T @ operator.matmat(basis @ vectors)
+
+        return spla.LinearOperator((size,) * 2, matvec=matmat, matmat=matmat, dtype=operator.dtype())
+    if operator.is_sparse():
+        return sp.csr_array(basis.T @ operator.mat @ basis)
+    return np.asarray(basis.T @ (operator.mat @ basis))
@@ -1,3 +1,5 @@
+import numpy as np
+
 from General.Grid import Grid
 from Projects.LinearAlgebraModel.Model.BaseOperators import ParticleHamiltonian
 
@@ -10,12 +12,12 @@ class Harmonic(ParticleHamiltonian):
     Represents a multi-dimensional quantum harmonic oscillator.
     """
 
-    def __init__(self, grid: Grid, m, w):
+    def __init__(self, grid: Grid, m, w, **kwargs):
         self.m = m
         self.w = w
-        super(Harmonic, self).__init__(grid, m)
+        super(Harmonic, self).__init__(grid, m, **kwargs)
 
-    def get_potential(self, x: list) -> float:
+    def get_potential(self, x: list) -> np.ndarray:
         return self.m * self.w ** 2 * sum(t ** 2 for t in x) / 2
 
 
@@ -24,13 +26,13 @@ class Coulomb(ParticleHamiltonian):
     Represents a charged particle in the electric field of another.
     """
 
-    def __init__(self, grid: Grid, m, q1, q2):
+    def __init__(self, grid: Grid, m, q1, q2, **kwargs):
         self.m = m
         self.q1 = q1
         self.q2 = q2
-        super(Coulomb, self).__init__(grid, m)
+        super(Coulomb, self).__init__(grid, m, **kwargs)
 
-    def get_potential(self, x: list) -> float:
+    def get_potential(self, x: list) -> np.ndarray:
         return K * self.q1 * self.q2 / sum(t ** 2 for t in x) ** 0.5
 
 
@@ -39,12 +41,12 @@ class LennardJones(ParticleHamiltonian):
     Represents a particle in the Lennard-Jones potential.
     """
 
-    def __init__(self, grid: Grid, m, s):
+    def __init__(self, grid: Grid, m, s, **kwargs):
         self.m = m
         self.s = s
-        super(LennardJones, self).__init__(grid, m)
+        super(LennardJones, self).__init__(grid, m, **kwargs)
 
-    def get_potential(self, x: list) -> float:
+    def get_potential(self, x: list) -> np.ndarray:
         if len(x) > 1:
             raise ValueError('Dimension mismatch')
         return 4 * Epsilon * ((self.s / x[0]) ** 12 - (self.s / x[0]) ** 6)
@@ -55,14 +57,14 @@ class MultipleParticleCoulomb1D(ParticleHamiltonian):
     Represents two single-dimensional particles in the Coulomb potential.
     """
 
-    def __init__(self, grid: Grid, m, q_center, q1, q2):
+    def __init__(self, grid: Grid, m, q_center, q1, q2, **kwargs):
         self.m = m
         self.Q = q_center
         self.q1 = q1
         self.q2 = q2
-        super(MultipleParticleCoulomb1D, self).__init__(grid, m)
+        super(MultipleParticleCoulomb1D, self).__init__(grid, m, **kwargs)
 
-    def get_potential(self, x: list) -> float:
+    def get_potential(self, x: list) -> np.ndarray:
         if len(x) != 2:
             raise ValueError('Must contain exactly 2 particles')
         return self.Q * self.q1 / abs(x[0]) + self.Q * self.q2 / abs(x[1]) + self.q1 * self.q2 / abs(x[0] - x[1])
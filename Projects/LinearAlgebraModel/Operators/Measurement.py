@@ -1,33 +1,57 @@
-import numpy as np
-
 from General.Grid import Grid
-from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator, ScalarLinearOperator, \
-    get_first_dif_operator_mat, H
+from General.Instrumentation import current_span, matrix_attributes, traced
+from Projects.LinearAlgebraModel.Model.BaseOperators import LinearOperator, DiagonalOperator, ScalarLinearOperator, \
+    StencilOperator, OperatorSum, OperatorProduct, get_first_dif_operator_mat, H
+from Projects.LinearAlgebraModel.Model.Cache import cached, operator_key
 
 
-class TorqueOperator(LinearOperator):
-    def __init__(self, grid: Grid, axis_no=2):
+class TorqueOperator(StencilOperator):
+    @traced('assembly')
+    def __init__(self, grid: Grid, axis_no=2, sparse=True, matrix_free=False, cache=None, order=2):
         if grid.dimensions() != 3:
             raise ValueError('Grid must be three-dimensional')
+        self.axis_no = axis_no
+        self.order = order
         x = (axis_no + 1) % 3
         y = (axis_no + 2) % 3
-        dx_mat = get_first_dif_operator_mat(grid, x)
-        dy_mat = get_first_dif_operator_mat(grid, y)
-        x_mat = np.diagflat(list(grid.point_to_absolute(pt)[x] for pt in grid))
-        y_mat = np.diagflat(list(grid.point_to_absolute(pt)[y] for pt in grid))
-        super(TorqueOperator, self).__init__(grid, -H * 1j * (np.dot(x_mat, dy_mat) - np.dot(y_mat, dx_mat)))
+        super(TorqueOperator, self).__init__(grid, matrix_free=matrix_free)
+        self.add_first_dif(y, multiplier=-H * 1j, weights=grid.coordinate_columns()[x], order=order)
+        self.add_first_dif(x, multiplier=H * 1j, weights=grid.coordinate_columns()[y], order=order)
+        if not matrix_free:
+            def assemble():
+                dx = LinearOperator(grid, get_first_dif_operator_mat(grid, x, sparse=sparse, order=order))
+                dy = LinearOperator(grid, get_first_dif_operator_mat(grid, y, sparse=sparse, order=order))
+                x_op = DiagonalOperator(grid, grid.coordinate_columns()[x])
+                y_op = DiagonalOperator(grid, grid.coordinate_columns()[y])
+                return {'mat': -H * 1j * (x_op * dy - y_op * dx).mat}
+
+            self.mat = cached(operator_key(self, kind='matrix', sparse=sparse), assemble, cache)['mat']
+            current_span().set(**matrix_attributes(self.mat))
+        current_span().set(operator=type(self).__name__, points=len(grid), matrix_free=matrix_free)
+
+    def parameters(self):
+        return None if self._modified else {'axis_no': self.axis_no, 'order': self.order}
 
 
-class TorqueSquaredOperator(LinearOperator):
-    def __init__(self, grid: Grid):
+class TorqueSquaredOperator(OperatorSum):
+    def __init__(self, grid: Grid, sparse=True, matrix_free=False, cache=None, order=2):
         if grid.dimensions() != 3:
             raise ValueError('Grid must be three-dimensional')
-        components = [TorqueOperator(grid, axis) for axis in range(3)]
-        mat = sum((c * c).mat for c in components)
-        super().__init__(grid, mat)
+        self.order = order
+        components = [TorqueOperator(grid, axis, sparse=sparse, matrix_free=matrix_free, cache=cache, order=order)
+                      for axis in range(3)]
+        super().__init__(grid, [(1, c * c) for c in components])
+
+    def parameters(self):
+        return None if self._modified else {'order': self.order}
+
 
+class AngularLaplaceOperator(OperatorProduct):
+    def __init__(self, grid: Grid, sparse=True, matrix_free=False, cache=None, order=2):
+        self.order = order
+        factors = [ScalarLinearOperator(grid, lambda x: 1 / sum(a ** 2 for a in x)),
+                   TorqueSquaredOperator(grid, sparse=sparse, matrix_free=matrix_free, cache=cache, order=order)]
+        super(AngularLaplaceOperator, self).__init__(grid, factors, coefficient=-1)
 
-class AngularLaplaceOperator(LinearOperator):
-    def __init__(self, grid: Grid):
-        mat = - TorqueSquaredOperator(grid).mat * ScalarLinearOperator(grid, lambda x: 1 / sum(a ** 2 for a in x)).mat
-        super(AngularLaplaceOperator, self).__init__(grid, mat)
+    def parameters(self):
+        return None if self._modified else {'order': self.order}
@@ -17,11 +17,8 @@ def plot_polar(wf: WaveFunction, center=None):
         center = [sum(b) / len(b) for b in wf.grid.bounds]
     elif len(center) != len(wf.grid):
         raise ValueError('Center coordinates must have same dimension number as grid')
-    k = []
-    v = []
-    for pt in wf.grid:
-        k.append(sum((pair[0] - pair[1]) ** 2 for pair in zip(wf.grid.point_to_absolute(pt), center)) ** 0.5)
-        v.append(abs(wf.values[wf.grid.index(pt)]) ** 2)
+    k = np.linalg.norm(wf.grid.coordinate_columns() - np.reshape(center, (-1, 1)), axis=0)
+    v = abs(wf.point_values()) ** 2
     plot_any(v, k)
 
 
@@ -32,7 +29,7 @@ def plot_spectrum(spectrum: Spectrum, title=''):
     pl.title(title)
     ax = pl.axes()
     for alias in spectrum.operators():
-        values = [float(e[alias][0].real) for e in spectrum]
+        values = spectrum[alias][0].real
         ax.scatter(list(range(len(values))), values, label=alias)
     pl.legend()
     pl.show()
@@ -77,19 +74,15 @@ class WaveFunctionVisualizer(Visualizer):
 
         :return: multi-dimensional array
         """
-        data = np.array(self.wf.grid.mesh())
         if data_type == 'value' or data_type == 'val':
-            for pt in self.wf.grid:
-                data[pt] = self.wf.values[self.wf.grid.index(pt)]
+            data = np.real(self.wf.point_values())
         elif data_type == 'phase' or data_type == 'phs':
-            for pt in self.wf.grid:
-                data[pt] = np.angle(self.wf.values[self.wf.grid.index(pt)]) / (2 * np.pi)
+            data = np.angle(self.wf.point_values()) / (2 * np.pi)
         elif data_type == 'prob' or data_type == 'pr':
-            for pt in self.wf.grid:
-                data[pt] = self.wf.values[self.wf.grid.index(pt)] * np.conj(self.wf.values[self.wf.grid.index(pt)])
+            data = abs(self.wf.point_values()) ** 2
         else:
             raise ValueError('Unknown data extraction argument {}'.format(data_type))
-        return data
+        return self.wf.grid.to_mesh(data)
 
     def add_data(self, data_type: str):
         """
@@ -1,4 +1,5 @@
 #!/usr/bin/python
+from Projects.LinearAlgebraModel.Model.Cache import DiskCache, set_default_cache
 from Projects.LinearAlgebraModel.Model.Equation import SchrodingerSolution, WaveFunction
 from Projects.LinearAlgebraModel.Model.Spectrum import Spectrum
 from Projects.LinearAlgebraModel.Operators.Hamiltonian import *
@@ -14,6 +15,7 @@ def square_grid(r, q, dim=1, center: tuple = None):
 
 
 if __name__ == '__main__':
+    set_default_cache(DiskCache('cache'))
     grid = square_grid(5, 4, dim=3)
     hamiltonian = Coulomb(grid, 1, 1, -1)
     sol = SchrodingerSolution(hamiltonian=hamiltonian, grid=grid)